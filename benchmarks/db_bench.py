@@ -0,0 +1,383 @@
+"""
+Storage benchmarks for the user store at 10k-1M users.
+
+Generates synthetic users.json datasets and opens every backend on its own
+copy. It then times get_user, update_user, reset_daily_counts and the admin
+panel scan (flush + count_users). It also replays the bot's download
+counter update on a few hot users and reports increments that were lost.
+Per-user operations run sequentially first, then from --threads threads
+(rows marked x<threads>); errors the store logs or raises are counted.
+
+    python benchmarks/db_bench.py --sizes 10k,100k --backends json,sqlite
+    python benchmarks/db_bench.py --sizes 1M --backends sqlite,sqlite+cache --threads 16 --json db.json
+
+Backends are the stores in STORES; "<store>+cache" puts the bot's UserCache
+in front, which is how CoolVideoBot uses them. To compare a new backend, add
+its opener to STORES. Datasets are cached in --data-dir; they are reused
+across runs and regenerated when --seed changes.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import string
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from typing import Callable, Dict, List, Optional, Tuple
+
+from load_test import percentile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIRST_USER_ID = 100_000_000
+HOT_USERS = 8
+PREMIUM_SHARE = 0.05
+ACTIVE_SHARE = 0.10
+
+# Store openers, called inside the dataset's working copy (users.json is in cwd)
+STORES: Dict[str, Callable] = {
+    'json': lambda bot: bot.CoolDatabase(),
+    'sqlite': lambda bot: bot.SQLiteDatabase("bot.db"),
+}
+
+
+def parse_count(value: str) -> int:
+    """'10k', '1M', '2500' -> user count"""
+    value = value.strip().lower()
+    scale = {'k': 1000, 'm': 1_000_000}.get(value[-1:], 1)
+    return int(float(value.rstrip('km')) * scale)
+
+
+def synthetic_user(user_id: int, rng: random.Random, yesterday: str) -> Dict:
+    """A user shaped like CoolDatabase._create_default_user, with some history"""
+    premium = rng.random() < PREMIUM_SHARE
+    active = rng.random() < ACTIVE_SHARE
+    joined = date(2023, 1, 1) + timedelta(days=rng.randrange(600))
+    return {
+        "user_id": user_id,
+        "is_premium": premium,
+        "premium_until": (joined + timedelta(days=365)).isoformat() if premium else None,
+        "daily_downloads": rng.randint(1, 9) if active else 0,
+        "total_downloads": rng.randint(0, 500),
+        "referral_code": ''.join(rng.choices(string.ascii_uppercase + string.digits, k=8)),
+        "referrals": [FIRST_USER_ID + rng.randrange(1_000_000) for _ in range(rng.choice((0, 0, 0, 1, 3)))],
+        "redeemed_codes": ["WELCOME2024"] if premium else [],
+        "join_date": f"{joined.isoformat()}T12:00:00",
+        "last_reset": yesterday,
+    }
+
+
+def generate_dataset(path: str, users: int, seed: int):
+    """Write users.json in the layout CoolDatabase._save_users produces, streaming it"""
+    rng = random.Random(seed)
+    yesterday = (date.today() - timedelta(days=1)).isoformat()
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write("{")
+        for n in range(users):
+            user_id = FIRST_USER_ID + n
+            body = json.dumps(synthetic_user(user_id, rng, yesterday), indent=2).replace("\n", "\n  ")
+            f.write(f'{"," if n else ""}\n  "{user_id}": {body}')
+        f.write("\n}")
+    os.replace(tmp_path, path)
+
+
+def dataset_path(data_dir: str, users: int, seed: int) -> str:
+    path = os.path.join(data_dir, f"users-{users}-{seed}.json")
+    if not os.path.exists(path):
+        started = time.perf_counter()
+        generate_dataset(path, users, seed)
+        print(f"Generated {path} ({os.path.getsize(path) / 1024 / 1024:.0f} MB) "
+              f"in {time.perf_counter() - started:.1f}s")
+    return path
+
+
+class StoreTarget:
+    """The operations the bot performs, straight against a store"""
+
+    def __init__(self, store):
+        self.store = store
+
+    def get_user(self, user_id: int) -> Dict:
+        return self.store.get_user(user_id)
+
+    def update_user(self, user_id: int, data: Dict):
+        self.store.update_user(user_id, data)
+
+    def modify_user(self, user_id: int, func: Callable[[Dict], None]) -> Dict:
+        return self.store.modify_user(user_id, func)
+
+    def reset_daily_counts(self):
+        self.store.reset_daily_counts()
+
+    def admin_scan(self) -> Tuple[int, int]:
+        return self.store.count_users()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+        if hasattr(self.store, 'conn'):
+            self.store.conn.close()
+
+
+class CachedTarget(StoreTarget):
+    """Same operations through UserCache, the way CoolVideoBot calls them"""
+
+    def __init__(self, store, cache):
+        super().__init__(store)
+        self.cache = cache
+
+    def get_user(self, user_id: int) -> Dict:
+        return self.cache.get_user(user_id)
+
+    def update_user(self, user_id: int, data: Dict):
+        self.cache.update_user(user_id, data)
+
+    def modify_user(self, user_id: int, func: Callable[[Dict], None]) -> Dict:
+        return self.cache.modify_user(user_id, func)
+
+    def reset_daily_counts(self):
+        self.cache.reset_daily_counts()
+
+    def admin_scan(self) -> Tuple[int, int]:
+        self.cache.flush()
+        return self.store.count_users()
+
+    def flush(self):
+        self.cache.flush()
+
+
+class ErrorCounter(logging.Handler):
+    """Counts errors the stores log or raise, so a corrupted store shows up in the results"""
+
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.count = 0
+
+    def emit(self, record: logging.LogRecord):
+        self.add()
+
+    def add(self):
+        with self.lock:
+            self.count += 1
+
+    def take(self) -> int:
+        with self.lock:
+            count, self.count = self.count, 0
+        return count
+
+
+def timed_calls(func: Callable, calls: List[tuple], threads: int, budget: float,
+                errors: ErrorCounter) -> Tuple[List[float], float]:
+    """Per-call latencies of func(*args) and the wall time; stops early once budget seconds are spent"""
+    latencies: List[float] = []
+    deadline = time.monotonic() + budget
+
+    def call(args: tuple):
+        if latencies and time.monotonic() > deadline:
+            return
+        started = time.perf_counter()
+        try:
+            func(*args)
+        except Exception:
+            errors.add()
+        latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    if threads > 1:
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(call, calls))
+    else:
+        for args in calls:
+            call(args)
+    return latencies, time.perf_counter() - started
+
+
+class Bench:
+    """Runs every operation for one (size, backend) pair and collects result rows"""
+
+    def __init__(self, bot, args: argparse.Namespace, errors: ErrorCounter):
+        self.bot = bot
+        self.args = args
+        self.errors = errors
+        self.rows: List[Dict] = []
+
+    def record(self, size: int, backend: str, mode: str, op: str,
+               latencies: List[float], elapsed: float, **extra):
+        row = {
+            'size': size, 'backend': backend, 'mode': mode, 'op': op,
+            'ops': len(latencies),
+            'p50': percentile(latencies, 50),
+            'p99': percentile(latencies, 99),
+            'ops_per_sec': len(latencies) / elapsed if elapsed else 0.0,
+            'errors': self.errors.take(),
+        }
+        row.update(extra)
+        self.rows.append(row)
+        print_row(row)
+
+    def open(self, backend: str) -> StoreTarget:
+        store_name, _, cached = backend.partition('+')
+        store = STORES[store_name](self.bot)
+        if cached:
+            return CachedTarget(store, self.bot.UserCache(store, self.bot.PerformanceConfig.USER_CACHE_SIZE))
+        return StoreTarget(store)
+
+    def timed(self, func: Callable, calls: List[tuple], threads: int = 1) -> Tuple[List[float], float]:
+        return timed_calls(func, calls, threads, self.args.budget, self.errors)
+
+    def increments(self, target: StoreTarget, size: int, rng: random.Random,
+                   threads: int) -> Tuple[List[float], float, Optional[int]]:
+        """Counter increments on hot users (like update_download_count); returns lost increments"""
+        hot = [FIRST_USER_ID + n for n in range(min(HOT_USERS, size))]
+        before = {user_id: target.get_user(user_id).get('total_downloads', 0) for user_id in hot}
+        done = {user_id: 0 for user_id in hot}
+        lock = threading.Lock()
+
+        def count(user_data: Dict):
+            user_data['total_downloads'] = user_data.get('total_downloads', 0) + 1
+
+        def increment(user_id: int):
+            target.modify_user(user_id, count)
+            with lock:
+                done[user_id] += 1
+
+        calls = [(rng.choice(hot),) for _ in range(self.args.ops)]
+        latencies, elapsed = self.timed(increment, calls, threads)
+        try:
+            target.flush()
+            lost = sum(before[u] + done[u] - target.store.get_user(u).get('total_downloads', 0) for u in hot)
+        except Exception:
+            self.errors.add()
+            lost = None
+        return latencies, elapsed, lost
+
+    def per_user_ops(self, target: StoreTarget, size: int, backend: str, mode: str,
+                     threads: int, ids: List[int], rng: random.Random):
+        latencies, elapsed = self.timed(target.get_user, [(i,) for i in ids], threads)
+        self.record(size, backend, mode, 'get_user', latencies, elapsed)
+
+        calls = [(i, {'daily_downloads': 1, 'last_reset': self.bot.today_str()}) for i in ids]
+        latencies, elapsed = self.timed(target.update_user, calls, threads)
+        self.record(size, backend, mode, 'update_user', latencies, elapsed)
+
+        latencies, elapsed, lost = self.increments(target, size, rng, threads)
+        self.record(size, backend, mode, 'increment', latencies, elapsed, lost=lost)
+
+    def run(self, size: int, backend: str, dataset: str):
+        workdir = os.path.join(self.args.data_dir, f"run-{size}-{backend}")
+        shutil.rmtree(workdir, ignore_errors=True)
+        os.makedirs(workdir)
+        shutil.copyfile(dataset, os.path.join(workdir, "users.json"))
+        os.chdir(workdir)
+
+        rng = random.Random(self.args.seed)
+        ids = [FIRST_USER_ID + rng.randrange(size) for _ in range(self.args.ops)]
+        yesterday = (date.today() - timedelta(days=1)).isoformat()
+
+        # Opening includes the one-time users.json import for SQLite
+        started = time.perf_counter()
+        target = self.open(backend)
+        opened = time.perf_counter() - started
+        self.record(size, backend, 'seq', 'open', [opened], opened)
+
+        try:
+            self.per_user_ops(target, size, backend, 'seq', 1, ids, rng)
+
+            # Daily jobs and admin views run one at a time in the bot
+            latencies, elapsed = self.timed(target.admin_scan, [()] * self.args.scans)
+            self.record(size, backend, 'seq', 'admin_scan', latencies, elapsed)
+
+            latencies = []
+            for _ in range(self.args.scans):
+                # Yesterday's downloaders need resetting again; seeding is not timed
+                active = rng.sample(range(size), max(1, int(size * ACTIVE_SHARE)))
+                seed = {FIRST_USER_ID + n: {'daily_downloads': 1, 'last_reset': yesterday} for n in active}
+                try:
+                    target.store.update_users(seed)
+                except Exception:
+                    self.errors.add()
+                timings, _ = self.timed(target.reset_daily_counts, [()])
+                latencies += timings
+                if sum(latencies) > self.args.budget:
+                    break
+            self.record(size, backend, 'seq', 'reset_daily', latencies, sum(latencies))
+
+            # Last, as a store that isn't thread-safe may be left corrupted
+            mode = f"x{self.args.threads}"
+            self.per_user_ops(target, size, backend, mode, self.args.threads, ids, rng)
+        finally:
+            target.close()
+            os.chdir(self.args.data_dir)
+            if not self.args.keep:
+                shutil.rmtree(workdir, ignore_errors=True)
+
+
+def format_seconds(value: float) -> str:
+    return f"{value * 1000:9.3f}ms" if value < 10 else f"{value:10.2f}s"
+
+
+def print_row(row: Dict):
+    lost = f"  lost {row['lost'] if row['lost'] is not None else '?'}" if row.get('lost', 0) != 0 else ""
+    errors = f"  errors {row['errors']}" if row['errors'] else ""
+    print(f"{row['size']:>9} {row['backend']:<14} {row['mode']:<5} {row['op']:<12} {row['ops']:>6} "
+          f"p50 {format_seconds(row['p50'])} p99 {format_seconds(row['p99'])} "
+          f"{row['ops_per_sec']:>10.1f}/s{errors}{lost}", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="User store benchmarks")
+    parser.add_argument('--sizes', default="10k,100k,1M", help="comma separated user counts (k/M suffixes)")
+    parser.add_argument('--backends', default="json,json+cache,sqlite,sqlite+cache",
+                        help=f"comma separated, from {sorted(STORES)} with optional +cache")
+    parser.add_argument('--ops', type=int, default=200, help="calls per per-user operation")
+    parser.add_argument('--scans', type=int, default=5, help="admin scans and daily resets")
+    parser.add_argument('--threads', type=int, default=8, help="threads for the concurrent runs")
+    parser.add_argument('--budget', type=float, default=20.0, help="max seconds per operation")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), "bot-db-bench"))
+    parser.add_argument('--keep', action='store_true', help="keep the per-backend working copies")
+    parser.add_argument('--json', help="also write the result rows to this file")
+    args = parser.parse_args()
+
+    sizes = [parse_count(size) for size in args.sizes.split(',')]
+    backends = args.backends.split(',')
+    for backend in backends:
+        if backend.partition('+')[0] not in STORES or backend.partition('+')[2] not in ('', 'cache'):
+            parser.error(f"Unknown backend: {backend}")
+
+    json_path = os.path.abspath(args.json) if args.json else None
+    args.data_dir = os.path.abspath(args.data_dir)
+    scratch = os.path.join(args.data_dir, "import")
+    os.makedirs(scratch, exist_ok=True)
+
+    # bot.py opens its default store in cwd at import time; keep that out of the datasets
+    os.chdir(scratch)
+    os.environ['STORAGE_BACKEND'] = 'json'
+    sys.path.insert(0, REPO_DIR)
+    import bot
+
+    errors = ErrorCounter()
+    # Counted per operation instead of printed
+    bot.logger.addHandler(errors)
+    bot.logger.propagate = False
+    bench = Bench(bot, args, errors)
+    for size in sizes:
+        dataset = dataset_path(args.data_dir, size, args.seed)
+        for backend in backends:
+            bench.run(size, backend, dataset)
+
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump(bench.rows, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+"""
+Fake Telegram Bot API server for offline benchmarks.
+
+Answers the methods the bot calls with plausible JSON so python-telegram-bot
+can parse the replies. Uploads are streamed and counted, never stored.
+
+    python benchmarks/fake_bot_api.py --port 8081
+    LOCAL_BOT_API_URL=http://127.0.0.1:8081 BOT_TOKEN=123456:BENCH python bot.py
+"""
+import argparse
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from typing import Callable, Dict, List, Tuple
+from urllib.parse import unquote, urlsplit
+
+from aiohttp import web
+
+BOT_USER = {
+    'id': 123456,
+    'is_bot': True,
+    'first_name': 'Bench Bot',
+    'username': 'bench_bot',
+    'can_join_groups': True,
+    'can_read_all_group_messages': False,
+    'supports_inline_queries': False,
+}
+
+# Methods answering with a Message / with True
+MESSAGE_METHODS = (
+    'sendMessage', 'sendPhoto', 'sendVideo', 'sendAudio', 'sendDocument',
+    'editMessageText', 'editMessageCaption', 'editMessageReplyMarkup',
+)
+TRUE_METHODS = (
+    'deleteMessage', 'answerCallbackQuery', 'setMyCommands', 'deleteWebhook',
+    'setWebhook', 'sendChatAction',
+)
+FILE_FIELDS = {'sendVideo': 'video', 'sendAudio': 'audio', 'sendDocument': 'document', 'sendPhoto': 'photo'}
+
+Predicate = Callable[[str, Dict], bool]
+
+
+class FakeBotApi:
+    """aiohttp app emulating /bot<token>/<method> with per-chat waiters for load generators"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self.bytes_received = 0
+        self._message_ids = defaultdict(int)
+        self._file_ids = 0
+        # chat_id -> [(predicate, future)]; futures may live on another thread's event loop
+        self._lock = threading.Lock()
+        self._waiters: Dict[int, List[Tuple[Predicate, asyncio.Future]]] = defaultdict(list)
+        self.app = web.Application(client_max_size=4 * 1024 ** 3)
+        self.app.router.add_post('/bot{token}/{method}', self.handle)
+        self.app.router.add_get('/bot{token}/{method}', self.handle)
+
+    def wait_for(self, chat_id: int, predicate: Predicate) -> asyncio.Future:
+        """Future resolved with (method, params, result) of the first matching call for chat_id"""
+        future = asyncio.get_running_loop().create_future()
+        with self._lock:
+            self._waiters[chat_id].append((predicate, future))
+        return future
+
+    def _notify(self, chat_id: int, method: str, params: Dict, result):
+        with self._lock:
+            waiters = self._waiters.get(chat_id)
+            if not waiters:
+                return
+            for entry in list(waiters):
+                predicate, future = entry
+                if future.done():
+                    waiters.remove(entry)
+                elif predicate(method, params):
+                    waiters.remove(entry)
+                    future.get_loop().call_soon_threadsafe(_resolve, future, (method, params, result))
+            if not waiters:
+                del self._waiters[chat_id]
+
+    async def _read_params(self, request: web.Request) -> Dict:
+        """Form, JSON or multipart parameters; uploaded files are replaced by their size"""
+        if request.content_type.startswith('multipart/'):
+            params = {}
+            reader = await request.multipart()
+            async for part in reader:
+                if part.filename is None:
+                    params[part.name] = await part.text()
+                    continue
+                size = 0
+                while True:
+                    chunk = await part.read_chunk(256 * 1024)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                self.bytes_received += size
+                params[part.name] = {'filename': part.filename, 'size': size}
+            return params
+        if request.content_type == 'application/json':
+            return await request.json()
+        return dict(await request.post())
+
+    def _file(self, size: int) -> Dict:
+        self._file_ids += 1
+        return {
+            'file_id': f"BENCH{self._file_ids:012d}",
+            'file_unique_id': f"U{self._file_ids:012d}",
+            'file_size': size,
+        }
+
+    def _media_size(self, media) -> int:
+        """Bytes of an upload; local mode passes file:// paths instead of the content"""
+        if isinstance(media, dict):
+            return media['size']
+        if isinstance(media, str) and media.startswith('file://'):
+            try:
+                size = os.path.getsize(unquote(urlsplit(media).path))
+            except OSError:
+                return 0
+            self.bytes_received += size
+            return size
+        return 0
+
+    def _message(self, method: str, params: Dict) -> Dict:
+        chat_id = int(params.get('chat_id') or 0)
+        if 'message_id' in params:
+            message_id = int(params['message_id'])
+        else:
+            self._message_ids[chat_id] += 1
+            message_id = self._message_ids[chat_id]
+
+        message = {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': BOT_USER,
+        }
+        if 'text' in params:
+            message['text'] = params['text']
+        if 'caption' in params:
+            message['caption'] = params['caption']
+        if params.get('reply_markup'):
+            markup = params['reply_markup']
+            message['reply_markup'] = json.loads(markup) if isinstance(markup, str) else markup
+
+        field = FILE_FIELDS.get(method)
+        if field:
+            size = self._media_size(params.get(field))
+            if field == 'photo':
+                message['photo'] = [dict(self._file(size), width=320, height=180)]
+            elif field == 'video':
+                message['video'] = dict(self._file(size), width=1280, height=720, duration=10)
+            elif field == 'audio':
+                message['audio'] = dict(self._file(size), duration=10)
+            else:
+                message['document'] = self._file(size)
+        return message
+
+    def _media_group(self, params: Dict) -> List[Dict]:
+        media = params.get('media') or []
+        if isinstance(media, str):
+            media = json.loads(media)
+        messages = []
+        for item in media:
+            attached = params.get(str(item.get('media', '')).replace('attach://', ''))
+            fields = {
+                'chat_id': params.get('chat_id'),
+                'caption': item.get('caption', ''),
+                item.get('type', 'video'): attached if isinstance(attached, dict) else None,
+            }
+            method = 'send' + item.get('type', 'video').capitalize()
+            messages.append(self._message(method, fields))
+        return messages
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        params = await self._read_params(request)
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if method == 'getMe':
+            result = BOT_USER
+        elif method in MESSAGE_METHODS:
+            result = self._message(method, params)
+        elif method == 'sendMediaGroup':
+            result = self._media_group(params)
+        elif method in TRUE_METHODS:
+            result = True
+        elif method == 'getUpdates':
+            await asyncio.sleep(min(float(params.get('timeout') or 0), 1.0))
+            result = []
+        else:
+            return web.json_response(
+                {'ok': False, 'error_code': 404, 'description': f"Not Found: {method}"}, status=404
+            )
+
+        if params.get('chat_id'):
+            self._notify(int(params['chat_id']), method, params, result)
+        return web.json_response({'ok': True, 'result': result})
+
+
+def _resolve(future: asyncio.Future, value):
+    if not future.done():
+        future.set_result(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Telegram Bot API server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every call")
+    args = parser.parse_args()
+    web.run_app(FakeBotApi(args.latency).app, host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,308 @@
+"""
+Offline load test for CoolVideoBot.
+
+Starts the fake Bot API and the synthetic media server on localhost, points
+the bot at them and feeds it synthetic Updates at a fixed rate. Each virtual
+user sends a link, waits for the quality menu, presses "Best Quality" and
+waits for the video to arrive.
+
+    python benchmarks/load_test.py --requests 200 --rate 10 --size 8MB
+    python benchmarks/load_test.py --requests 100 --rate 5 --same-url      # info and file_id caches
+    python benchmarks/load_test.py --bandwidth 2MB --local-mode --json out.json
+
+Bot settings come from the environment as usual (DOWNLOAD_WORKERS=8 ...).
+The bot runs in a scratch directory so users.json and downloads/ of a real
+deployment are never touched. Peak RSS covers the whole process, stubs
+included; they keep counters only, so differences between runs are the bot's.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import math
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+
+from aiohttp import web
+
+from fake_bot_api import FakeBotApi
+from media_server import MediaServer, parse_size
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOKEN = "123456:BENCH"
+FIRST_USER_ID = 10_000_000
+FAILURE_PREFIXES = ('❌', '🛑', '⚠️', '⌛')
+PHASES = ('analyze', 'download', 'total')
+
+
+class ServerThread(threading.Thread):
+    """Runs the stub servers on their own event loop so they don't compete with the bot's"""
+
+    def __init__(self, apps: List[web.Application]):
+        super().__init__(name="bench-servers", daemon=True)
+        self.apps = apps
+        self.urls: List[str] = []
+        self.loop = asyncio.new_event_loop()
+        self._runners: List[web.AppRunner] = []
+        self._ready = threading.Event()
+        self._error: Optional[BaseException] = None
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._start())
+        except BaseException as e:
+            self._error = e
+            return
+        finally:
+            self._ready.set()
+        self.loop.run_forever()
+
+    async def _start(self):
+        for app in self.apps:
+            # Probe requests left open by extractors must not hold up shutdown
+            runner = web.AppRunner(app, access_log=None, shutdown_timeout=1.0)
+            await runner.setup()
+            await web.TCPSite(runner, "127.0.0.1", 0).start()
+            host, port = runner.addresses[0][:2]
+            self.urls.append(f"http://{host}:{port}")
+            self._runners.append(runner)
+
+    def start_servers(self) -> List[str]:
+        """Start the thread and return the base URL of every app"""
+        self.start()
+        self._ready.wait()
+        if self._error:
+            raise self._error
+        return self.urls
+
+    def stop(self):
+        async def cleanup():
+            for runner in self._runners:
+                await runner.cleanup()
+
+        asyncio.run_coroutine_threadsafe(cleanup(), self.loop).result(timeout=10)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.join(timeout=10)
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+def peak_rss() -> int:
+    """Peak resident set size of this process in bytes"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def is_failure(params: Dict) -> bool:
+    return str(params.get('text') or '').startswith(FAILURE_PREFIXES)
+
+
+def user_dict(user_id: int) -> Dict:
+    return {'id': user_id, 'is_bot': False, 'first_name': f"Bench{user_id}", 'language_code': 'en'}
+
+
+class LoadGenerator:
+    """Virtual users replaying link -> menu -> best quality -> video against the bot"""
+
+    def __init__(self, application, api: FakeBotApi, media_url: str, args: argparse.Namespace):
+        self.application = application
+        self.api = api
+        self.media_url = media_url
+        self.args = args
+        self.update_ids = itertools.count(1)
+        self.latencies: Dict[str, List[float]] = {phase: [] for phase in PHASES}
+        self.errors = Counter()
+
+    async def feed(self, payload: Dict):
+        from telegram import Update
+
+        payload['update_id'] = next(self.update_ids)
+        await self.application.update_queue.put(Update.de_json(payload, self.application.bot))
+
+    async def expect(self, user_id: int, predicate, payload: Dict):
+        """Feed an update and wait for the matching Bot API call from the bot"""
+        reply = self.api.wait_for(user_id, lambda method, params: predicate(method, params) or is_failure(params))
+        await self.feed(payload)
+        try:
+            return await asyncio.wait_for(reply, self.args.timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def virtual_user(self, n: int):
+        user_id = FIRST_USER_ID + n
+        name = "clip-0.mp4" if self.args.same_url else f"clip-{n}.mp4"
+        url = f"{self.media_url}/media/{name}?size={self.args.size}"
+        chat = {'id': user_id, 'type': 'private'}
+        started = time.monotonic()
+
+        reply = await self.expect(
+            user_id,
+            lambda method, params: 'dl:' in str(params.get('reply_markup') or ''),
+            {'message': {
+                'message_id': 1, 'date': int(time.time()), 'chat': chat,
+                'from': user_dict(user_id), 'text': url,
+            }}
+        )
+        if not reply or is_failure(reply[1]):
+            self.errors[reply[1]['text'][:60] if reply else "menu timeout"] += 1
+            return
+        analyzed = time.monotonic()
+
+        _, _, menu = reply
+        buttons = [button for row in menu['reply_markup']['inline_keyboard'] for button in row]
+        data = next(b['callback_data'] for b in buttons if b.get('callback_data', '').endswith(':best'))
+        reply = await self.expect(
+            user_id,
+            lambda method, params: method == 'sendVideo',
+            {'callback_query': {
+                'id': str(user_id), 'from': user_dict(user_id), 'chat_instance': str(user_id),
+                'message': menu, 'data': data,
+            }}
+        )
+        if not reply or is_failure(reply[1]):
+            self.errors[reply[1]['text'][:60] if reply else "download timeout"] += 1
+            return
+        done = time.monotonic()
+
+        self.latencies['analyze'].append(analyzed - started)
+        self.latencies['download'].append(done - analyzed)
+        self.latencies['total'].append(done - started)
+
+    async def run(self) -> float:
+        """Start a virtual user every 1/rate seconds; returns the wall time of the run"""
+        started = time.monotonic()
+        tasks = []
+        for n in range(self.args.requests):
+            tasks.append(asyncio.create_task(self.virtual_user(n)))
+            # Open loop: arrivals don't wait for earlier users to finish
+            await asyncio.sleep(max(0.0, started + (n + 1) / self.args.rate - time.monotonic()))
+        await asyncio.gather(*tasks)
+        return time.monotonic() - started
+
+
+async def run(args: argparse.Namespace, api: FakeBotApi, media: MediaServer, api_url: str, media_url: str) -> Dict:
+    import bot as botmod
+    from telegram.ext import Application
+
+    bot = botmod.CoolVideoBot()
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .base_url(f"{api_url}/bot")
+        .base_file_url(f"{api_url}/file/bot")
+        .concurrent_updates(botmod.PerformanceConfig.CONCURRENT_UPDATES)
+        .updater(None)
+    )
+    if args.local_mode:
+        builder = builder.local_mode(True)
+    application = builder.build()
+    botmod.add_handlers(application, bot)
+
+    await application.initialize()
+    await botmod.post_init(application)
+    await application.start()
+    startup_rss = peak_rss()
+    generator = LoadGenerator(application, api, media_url, args)
+    try:
+        elapsed = await generator.run()
+    finally:
+        await application.stop()
+        await application.shutdown()
+        await bot.shutdown(application)
+
+    completed = len(generator.latencies['total'])
+    return {
+        'requests': args.requests,
+        'rate': args.rate,
+        'size': args.size,
+        'completed': completed,
+        'failed': args.requests - completed,
+        'errors': dict(generator.errors),
+        'elapsed': elapsed,
+        'downloads_per_sec': completed / elapsed if elapsed else 0.0,
+        'latency': {
+            phase: {'p50': percentile(values, 50), 'p99': percentile(values, 99)}
+            for phase, values in generator.latencies.items()
+        },
+        'startup_rss': startup_rss,
+        'peak_rss': peak_rss(),
+        'api_calls': dict(api.calls),
+        'uploaded_bytes': api.bytes_received,
+        'served_bytes': media.bytes_sent,
+    }
+
+
+def print_report(result: Dict):
+    mb = 1024 * 1024
+    print(f"\n{result['completed']}/{result['requests']} downloads in {result['elapsed']:.1f}s "
+          f"({result['rate']:g} req/s offered, {result['size'] / mb:.1f} MB each)")
+    for phase, stats in result['latency'].items():
+        print(f"  {phase:<9} p50 {stats['p50']:7.3f}s   p99 {stats['p99']:7.3f}s")
+    print(f"  downloads/sec  {result['downloads_per_sec']:.2f}")
+    print(f"  peak RSS       {result['peak_rss'] / mb:.1f} MB (after startup {result['startup_rss'] / mb:.1f} MB)")
+    print(f"  served         {result['served_bytes'] / mb:.1f} MB, uploaded {result['uploaded_bytes'] / mb:.1f} MB")
+    print(f"  api calls      {', '.join(f'{k}={v}' for k, v in sorted(result['api_calls'].items()))}")
+    for error, count in result['errors'].items():
+        print(f"  failed x{count}: {error}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test against a fake Bot API")
+    parser.add_argument('--requests', type=int, default=50, help="virtual users, one download each")
+    parser.add_argument('--rate', type=float, default=5.0, help="new users per second")
+    parser.add_argument('--size', type=parse_size, default=parse_size('8MB'), help="synthetic video size")
+    parser.add_argument('--bandwidth', type=parse_size, default=0, help="media bytes/sec per connection")
+    parser.add_argument('--media-latency', type=float, default=0.0, help="seconds before the first media byte")
+    parser.add_argument('--api-latency', type=float, default=0.0, help="seconds added to every Bot API call")
+    parser.add_argument('--same-url', action='store_true', help="every user requests the same video")
+    parser.add_argument('--local-mode', action='store_true', help="emulate a local Bot API server (uploads by path)")
+    parser.add_argument('--timeout', type=float, default=300.0, help="per-phase timeout in seconds")
+    parser.add_argument('--workdir', help="directory for the bot's files (default: a temporary one)")
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    api = FakeBotApi(latency=args.api_latency)
+    media = MediaServer(args.size, args.bandwidth, args.media_latency)
+    servers = ServerThread([api.app, media.app])
+    api_url, media_url = servers.start_servers()
+
+    # bot.py reads its config and opens users.json at import time
+    json_path = os.path.abspath(args.json) if args.json else None
+    os.chdir(args.workdir or tempfile.mkdtemp(prefix="bot-bench-"))
+    os.environ['BOT_TOKEN'] = TOKEN
+    os.environ.setdefault('METRICS_ENABLED', '0')
+    if args.local_mode:
+        os.environ['LOCAL_BOT_API_URL'] = api_url
+    else:
+        os.environ.pop('LOCAL_BOT_API_URL', None)
+    sys.path.insert(0, REPO_DIR)
+
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    print(f"Bot API {api_url}, media {media_url}, workdir {os.getcwd()}")
+
+    try:
+        result = asyncio.run(run(args, api, media, api_url, media_url))
+        print_report(result)
+        if json_path:
+            with open(json_path, 'w') as f:
+                json.dump(result, f, indent=2)
+    finally:
+        servers.stop()
+
+
+if __name__ == '__main__':
+    main()
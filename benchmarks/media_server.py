@@ -0,0 +1,131 @@
+"""
+Synthetic media server for offline benchmarks.
+
+Serves /media/<name>.mp4?size=<bytes> as video/mp4 with Range support, so
+yt-dlp's generic extractor treats it as a direct link. The body is an ftyp
+header followed by filler; nothing has to decode it. Every distinct name is
+a distinct video to the bot's caches.
+
+    python benchmarks/media_server.py --port 8082 --size 8MB --bandwidth 4MB
+    curl -I "http://127.0.0.1:8082/media/clip-1.mp4?size=1048576"
+"""
+import argparse
+import asyncio
+import re
+from typing import Optional, Tuple
+
+from aiohttp import web
+
+CHUNK = 256 * 1024
+FTYP = b'\x00\x00\x00\x18ftypisom\x00\x00\x02\x00isomiso2'
+FILLER = bytes(range(256)) * (CHUNK // 256)
+RANGE_RE = re.compile(r'bytes=(\d*)-(\d*)$')
+CONTENT_TYPES = {'mp4': 'video/mp4', 'webm': 'video/webm', 'm4a': 'audio/mp4', 'mp3': 'audio/mpeg'}
+
+
+def parse_size(value: str) -> int:
+    """'8MB', '512K', '1048576' -> bytes"""
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)\s*([KMG]?)B?', value.strip().upper())
+    if not match:
+        raise ValueError(f"Invalid size: {value}")
+    number, unit = match.groups()
+    return int(float(number) * 1024 ** ' KMG'.index(unit or ' '))
+
+
+def synthetic_bytes(start: int, end: int) -> bytes:
+    """Content of the synthetic file between offsets [start, end)"""
+    out = bytearray()
+    position = start
+    while position < end:
+        if position < len(FTYP):
+            piece = FTYP[position:min(end, len(FTYP))]
+        else:
+            offset = (position - len(FTYP)) % CHUNK
+            piece = FILLER[offset:offset + min(end - position, CHUNK - offset)]
+        out += piece
+        position += len(piece)
+    return bytes(out)
+
+
+class MediaServer:
+    """aiohttp app serving synthetic videos, optionally throttled per connection"""
+
+    def __init__(self, size: int, bandwidth: int = 0, latency: float = 0.0):
+        self.size = size
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.requests = 0
+        self.bytes_sent = 0
+        self.app = web.Application()
+        self.app.router.add_get('/media/{name}', self.handle)  # also answers HEAD
+
+    def _range(self, header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+        """[start, end) for a single Range header; None serves the whole file"""
+        match = RANGE_RE.match(header or '')
+        if not match or match.groups() == ('', ''):
+            return None
+        first, last = match.groups()
+        if first:
+            start, end = int(first), min(int(last) + 1 if last else size, size)
+        else:
+            start, end = max(size - int(last), 0), size
+        if start >= size or start >= end:
+            raise web.HTTPRequestRangeNotSatisfiable(headers={'Content-Range': f"bytes */{size}"})
+        return start, end
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        name = request.match_info['name']
+        ext = name.rsplit('.', 1)[-1].lower()
+        size = int(request.query.get('size', self.size))
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        byte_range = self._range(request.headers.get('Range'), size)
+        start, end = byte_range or (0, size)
+        response = web.StreamResponse(status=206 if byte_range else 200, headers={
+            'Content-Type': CONTENT_TYPES.get(ext, 'application/octet-stream'),
+            'Content-Length': str(end - start),
+            'Accept-Ranges': 'bytes',
+            'Last-Modified': 'Mon, 01 Jan 2024 00:00:00 GMT',
+        })
+        if byte_range:
+            response.headers['Content-Range'] = f"bytes {start}-{end - 1}/{size}"
+        await response.prepare(request)
+        if request.method == 'HEAD':
+            return response
+
+        loop = asyncio.get_running_loop()
+        began = loop.time()
+        position = start
+        try:
+            while position < end:
+                data = synthetic_bytes(position, min(position + CHUNK, end))
+                await response.write(data)
+                position += len(data)
+                self.bytes_sent += len(data)
+                if self.bandwidth:
+                    # Sleep until the bytes sent so far fit the configured rate
+                    delay = began + (position - start) / self.bandwidth - loop.time()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+            await response.write_eof()
+        except ConnectionResetError:
+            # Extractors read the headers and hang up; that is expected
+            pass
+        return response
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Synthetic media server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8082)
+    parser.add_argument('--size', type=parse_size, default=parse_size('8MB'), help="default file size")
+    parser.add_argument('--bandwidth', type=parse_size, default=0, help="bytes/sec per connection, 0 = unlimited")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds before the first byte")
+    args = parser.parse_args()
+    web.run_app(MediaServer(args.size, args.bandwidth, args.latency).app, host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,14 +2,39 @@ import os
 import logging
 import asyncio
 import json
+import sqlite3
 import random
 import string
 import time
-from datetime import datetime, timedelta
-from typing import Dict, List, Tuple
-from io import BytesIO
+import uuid
+import copy
+import secrets
+import signal
+import shutil
+import tempfile
+import threading
+import functools
+import contextlib
+import contextvars
+import cProfile
+import pstats
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, time as dtime
+from zoneinfo import ZoneInfo
+from typing import Callable, Dict, List, Tuple, Optional, Union
+from io import BytesIO, StringIO
+from http.cookies import SimpleCookie, CookieError
+from pathlib import Path
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 import traceback
 
+try:
+    import fcntl
+except ImportError:
+    # Windows: writers are only serialized within this process
+    fcntl = None
+
 from telegram import (
     Update, 
     InlineKeyboardButton, 
@@ -17,7 +42,8 @@ from telegram import (
     BotCommand,
     ReplyKeyboardMarkup,
     KeyboardButton,
-    InputFile
+    InputFile,
+    InputMediaVideo
 )
 from telegram.ext import (
     Application, 
@@ -28,9 +54,12 @@ from telegram.ext import (
     filters,
     ConversationHandler
 )
-from telegram.error import BadRequest
+from telegram.error import BadRequest, RetryAfter, Forbidden, TelegramError
 
 import yt_dlp
+from aiohttp import web
+from prometheus_client import Counter, Histogram, REGISTRY, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
 import requests
 from bs4 import BeautifulSoup
 import re
@@ -58,6 +87,10 @@ class PremiumConfig:
     FREE_MAX_QUALITY = "720p"
     PREMIUM_MAX_QUALITY = "4K"
     
+    # Concurrent downloads per user
+    FREE_CONCURRENT_DOWNLOADS = 1
+    PREMIUM_CONCURRENT_DOWNLOADS = 2
+    
     # Referral system
     REFERRAL_BONUS = 5  # Extra downloads per referral
     
@@ -70,196 +103,2806 @@ class PremiumConfig:
         "DEVIL": 365  # 👑 Special code
     }
 
+# Performance tuning (override with environment variables)
+class PerformanceConfig:
+    # Worker pools: yt-dlp is blocking, so it never runs on the event loop
+    METADATA_WORKERS = int(os.getenv("METADATA_WORKERS", "8"))
+    DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", "4"))
+    
+    # Jobs allowed to wait for a worker before new ones are rejected
+    METADATA_QUEUE_SIZE = int(os.getenv("METADATA_QUEUE_SIZE", "32"))
+    DOWNLOAD_QUEUE_SIZE = int(os.getenv("DOWNLOAD_QUEUE_SIZE", "16"))
+    
+    # Download scheduler: global cap, queued jobs per user, premium picks per free pick
+    MAX_CONCURRENT_DOWNLOADS = int(os.getenv("MAX_CONCURRENT_DOWNLOADS", str(DOWNLOAD_WORKERS)))
+    MAX_QUEUED_PER_USER = int(os.getenv("MAX_QUEUED_PER_USER", "3"))
+    PREMIUM_WEIGHT = int(os.getenv("PREMIUM_WEIGHT", "3"))
+    
+    # Each job downloads into its own DOWNLOAD_DIR/<job_id>/ directory
+    DOWNLOAD_DIR = os.getenv("DOWNLOAD_DIR", "downloads")
+    
+    # Disk janitor for DOWNLOAD_DIR (bytes / seconds)
+    DOWNLOAD_DIR_BUDGET = int(os.getenv("DOWNLOAD_DIR_BUDGET", str(4 * 1024 * 1024 * 1024)))
+    MIN_FREE_BYTES = int(os.getenv("MIN_FREE_BYTES", str(1024 * 1024 * 1024)))
+    JANITOR_INTERVAL = int(os.getenv("JANITOR_INTERVAL", "600"))
+    STALE_PARTIAL_AGE = int(os.getenv("STALE_PARTIAL_AGE", "1800"))
+    ORPHAN_GRACE = int(os.getenv("ORPHAN_GRACE", "300"))
+    
+    # Seconds between progress edits of a status message
+    PROGRESS_INTERVAL = float(os.getenv("PROGRESS_INTERVAL", "4"))
+    
+    # Timezone whose midnight resets the daily download counters
+    TIMEZONE = os.getenv("TIMEZONE", "UTC")
+    
+    # Broadcasts: messages/second (Telegram allows ~30), parallel senders, checkpoint file
+    BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+    BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))
+    BROADCAST_STATE_FILE = os.getenv("BROADCAST_STATE_FILE", "broadcast_state.json")
+    BROADCAST_REPORT_INTERVAL = float(os.getenv("BROADCAST_REPORT_INTERVAL", "5"))
+    
+    # Progressive formats up to this size are fetched into memory instead of DOWNLOAD_DIR (0 = off)
+    MEMORY_DOWNLOAD_MAX = int(os.getenv("MEMORY_DOWNLOAD_MAX", str(20 * 1024 * 1024)))
+    
+    # /batch: items per request, items fetched in parallel, seconds a partial media group may wait
+    BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "20"))
+    BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", "3"))
+    BATCH_GROUP_WAIT = float(os.getenv("BATCH_GROUP_WAIT", "10"))
+    
+    # Audio: "native" keeps the source stream (AAC -> m4a copy) and only encodes what
+    # Telegram can't play; "mp3" always re-encodes to MP3 like before
+    AUDIO_MODE = os.getenv("AUDIO_MODE", "native").lower()
+    
+    # ffmpeg transcodes (/compress, /convert): parallel processes, threads each, source limits
+    TRANSCODE_WORKERS = int(os.getenv("TRANSCODE_WORKERS", "1"))
+    TRANSCODE_THREADS = int(os.getenv("TRANSCODE_THREADS", "2"))
+    TRANSCODE_MAX_INPUT = int(os.getenv("TRANSCODE_MAX_INPUT", str(500 * 1024 * 1024)))
+    TRANSCODE_MAX_HEIGHT = int(os.getenv("TRANSCODE_MAX_HEIGHT", "720"))
+    
+    # Uploads: parallel uploads to Telegram, write timeout for large files (seconds)
+    MAX_CONCURRENT_UPLOADS = int(os.getenv("MAX_CONCURRENT_UPLOADS", "2"))
+    UPLOAD_TIMEOUT = float(os.getenv("UPLOAD_TIMEOUT", "600"))
+    
+    # Local Bot API server (e.g. http://localhost:8081): files are sent by path, up to 2GB
+    LOCAL_BOT_API_URL = os.getenv("LOCAL_BOT_API_URL", "").rstrip("/")
+    
+    # Tracing: fraction of requests traced (0 = off), traces slower than this many seconds
+    # are logged as warnings with a cProfile dump in PROFILE_DIR (0 = no profiling)
+    TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+    SLOW_REQUEST_SECONDS = float(os.getenv("SLOW_REQUEST_SECONDS", "30"))
+    PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+    
+    # "text" or "json" (JSON lines carry trace_id/span_id)
+    LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+    
+    # Webhook mode (set WEBHOOK_URL, e.g. https://app.example.com); polling otherwise.
+    # PORT is also where /healthz, /readyz and /metrics are served (set by web dynos)
+    WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+    WEBHOOK_PATH = "/" + os.getenv("WEBHOOK_PATH", "telegram").strip("/")
+    WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "") or secrets.token_urlsafe(32)
+    WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+    HTTP_HOST = os.getenv("HTTP_HOST", "0.0.0.0")
+    PORT = int(os.getenv("PORT", "8080"))
+    # Opt in (METRICS_ENABLED=1) to serve the HTTP endpoints in polling mode too, for Prometheus
+    # scrapes; without PORT or HTTP_HOST they then listen on localhost only
+    METRICS_ENABLED = os.getenv("METRICS_ENABLED", "0") != "0"
+    
+    # Updates handled in parallel by python-telegram-bot
+    CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "64"))
+    
+    # Storage backend: "json" (users.json) or "sqlite"
+    STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json").lower()
+    SQLITE_PATH = os.getenv("SQLITE_PATH", "bot.db")
+    
+    # In-memory user cache (write-back, flushed every interval seconds)
+    USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+    USER_CACHE_FLUSH_INTERVAL = int(os.getenv("USER_CACHE_FLUSH_INTERVAL", "10"))
+    
+    # Download history: append-only event log, rollups live in stats.json,
+    # per-user counts and event offsets in an indexed SQLite file
+    DOWNLOAD_LOG_FILE = os.getenv("DOWNLOAD_LOG_FILE", "downloads.jsonl")
+    HISTORY_INDEX_FILE = os.getenv("HISTORY_INDEX_FILE", "history.db")
+    HISTORY_PER_USER = int(os.getenv("HISTORY_PER_USER", "100"))
+    
+    # Telegram file_id cache for already uploaded media
+    FILE_ID_CACHE_PATH = os.getenv("FILE_ID_CACHE_PATH", "file_ids.json")
+    FILE_ID_CACHE_SIZE = int(os.getenv("FILE_ID_CACHE_SIZE", "50000"))
+    
+    # Extracted video info cache (seconds / entries / approximate bytes)
+    INFO_CACHE_TTL = int(os.getenv("INFO_CACHE_TTL", "600"))
+    INFO_CACHE_SIZE = int(os.getenv("INFO_CACHE_SIZE", "1000"))
+    INFO_CACHE_MAX_BYTES = int(os.getenv("INFO_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+    
+    # Quality-selection menus (callback tokens -> extracted info)
+    SESSION_TTL = int(os.getenv("SESSION_TTL", "1800"))
+    SESSION_MAX = int(os.getenv("SESSION_MAX", "5000"))
+    SESSION_MAX_BYTES = int(os.getenv("SESSION_MAX_BYTES", str(128 * 1024 * 1024)))
+
+BOT_TZ = ZoneInfo(PerformanceConfig.TIMEZONE)
+
+def today_str() -> str:
+    """Current day in the bot's timezone (the key daily counters belong to)"""
+    return datetime.now(BOT_TZ).date().isoformat()
+
+def daily_downloads(user_data: Dict) -> int:
+    """Downloads made today; a counter from an earlier day counts as 0"""
+    if user_data.get('last_reset') != today_str():
+        return 0
+    return user_data.get('daily_downloads', 0)
+
+# ======================
+# LOGGING SETUP
+# ======================
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# ======================
+# TRACING
+# ======================
+class Span:
+    """One timed step of a traced request"""
+    def __init__(self, name: str, trace_id: str, parent: Optional["Span"] = None, **attrs):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:8]
+        self.parent = parent
+        self.attrs = attrs
+        self.children: List["Span"] = []
+        self.error: Optional[str] = None
+        self.start = time.monotonic()
+        self.end: Optional[float] = None
+    
+    @property
+    def duration(self) -> float:
+        return (self.end or time.monotonic()) - self.start
+    
+    def tree(self, origin: Optional[float] = None, depth: int = 0) -> str:
+        """Indented span tree with start offsets and durations"""
+        origin = self.start if origin is None else origin
+        attrs = " ".join(f"{key}={value}" for key, value in self.attrs.items())
+        line = (
+            f"{'  ' * depth}+{self.start - origin:.2f}s {self.name} {self.duration:.2f}s"
+            f"{' ' + attrs if attrs else ''}{' ERROR ' + self.error if self.error else ''}"
+        )
+        return "\n".join([line] + [child.tree(origin, depth + 1) for child in list(self.children)])
+
+# The span of the request being handled; copied into tasks and worker threads
+_current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar('current_span', default=None)
+_profiling = threading.Lock()
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+@contextlib.contextmanager
+def _enter_span(new_span: Span):
+    token = _current_span.set(new_span)
+    try:
+        yield new_span
+    except BaseException as e:
+        new_span.error = type(e).__name__
+        raise
+    finally:
+        new_span.end = time.monotonic()
+        _current_span.reset(token)
+
+def span(name: str, **attrs):
+    """Child span of the current request; a shared no-op when the request isn't traced"""
+    parent = _current_span.get()
+    if parent is None:
+        return contextlib.nullcontext()
+    child = Span(name, parent.trace_id, parent, **attrs)
+    parent.children.append(child)
+    return _enter_span(child)
+
+@contextlib.contextmanager
+def _root_span(name: str):
+    """Trace a request; slow ones are logged with their span tree and a profile"""
+    root = Span(name, uuid.uuid4().hex[:16])
+    # cProfile covers the event loop thread, so only one request is profiled at a time
+    profiler = None
+    if PerformanceConfig.SLOW_REQUEST_SECONDS and _profiling.acquire(blocking=False):
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            profiler = None
+            _profiling.release()
+    try:
+        with _enter_span(root):
+            yield root
+    finally:
+        if profiler:
+            profiler.disable()
+            _profiling.release()
+        slow = PerformanceConfig.SLOW_REQUEST_SECONDS and root.duration >= PerformanceConfig.SLOW_REQUEST_SECONDS
+        if slow:
+            logger.warning(f"Slow request trace={root.trace_id}\n{root.tree()}{_dump_profile(profiler, root)}")
+        else:
+            logger.info(f"Trace trace={root.trace_id}\n{root.tree()}")
+
+def _dump_profile(profiler: Optional[cProfile.Profile], root: Span) -> str:
+    """Write the profile of a slow request; returns a short summary for the log"""
+    if profiler is None:
+        return ""
+    try:
+        os.makedirs(PerformanceConfig.PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PerformanceConfig.PROFILE_DIR, f"{root.name}-{root.trace_id}.prof")
+        profiler.dump_stats(path)
+        summary = StringIO()
+        pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(15)
+        return f"\nProfile saved to {path} (event loop thread):\n{summary.getvalue()}"
+    except Exception as e:
+        return f"\nProfile dump failed: {e}"
+
+def traced(name: str):
+    """Decorator for request entry points: starts a sampled trace, or a span inside one"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if _current_span.get() is not None:
+                with span(name):
+                    return await func(*args, **kwargs)
+            rate = PerformanceConfig.TRACE_SAMPLE_RATE
+            if not rate or random.random() >= rate:
+                return await func(*args, **kwargs)
+            with _root_span(name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def bind_context(func, name: str):
+    """Run func in another thread under the caller's trace (unchanged when not tracing)"""
+    if _current_span.get() is None:
+        return func
+    
+    def run():
+        with span(name):
+            return func()
+    return functools.partial(contextvars.copy_context().run, run)
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per line, with the trace and span of the current request"""
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        active = _current_span.get()
+        if active is not None:
+            entry['trace_id'] = active.trace_id
+            entry['span_id'] = active.span_id
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+if PerformanceConfig.LOG_FORMAT == "json":
+    for handler in logging.getLogger().handlers:
+        handler.setFormatter(JsonLogFormatter())
+
+# ======================
+# METRICS
+# ======================
+# Seconds; large downloads, uploads and transcodes take minutes
+STAGE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+STAGE_SECONDS = Histogram(
+    'bot_stage_duration_seconds', 'Time spent in each pipeline stage', ['stage'], buckets=STAGE_BUCKETS
+)
+STAGE_ERRORS = Counter('bot_stage_errors', 'Failed pipeline stages by extractor', ['stage', 'extractor'])
+UPLOAD_BYTES = Counter('bot_upload_bytes', 'Bytes uploaded to Telegram', ['kind'])
+
+# yt-dlp prefixes its errors with the extractor name: "[youtube] abc: Video unavailable"
+ERROR_EXTRACTOR_RE = re.compile(r'\[([\w:.-]+)\]')
+
+def extractor_label(info: Optional[Dict] = None, error: str = "") -> str:
+    """Bounded extractor label for metrics"""
+    if info and info.get('extractor'):
+        return info['extractor'].lower()
+    match = ERROR_EXTRACTOR_RE.search(error)
+    return match.group(1).lower() if match else 'unknown'
+
+def count_error(stage: str, extractor: str = 'unknown'):
+    STAGE_ERRORS.labels(stage, extractor).inc()
+
+@contextlib.contextmanager
+def track_stage(stage: str, extractor: str = 'unknown'):
+    """Time a pipeline stage (and trace it as a span); exceptions other than user cancellation count as errors"""
+    start = time.monotonic()
+    try:
+        with span(stage):
+            yield
+    except yt_dlp.utils.DownloadCancelled:
+        raise
+    except Exception as e:
+        count_error(stage, extractor if extractor != 'unknown' else extractor_label(error=str(e)))
+        raise
+    finally:
+        STAGE_SECONDS.labels(stage).observe(time.monotonic() - start)
+
+def timed(stage: str):
+    """Decorator form of track_stage for coroutine methods"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with track_stage(stage):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# ======================
+# DATABASE SIMULATION (Using JSON files)
+# ======================
+def atomic_write(path: str, data: str):
+    """Replace path with data; after a crash the file holds either the old or the new content"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_file = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            if os.name == 'posix':
+                # mkstemp creates 0600; keep the file readable like before
+                os.fchmod(f.fileno(), 0o644)
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.unlink(tmp_file)
+        raise
+    if os.name != 'posix':
+        return
+    # The rename is only durable once the directory entry is on disk
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+class FileLock:
+    """Exclusive writer lock across threads (threading.Lock) and processes (flock on path)"""
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._fd: Optional[int] = None
+    
+    def __enter__(self):
+        self._lock.acquire()
+        if fcntl is None:
+            return self
+        try:
+            if self._fd is None:
+                self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        except BaseException:
+            self._lock.release()
+            raise
+        return self
+    
+    def __exit__(self, *exc):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._lock.release()
+
+class StoreCorruptError(Exception):
+    """Raised when users.json can't be parsed; it is never replaced by default users"""
+
+class CoolDatabase:
+    def __init__(self):
+        self.users_file = "users.json"
+        self.stats_file = "stats.json"
+        self.downloads_file = "downloads.json"
+        # Held for every read-modify-write of users.json (a separate file survives renames)
+        self._write_lock = FileLock(f"{self.users_file}.lock")
+        self._init_files()
+    
+    def _init_files(self):
+        """Initialize JSON files"""
+        for file in [self.users_file, self.stats_file, self.downloads_file]:
+            if not os.path.exists(file):
+                with open(file, 'w') as f:
+                    json.dump({}, f)
+        
+        # Writers hold the lock while their temp file exists, so any left now is from a crash
+        users_path = Path(self.users_file)
+        with self._write_lock:
+            for stale in users_path.parent.glob(f".{users_path.name}.*.tmp"):
+                stale.unlink(missing_ok=True)
+    
+    def _load_users(self) -> Dict:
+        """Parse users.json; raises StoreCorruptError instead of guessing"""
+        try:
+            with open(self.users_file, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            raise StoreCorruptError(f"{self.users_file} is corrupt: {e}") from e
+    
+    def _save_users(self, users: Dict):
+        """Write users.json atomically and durably (temp file + fsync + rename)"""
+        atomic_write(self.users_file, json.dumps(users, indent=2))
+    
+    @contextlib.contextmanager
+    def transaction(self):
+        """Yield all users under the writer lock and save them if the block succeeds"""
+        with self._write_lock:
+            users = self._load_users()
+            yield users
+            self._save_users(users)
+    
+    def get_user(self, user_id: int) -> Dict:
+        """Get user data (readers never see a partial file, so no lock is needed)"""
+        user_data = self._load_users().get(str(user_id))
+        return user_data if user_data is not None else self._create_default_user(user_id)
+    
+    def modify_user(self, user_id: int, func: Callable[[Dict], None]) -> Dict:
+        """Read-modify-write one user atomically; func mutates the user dict in place"""
+        user_id_str = str(user_id)
+        with self.transaction() as users:
+            if user_id_str not in users:
+                users[user_id_str] = self._create_default_user(user_id)
+            user_data = users[user_id_str]
+            func(user_data)
+            user_data['updated_at'] = datetime.now().isoformat()
+        return dict(user_data)
+    
+    def update_user(self, user_id: int, data: Dict):
+        """Update user data"""
+        try:
+            self.modify_user(user_id, lambda user_data: user_data.update(data))
+        except Exception as e:
+            logger.error(f"Update user error: {e}")
+    
+    def update_users(self, batch: Dict[int, Dict]):
+        """Write several users in one pass (raises on failure)"""
+        with self.transaction() as users:
+            for user_id, data in batch.items():
+                user_id_str = str(user_id)
+                if user_id_str not in users:
+                    users[user_id_str] = self._create_default_user(user_id)
+                users[user_id_str].update(data)
+    
+    def _create_default_user(self, user_id: int) -> Dict:
+        """Create default user structure"""
+        return {
+            "user_id": user_id,
+            "is_premium": False,
+            "premium_until": None,
+            "daily_downloads": 0,
+            "total_downloads": 0,
+            "referral_code": self._generate_referral_code(),
+            "referrals": [],
+            "redeemed_codes": [],
+            "join_date": datetime.now().isoformat(),
+            "last_reset": today_str()
+        }
+    
+    def _generate_referral_code(self) -> str:
+        """Generate random referral code"""
+        return ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
+    
+    def reset_daily_counts(self):
+        """Nothing to write: daily_downloads() already reads a counter from an earlier day as 0.
+        
+        Rewriting users.json here would cost O(all users); a stale counter is replaced the
+        next time that user downloads something.
+        """
+    
+    def iter_users(self):
+        """Yield (user_id, user_data) for every stored user"""
+        users = self._load_users()
+        for user_id, user_data in users.items():
+            yield int(user_id), user_data
+    
+    def count_users(self) -> Tuple[int, int]:
+        """Return (total users, premium users)"""
+        users = self._load_users()
+        premium = sum(1 for u in users.values() if u.get('is_premium'))
+        return len(users), premium
+
+class SQLiteDatabase(CoolDatabase):
+    """Same API as CoolDatabase, stored in an indexed SQLite table (WAL mode)"""
+    def __init__(self, path: str = "bot.db"):
+        self.path = path
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                is_premium INTEGER NOT NULL DEFAULT 0,
+                daily_downloads INTEGER NOT NULL DEFAULT 0,
+                last_reset TEXT,
+                data TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_users_premium ON users(is_premium);
+            CREATE INDEX IF NOT EXISTS idx_users_active ON users(last_reset) WHERE daily_downloads > 0;
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+        """)
+        super().__init__()
+        self._migrate_once()
+    
+    def _init_files(self):
+        """Only stats/downloads stay in JSON files"""
+        for file in [self.stats_file, self.downloads_file]:
+            if not os.path.exists(file):
+                with open(file, 'w') as f:
+                    json.dump({}, f)
+    
+    def _migrate_once(self):
+        """Import users.json the first time the SQLite store is opened"""
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'json_migrated'").fetchone()
+        if row or not os.path.exists(self.users_file):
+            return
+        count = migrate_json_to_sqlite(self.users_file, self)
+        logger.info(f"Migrated {count} users from {self.users_file} to {self.path}")
+    
+    def _write_row(self, user_id: int, user_data: Dict):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO users (user_id, is_premium, daily_downloads, last_reset, data) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (
+                user_id,
+                1 if user_data.get('is_premium') else 0,
+                user_data.get('daily_downloads', 0),
+                user_data.get('last_reset'),
+                json.dumps(user_data)
+            )
+        )
+    
+    def get_user(self, user_id: int) -> Dict:
+        """Get user data (read errors propagate rather than returning a blank user)"""
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT data FROM users WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        if row:
+            return json.loads(row[0])
+        return self._create_default_user(user_id)
+    
+    def modify_user(self, user_id: int, func: Callable[[Dict], None]) -> Dict:
+        """Read-modify-write one user in a single transaction"""
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.conn.execute(
+                    "SELECT data FROM users WHERE user_id = ?", (user_id,)
+                ).fetchone()
+                user_data = json.loads(row[0]) if row else self._create_default_user(user_id)
+                func(user_data)
+                user_data['updated_at'] = datetime.now().isoformat()
+                self._write_row(user_id, user_data)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        return dict(user_data)
+    
+    def update_user(self, user_id: int, data: Dict):
+        """Update user data"""
+        try:
+            self.modify_user(user_id, lambda user_data: user_data.update(data))
+        except Exception as e:
+            logger.error(f"Update user error: {e}")
+    
+    def update_users(self, batch: Dict[int, Dict]):
+        """Write several users in one transaction (raises on failure)"""
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                for user_id, data in batch.items():
+                    row = self.conn.execute(
+                        "SELECT data FROM users WHERE user_id = ?", (user_id,)
+                    ).fetchone()
+                    user_data = json.loads(row[0]) if row else self._create_default_user(user_id)
+                    user_data.update(data)
+                    self._write_row(user_id, user_data)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+    
+    def reset_daily_counts(self):
+        """Zero yesterday's counters (uses the partial index, so O(active users))"""
+        try:
+            today = today_str()
+            with self._lock:
+                self.conn.execute(
+                    "UPDATE users SET daily_downloads = 0, last_reset = ?, "
+                    "data = json_set(data, '$.daily_downloads', 0, '$.last_reset', ?) "
+                    "WHERE daily_downloads > 0 AND last_reset IS NOT ?",
+                    (today, today, today)
+                )
+        except Exception as e:
+            logger.error(f"Reset counts error: {e}")
+    
+    def iter_users(self):
+        """Yield (user_id, user_data) for every stored user"""
+        with self._lock:
+            rows = self.conn.execute("SELECT user_id, data FROM users").fetchall()
+        for user_id, data in rows:
+            yield user_id, json.loads(data)
+    
+    def count_users(self) -> Tuple[int, int]:
+        """Return (total users, premium users)"""
+        with self._lock:
+            total, premium = self.conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(is_premium), 0) FROM users"
+            ).fetchone()
+        return total, premium
+
+def migrate_json_to_sqlite(json_path: str, target: SQLiteDatabase) -> int:
+    """Copy every user from a users.json file into a SQLite store"""
+    with open(json_path, 'r') as f:
+        users = json.load(f)
+    
+    with target._lock:
+        target.conn.execute("BEGIN IMMEDIATE")
+        try:
+            for user_id, user_data in users.items():
+                target._write_row(int(user_id), user_data)
+            target.conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('json_migrated', ?)",
+                (datetime.now().isoformat(),)
+            )
+            target.conn.execute("COMMIT")
+        except Exception:
+            target.conn.execute("ROLLBACK")
+            raise
+    return len(users)
+
+def create_database() -> CoolDatabase:
+    """Pick the storage backend from PerformanceConfig"""
+    if PerformanceConfig.STORAGE_BACKEND == "sqlite":
+        return SQLiteDatabase(PerformanceConfig.SQLITE_PATH)
+    store = CoolDatabase()
+    # Parse users.json once now, so a damaged file stops startup instead of failing every handler
+    store._load_users()
+    return store
+
+# Initialize database
+try:
+    db = create_database()
+except StoreCorruptError as e:
+    print(f"❌ ERROR: {e}")
+    print("Restore users.json from a backup (or repair it) and restart; the bot won't run on a damaged user store")
+    raise SystemExit(1)
+
+# ======================
+# USER CACHE
+# ======================
+class UserCache:
+    """Write-back LRU cache in front of the user store"""
+    def __init__(self, store: CoolDatabase, max_size: int = 10000):
+        self.store = store
+        self.max_size = max_size
+        self._entries: "OrderedDict[int, Dict]" = OrderedDict()
+        self._dirty = set()
+        # Dirty entries evicted before a flush, and the batch a flush is writing right now;
+        # misses read these first so the store's older copy is never loaded over them
+        self._evicted: Dict[int, Dict] = {}
+        self._inflight: Dict[int, Dict] = {}
+        self._lock = threading.RLock()
+        # Serializes flushes so an older batch can't land after a newer one (taken before _lock)
+        self._flush_lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+    
+    def _load(self, user_id: int) -> Dict:
+        """Return the cached entry, reading it from the store on a miss"""
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry
+        
+        self.misses += 1
+        entry = self._evicted.pop(user_id, None)
+        if entry is not None:
+            self._dirty.add(user_id)
+        elif user_id in self._inflight:
+            entry = dict(self._inflight[user_id])
+        else:
+            entry = self.store.get_user(user_id)
+        self._entries[user_id] = entry
+        self._evict()
+        return entry
+    
+    def _evict(self):
+        while len(self._entries) > self.max_size:
+            user_id, entry = self._entries.popitem(last=False)
+            if user_id in self._dirty:
+                # Never drop unsaved changes; they go out with the next flush
+                self._dirty.discard(user_id)
+                self._evicted[user_id] = entry
+    
+    def get_user(self, user_id: int) -> Dict:
+        """Get user data"""
+        with self._lock:
+            return dict(self._load(user_id))
+    
+    def modify_user(self, user_id: int, func: Callable[[Dict], None]) -> Dict:
+        """Read-modify-write a user atomically; func mutates the entry in place (persisted on the next flush)"""
+        with self._lock:
+            entry = self._load(user_id)
+            func(entry)
+            entry['updated_at'] = datetime.now().isoformat()
+            self._dirty.add(user_id)
+            return dict(entry)
+    
+    def update_user(self, user_id: int, data: Dict):
+        """Update user data (persisted on the next flush)"""
+        self.modify_user(user_id, lambda entry: entry.update(data))
+    
+    def update_users(self, batch: Dict[int, Dict]):
+        """Write several users straight to the store in one batch, patching the copies held here.
+        
+        Cached entries are not read from the store first, so this suits bulk flag changes.
+        """
+        with self._flush_lock:
+            with self._lock:
+                for user_id, data in batch.items():
+                    for copies in (self._entries, self._evicted):
+                        if user_id in copies:
+                            copies[user_id].update(data)
+            self.store.update_users(batch)
+    
+    def _take_dirty(self) -> Dict[int, Dict]:
+        with self._lock:
+            batch = self._evicted
+            batch.update((user_id, dict(self._entries[user_id])) for user_id in self._dirty)
+            self._evicted = {}
+            self._dirty.clear()
+            self._inflight = batch
+            return batch
+    
+    def _finish_flush(self, batch: Dict[int, Dict], ok: bool):
+        with self._lock:
+            self._inflight = {}
+            if ok:
+                return
+            for user_id, entry in batch.items():
+                if user_id in self._entries:
+                    self._dirty.add(user_id)
+                else:
+                    self._evicted.setdefault(user_id, entry)
+    
+    def flush(self) -> int:
+        """Write all dirty and evicted entries to the store in one batch"""
+        with self._flush_lock:
+            batch = self._take_dirty()
+            if not batch:
+                return 0
+            try:
+                self.store.update_users(batch)
+            except Exception as e:
+                self._finish_flush(batch, False)
+                logger.error(f"User cache flush error: {e}")
+                return 0
+            self._finish_flush(batch, True)
+            return len(batch)
+    
+    async def flush_async(self) -> int:
+        """Same as flush, but the store write runs off the event loop"""
+        return await asyncio.to_thread(self.flush)
+    
+    def reset_daily_counts(self):
+        """Flush, then reset counts in the store.
+        
+        Cached entries stay valid: a counter whose last_reset is not today already reads as 0.
+        Only _flush_lock is held across the store write, so lookups keep being served meanwhile.
+        """
+        with self._flush_lock:
+            self.flush()
+            self.store.reset_daily_counts()
+    
+    def stats(self) -> Dict:
+        """Cache hit/miss counters"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'dirty': len(self._dirty) + len(self._evicted),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0
+            }
+
+# ======================
+# DOWNLOAD LOG
+# ======================
+class DownloadLog:
+    """Append-only JSONL log of finished downloads with incrementally maintained rollups.
+    
+    Small rollups (totals, per-extractor counts) are checkpointed to stats_file with the
+    log offset they cover. Per-user counts and the offsets of each user's newest per_user
+    events live in an indexed SQLite file, written in one transaction per flush. Startup only
+    replays the tail of the log past whichever checkpoint is older.
+    """
+    def __init__(self, log_file: str, stats_file: str, index_file: str, per_user: int = 100):
+        self.log_file = log_file
+        self.stats_file = stats_file
+        self.per_user = per_user
+        self._lock = threading.Lock()
+        # Serializes flushes; the index is written without holding _lock
+        self._flush_lock = threading.Lock()
+        self._dirty = False
+        self.stats = self._empty_stats()
+        # (log offset, user id, bytes) of events not yet in the index, and of those a flush is writing
+        self._pending: List[Tuple[int, int, int]] = []
+        self._inflight: List[Tuple[int, int, int]] = []
+        # Written only by flush (and at startup); lookups use their own connection (WAL readers don't block)
+        self.index = sqlite3.connect(index_file, check_same_thread=False, isolation_level=None)
+        self.index.execute("PRAGMA journal_mode=WAL")
+        self.index.execute("PRAGMA synchronous=NORMAL")
+        self.index.executescript("""
+            CREATE TABLE IF NOT EXISTS history (
+                log_offset INTEGER PRIMARY KEY,
+                user_id INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_history_user ON history(user_id, log_offset);
+            CREATE TABLE IF NOT EXISTS user_totals (
+                user_id INTEGER PRIMARY KEY,
+                count INTEGER NOT NULL DEFAULT 0,
+                bytes INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+        """)
+        self._reader = sqlite3.connect(index_file, check_same_thread=False, isolation_level=None)
+        self._load()
+    
+    @staticmethod
+    def _empty_stats() -> Dict:
+        return {
+            'log_offset': 0,
+            'total': 0,
+            'bytes': 0,
+            'cache_hits': 0,
+            'extractors': {}
+        }
+    
+    def _index_offset(self) -> Optional[int]:
+        row = self.index.execute("SELECT value FROM meta WHERE key = 'log_offset'").fetchone()
+        return int(row[0]) if row else None
+    
+    def _load(self):
+        try:
+            with open(self.stats_file, 'r') as f:
+                stats = json.load(f)
+            if 'log_offset' in stats:
+                self.stats = stats
+        except Exception:
+            pass
+        
+        legacy_users = self.stats.pop('users', None)
+        index_offset = self._index_offset()
+        if index_offset is None:
+            # First start with the index: take over what older versions kept in stats_file
+            index_offset = self.stats['log_offset'] if legacy_users else 0
+            self._migrate_users(legacy_users or {}, index_offset)
+        # Rewrite stats_file without the per-user data on the next flush
+        self._dirty = legacy_users is not None
+        
+        # Replay events written after the older of the two checkpoints
+        if not os.path.exists(self.log_file):
+            return
+        if max(self.stats['log_offset'], index_offset) > os.path.getsize(self.log_file):
+            # The log was truncated or replaced: rebuild everything from it
+            self.stats = self._empty_stats()
+            self.index.execute("DELETE FROM history")
+            self.index.execute("DELETE FROM user_totals")
+            index_offset = 0
+            self._write_index([], {}, index_offset)
+        stats_offset = self.stats['log_offset']
+        with open(self.log_file, 'rb') as f:
+            f.seek(min(stats_offset, index_offset))
+            while True:
+                offset = f.tell()
+                line = f.readline()
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    event = json.loads(line)
+                    if offset >= stats_offset:
+                        self._apply(event)
+                    if offset >= index_offset:
+                        self._pending.append((offset, int(event['user']), event.get('bytes', 0)))
+                except (ValueError, KeyError):
+                    pass
+                self.stats['log_offset'] = f.tell()
+                self._dirty = True
+    
+    def _migrate_users(self, users: Dict, log_offset: int):
+        """Import the per-user rollups stats_file used to hold"""
+        rows = [
+            (offset, int(user_id)) for user_id, user in users.items() for offset in user.get('offsets', [])
+        ]
+        totals = {int(user_id): (user.get('count', 0), user.get('bytes', 0)) for user_id, user in users.items()}
+        self._write_index(rows, totals, log_offset)
+        if users:
+            logger.info(f"Moved download history of {len(users)} users to the history index")
+    
+    def _write_events(self, events: List[Tuple[int, int, int]], log_offset: int):
+        totals: Dict[int, Tuple[int, int]] = {}
+        for _, user_id, num_bytes in events:
+            count, total_bytes = totals.get(user_id, (0, 0))
+            totals[user_id] = (count + 1, total_bytes + num_bytes)
+        rows = [(offset, user_id) for offset, user_id, _ in events]
+        self._write_index(rows, totals, log_offset)
+    
+    def _write_index(self, rows: List[Tuple[int, int]], totals: Dict[int, Tuple[int, int]], log_offset: int):
+        """Add events and per-user totals to the index with the log offset it now covers, in one transaction.
+        
+        Only the newest per_user events of each user are kept; older ones are never shown.
+        """
+        self.index.execute("BEGIN IMMEDIATE")
+        try:
+            self.index.executemany("INSERT OR IGNORE INTO history (log_offset, user_id) VALUES (?, ?)", rows)
+            self.index.executemany(
+                "INSERT INTO user_totals (user_id, count, bytes) VALUES (?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET count = count + excluded.count, bytes = bytes + excluded.bytes",
+                ((user_id, count, num_bytes) for user_id, (count, num_bytes) in totals.items())
+            )
+            self.index.executemany(
+                "DELETE FROM history WHERE user_id = ? AND log_offset < ("
+                "SELECT log_offset FROM history WHERE user_id = ? ORDER BY log_offset DESC LIMIT 1 OFFSET ?)",
+                ((user_id, user_id, self.per_user - 1) for user_id in totals)
+            )
+            self.index.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('log_offset', ?)", (str(log_offset),)
+            )
+            # Readers see the new rows and stop counting the in-flight copies at the same moment
+            with self._lock:
+                self.index.execute("COMMIT")
+                self._inflight = []
+        except Exception:
+            self.index.execute("ROLLBACK")
+            raise
+    
+    def _apply(self, event: Dict):
+        stats = self.stats
+        stats['total'] += 1
+        stats['bytes'] += event.get('bytes', 0)
+        stats['cache_hits'] += 1 if event.get('cache_hit') else 0
+        extractor = event.get('extractor', 'generic')
+        stats['extractors'][extractor] = stats['extractors'].get(extractor, 0) + 1
+    
+    def record(self, event: Dict):
+        """Append one download event and update the rollups"""
+        line = (json.dumps(event) + '\n').encode()
+        with self._lock:
+            with open(self.log_file, 'ab') as f:
+                offset = f.tell()
+                f.write(line)
+            self._apply(event)
+            self._pending.append((offset, int(event['user']), event.get('bytes', 0)))
+            self.stats['log_offset'] = offset + len(line)
+            self._dirty = True
+    
+    def flush(self):
+        """Write new events to the index, then checkpoint the rollups"""
+        with self._flush_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                events, self._pending = self._pending, []
+                self._inflight = events
+                log_offset = self.stats['log_offset']
+                data = json.dumps(self.stats)
+                self._dirty = False
+            
+            if events:
+                # Only this interval's events; WAL with synchronous=NORMAL commits without fsync
+                try:
+                    self._write_events(events, log_offset)
+                except Exception:
+                    with self._lock:
+                        self._pending = events + self._pending
+                        self._inflight = []
+                        self._dirty = True
+                    raise
+            
+            tmp_file = f"{self.stats_file}.tmp"
+            with open(tmp_file, 'w') as f:
+                f.write(data)
+            os.replace(tmp_file, self.stats_file)
+    
+    def totals(self) -> Dict:
+        with self._lock:
+            return {key: self.stats[key] for key in ('total', 'bytes', 'cache_hits')}
+    
+    def user_count(self, user_id: int) -> int:
+        with self._lock:
+            row = self._reader.execute("SELECT count FROM user_totals WHERE user_id = ?", (user_id,)).fetchone()
+            unindexed = sum(1 for _, uid, _ in self._inflight + self._pending if uid == user_id)
+            return (row[0] if row else 0) + unindexed
+    
+    def history(self, user_id: int, page: int = 0, per_page: int = 10) -> List[Dict]:
+        """A page of the user's most recent downloads (newest first)"""
+        wanted = min((page + 1) * per_page, self.per_user)
+        with self._lock:
+            # Events not yet in the index are newer than anything in it
+            offsets = [offset for offset, uid, _ in reversed(self._inflight + self._pending) if uid == user_id]
+            offsets += [row[0] for row in self._reader.execute(
+                "SELECT log_offset FROM history WHERE user_id = ? ORDER BY log_offset DESC LIMIT ?",
+                (user_id, wanted)
+            )]
+        events = []
+        with open(self.log_file, 'rb') as f:
+            for offset in offsets[page * per_page:wanted]:
+                f.seek(offset)
+                events.append(json.loads(f.readline()))
+        return events
+
+download_log = DownloadLog(
+    PerformanceConfig.DOWNLOAD_LOG_FILE,
+    db.stats_file,
+    PerformanceConfig.HISTORY_INDEX_FILE,
+    PerformanceConfig.HISTORY_PER_USER
+)
+
+# ======================
+# FILE ID CACHE
+# ======================
+class FileIdCache:
+    """Persistent map of (extractor, video id, format) -> uploaded Telegram file_id"""
+    MEDIA_KINDS = ('video', 'audio', 'animation', 'document')
+    
+    def __init__(self, path: str = "file_ids.json", max_size: int = 50000):
+        self.path = path
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, Dict]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._dirty = False
+        self.hits = 0
+        self.misses = 0
+        self._load()
+    
+    @staticmethod
+    def make_key(extractor: str, video_id: str, variant: str) -> str:
+        return f"{extractor.lower()}:{video_id}:{variant}"
+    
+    def _load(self):
+        try:
+            with open(self.path, 'r') as f:
+                self._entries = OrderedDict(json.load(f))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error(f"File id cache load error: {e}")
+    
+    def flush(self):
+        """Write the map if it changed; called periodically off the event loop"""
+        with self._lock:
+            if not self._dirty:
+                return
+            # Entries are never mutated after put, so a shallow copy is a consistent snapshot
+            snapshot = list(self._entries.items())
+            self._dirty = False
+        try:
+            atomic_write(self.path, json.dumps(dict(snapshot)))
+        except Exception as e:
+            with self._lock:
+                self._dirty = True
+            logger.error(f"File id cache save error: {e}")
+    
+    def get(self, key: str) -> Optional[Dict]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+    
+    def put(self, key: str, entry: Dict):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            self._dirty = True
+    
+    def discard(self, key: str):
+        """Forget a file_id Telegram no longer accepts"""
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self._dirty = True
+    
+    @classmethod
+    def entry_from_message(cls, message) -> Optional[Dict]:
+        """Build a cache entry from the message Telegram returned after an upload"""
+        for kind in cls.MEDIA_KINDS:
+            media = getattr(message, kind, None)
+            if media:
+                return {
+                    'kind': kind,
+                    'file_id': media.file_id,
+                    'file_size': media.file_size or 0,
+                    'created': datetime.now().isoformat()
+                }
+        return None
+
+file_id_cache = FileIdCache(PerformanceConfig.FILE_ID_CACHE_PATH, PerformanceConfig.FILE_ID_CACHE_SIZE)
+
+# ======================
+# EXECUTION ENGINE
+# ======================
+class PoolBusyError(Exception):
+    """Raised when a worker pool has no room left in its queue"""
+
+class FileTooLargeError(yt_dlp.utils.DownloadCancelled):
+    """Raised from the progress hook once a transfer crosses the size limit"""
+
+class TransferStats:
+    """Per-extractor transfer totals collected from yt-dlp progress hooks"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals: Dict[str, Dict] = defaultdict(lambda: {'downloads': 0, 'bytes': 0, 'seconds': 0.0})
+    
+    def record(self, extractor: str, num_bytes: int, seconds: float):
+        with self._lock:
+            totals = self._totals[extractor]
+            totals['downloads'] += 1
+            totals['bytes'] += num_bytes
+            totals['seconds'] += seconds
+    
+    def snapshot(self) -> Dict[str, Dict]:
+        """extractor -> downloads, bytes, seconds and average speed (bytes/s)"""
+        with self._lock:
+            return {
+                extractor: dict(totals, speed=totals['bytes'] / totals['seconds'] if totals['seconds'] else 0)
+                for extractor, totals in self._totals.items()
+            }
+
+transfer_stats = TransferStats()
+
+class DownloadJob:
+    """Handle for a single download that can be cancelled"""
+    def __init__(self, user_id: int, max_bytes: int = 0, to_disk: bool = False):
+        self.job_id = uuid.uuid4().hex[:12]
+        self.user_id = user_id
+        self.max_bytes = max_bytes
+        # Never buffer in memory (for results that wait before upload, like batch items)
+        self.to_disk = to_disk
+        self.workdir = os.path.join(PerformanceConfig.DOWNLOAD_DIR, self.job_id)
+        self.cancel_event = threading.Event()
+        self._finished_bytes = 0
+        # Latest progress, written by the worker thread and read by the event loop
+        self._progress_lock = threading.Lock()
+        self._progress: Dict = {}
+        self._progress_version = 0
+    
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_event.is_set()
+    
+    def cancel(self):
+        """Ask the worker thread to stop"""
+        self.cancel_event.set()
+    
+    def cleanup(self):
+        """Remove the job's download directory and everything in it"""
+        shutil.rmtree(self.workdir, ignore_errors=True)
+    
+    def progress_hook(self, status: Dict):
+        """yt-dlp progress hook: publishes progress, aborts once cancelled or oversize"""
+        if self.cancel_event.is_set():
+            raise yt_dlp.utils.DownloadCancelled("Cancelled by user")
+        
+        expected = status.get('total_bytes') or status.get('total_bytes_estimate') or 0
+        downloaded = status.get('downloaded_bytes') or 0
+        
+        # Merged formats download several files; count them together
+        if status.get('status') == 'finished':
+            self._finished_bytes += expected or downloaded
+            extractor = (status.get('info_dict') or {}).get('extractor', 'generic')
+            transfer_stats.record(extractor, expected or downloaded, status.get('elapsed') or 0)
+            return
+        
+        with self._progress_lock:
+            self._progress = {
+                'downloaded': self._finished_bytes + downloaded,
+                'total': self._finished_bytes + expected if expected else 0,
+                'speed': status.get('speed') or 0,
+                'eta': status.get('eta'),
+            }
+            self._progress_version += 1
+        
+        if self.max_bytes and self._finished_bytes + max(expected, downloaded) > self.max_bytes:
+            raise FileTooLargeError("File is larger than your size limit")
+    
+    def progress(self) -> Tuple[int, Dict]:
+        """(version, latest progress) - version changes on every update"""
+        with self._progress_lock:
+            return self._progress_version, dict(self._progress)
+
+class WorkerPool:
+    """Bounded thread pool for blocking yt-dlp calls"""
+    def __init__(self, name: str, max_workers: int, max_queue: int):
+        self.name = name
+        self.capacity = max_workers + max_queue
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix=f"{name}-worker"
+        )
+        self._pending = 0
+        self._lock = threading.Lock()
+    
+    @property
+    def depth(self) -> int:
+        """Jobs currently running or waiting for a worker"""
+        return self._pending
+    
+    def _release(self, _future):
+        with self._lock:
+            self._pending -= 1
+    
+    async def run(self, func, *args, **kwargs):
+        """Run func in the pool and await its result"""
+        with self._lock:
+            if self._pending >= self.capacity:
+                raise PoolBusyError(f"{self.name} queue is full")
+            self._pending += 1
+        
+        try:
+            future = self.executor.submit(bind_context(functools.partial(func, *args, **kwargs), f"{self.name}.run"))
+        except Exception:
+            with self._lock:
+                self._pending -= 1
+            raise
+        
+        # Slot is freed when the thread finishes, not when the caller stops waiting
+        future.add_done_callback(self._release)
+        return await asyncio.wrap_future(future)
+    
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+# ======================
+# DOWNLOAD SCHEDULER
+# ======================
+class SchedulerFullError(Exception):
+    """Raised when a user already has too many downloads waiting"""
+
+class DownloadTicket:
+    """A download waiting for (or holding) a scheduler slot"""
+    def __init__(self, user_id: int, premium: bool, job: Optional[DownloadJob], on_position=None):
+        self.user_id = user_id
+        self.premium = premium
+        self.job = job
+        self.on_position = on_position
+        self.future = asyncio.get_running_loop().create_future()
+        self.position = 0
+        # One task per ticket sends position changes, in order and at most one per PROGRESS_INTERVAL
+        self.shown = 0
+        self.updater: Optional[asyncio.Task] = None
+        self.started = asyncio.Event()
+
+class DownloadScheduler:
+    """Admits downloads under a global cap with per-user limits, premium priority
+    and round-robin fairness between users of the same tier"""
+    def __init__(self, max_concurrent: int, max_queued_per_user: int = 3, premium_weight: int = 3):
+        self.max_concurrent = max_concurrent
+        self.max_queued_per_user = max_queued_per_user
+        self.premium_weight = premium_weight
+        self._queues: Dict[int, deque] = {}
+        # Users with waiting tickets, per tier, in round-robin order
+        self._rotation = {True: deque(), False: deque()}
+        self._running: Dict[int, int] = defaultdict(int)
+        self._active = 0
+        self._premium_streak = 0
+    
+    @property
+    def queued(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+    
+    @property
+    def active(self) -> int:
+        return self._active
+    
+    def _user_limit(self, premium: bool) -> int:
+        if premium:
+            return PremiumConfig.PREMIUM_CONCURRENT_DOWNLOADS
+        return PremiumConfig.FREE_CONCURRENT_DOWNLOADS
+    
+    def _pick_from(self, premium: bool) -> Optional[DownloadTicket]:
+        """Next eligible ticket of a tier, rotating users for fairness"""
+        rotation = self._rotation[premium]
+        for _ in range(len(rotation)):
+            user_id = rotation[0]
+            rotation.rotate(-1)
+            queue = self._queues[user_id]
+            if self._running[user_id] >= self._user_limit(premium):
+                continue
+            ticket = queue.popleft()
+            if not queue:
+                del self._queues[user_id]
+                rotation.remove(user_id)
+            return ticket
+        return None
+    
+    def _next_ticket(self) -> Optional[DownloadTicket]:
+        # Premium goes first, but every premium_weight picks a free user gets a turn
+        prefer_premium = self._premium_streak < self.premium_weight
+        for premium in ((True, False) if prefer_premium else (False, True)):
+            ticket = self._pick_from(premium)
+            if ticket:
+                self._premium_streak = self._premium_streak + 1 if premium else 0
+                return ticket
+        return None
+    
+    def _dispatch(self):
+        while self._active < self.max_concurrent:
+            ticket = self._next_ticket()
+            if ticket is None:
+                break
+            self._active += 1
+            self._running[ticket.user_id] += 1
+            ticket.future.set_result(True)
+            if ticket.position:
+                ticket.position = 0
+                ticket.started.set()
+                self._notify(ticket)
+    
+    def _ordered_waiting(self) -> List[DownloadTicket]:
+        """Waiting tickets in the order they are expected to start"""
+        def interleave(premium: bool) -> List[DownloadTicket]:
+            queues = [list(self._queues[user_id]) for user_id in self._rotation[premium]]
+            order = []
+            for depth in range(max((len(q) for q in queues), default=0)):
+                order.extend(q[depth] for q in queues if depth < len(q))
+            return order
+        
+        premium, free = interleave(True), interleave(False)
+        order = []
+        streak = self._premium_streak
+        while premium or free:
+            if premium and (streak < self.premium_weight or not free):
+                order.append(premium.pop(0))
+                streak += 1
+            else:
+                order.append(free.pop(0))
+                streak = 0
+        return order
+    
+    def _notify(self, ticket: DownloadTicket):
+        """Make sure the ticket's updater will send its latest position"""
+        if ticket.on_position is None or (ticket.updater and not ticket.updater.done()):
+            return
+        ticket.updater = asyncio.ensure_future(self._send_positions(ticket))
+    
+    async def _send_positions(self, ticket: DownloadTicket):
+        """Send the latest position until the message is current; intermediate ones are skipped"""
+        while ticket.shown != ticket.position:
+            position = ticket.position
+            try:
+                await ticket.on_position(position)
+            except RetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+                continue
+            except Exception as e:
+                logger.debug(f"Queue position update failed: {e}")
+            ticket.shown = position
+            if not position:
+                return
+            # Rate limit, but let the "started" update through right away
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(ticket.started.wait(), PerformanceConfig.PROGRESS_INTERVAL)
+    
+    def _report_positions(self):
+        for index, ticket in enumerate(self._ordered_waiting(), start=1):
+            if ticket.position != index:
+                ticket.position = index
+                self._notify(ticket)
+    
+    def _remove_waiting(self, ticket: DownloadTicket):
+        queue = self._queues.get(ticket.user_id)
+        if queue and ticket in queue:
+            queue.remove(ticket)
+            if not queue:
+                del self._queues[ticket.user_id]
+                self._rotation[ticket.premium].remove(ticket.user_id)
+    
+    def _release(self, ticket: DownloadTicket):
+        self._active -= 1
+        self._running[ticket.user_id] -= 1
+        if self._running[ticket.user_id] <= 0:
+            del self._running[ticket.user_id]
+        self._dispatch()
+        self._report_positions()
+    
+    def cancel(self, job_id: str) -> bool:
+        """Drop a waiting ticket whose job was cancelled"""
+        for queue in list(self._queues.values()):
+            for ticket in list(queue):
+                if ticket.job and ticket.job.job_id == job_id:
+                    self._remove_waiting(ticket)
+                    ticket.future.set_exception(yt_dlp.utils.DownloadCancelled("Cancelled by user"))
+                    self._report_positions()
+                    return True
+        return False
+    
+    def _user_tickets(self, user_id: int) -> int:
+        return len(self._queues.get(user_id, ())) + self._running.get(user_id, 0)
+    
+    def remaining(self, user_id: int, premium: bool) -> int:
+        """How many more downloads the user may start or queue right now"""
+        return self.max_queued_per_user + self._user_limit(premium) - self._user_tickets(user_id)
+    
+    @contextlib.asynccontextmanager
+    async def slot(self, user_id: int, premium: bool, job: Optional[DownloadJob] = None, on_position=None):
+        """Wait for a download slot; on_position(n) is called as the queue moves (0 = started)"""
+        waiting = self._user_tickets(user_id)
+        if waiting >= self.max_queued_per_user + self._user_limit(premium):
+            raise SchedulerFullError(f"You already have {waiting} downloads in progress")
+        
+        ticket = DownloadTicket(user_id, premium, job, on_position)
+        if user_id not in self._queues:
+            self._queues[user_id] = deque()
+            self._rotation[premium].append(user_id)
+        self._queues[user_id].append(ticket)
+        
+        self._dispatch()
+        self._report_positions()
+        try:
+            with span('scheduler_wait'):
+                await ticket.future
+        except BaseException:
+            if ticket.future.done() and not ticket.future.cancelled() and ticket.future.exception() is None:
+                # Slot was granted just as we were cancelled
+                self._release(ticket)
+            else:
+                self._remove_waiting(ticket)
+                self._report_positions()
+            raise
+        
+        try:
+            yield ticket
+        finally:
+            self._release(ticket)
+
+# ======================
+# METADATA CACHE
+# ======================
+TRACKING_PARAMS = {'si', 'feature', 'igshid', 'igsh', 'fbclid', 'gclid', 'ref', 'ref_src', 'share_id'}
+YOUTUBE_ID_RE = re.compile(
+    r'(?:youtube\.com/(?:watch\?(?:.*&)?v=|shorts/|embed/|live/)|youtu\.be/)([\w-]{11})'
+)
+
+def normalize_url(url: str) -> str:
+    """Canonical cache key for a video URL"""
+    url = url.strip()
+    match = YOUTUBE_ID_RE.search(url)
+    if match:
+        return f"youtube:{match.group(1)}"
+    
+    try:
+        parts = urlsplit(url)
+    except ValueError:
+        return url
+    host = parts.netloc.lower()
+    for prefix in ('www.', 'm.', 'mobile.'):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+            break
+    query = sorted(
+        (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+        if k not in TRACKING_PARAMS and not k.startswith('utm_')
+    )
+    return urlunsplit(('https', host, parts.path.rstrip('/'), urlencode(query), ''))
+
+class MetadataCache:
+    """TTL cache of extracted video info, bounded by entries and bytes, with single-flight lookups"""
+    def __init__(self, ttl: int = 600, max_entries: int = 1000, max_bytes: int = 64 * 1024 * 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # key -> (expires_at, size, summary, raw info)
+        self._entries: "OrderedDict[str, Tuple[float, int, Dict, Dict]]" = OrderedDict()
+        self._bytes = 0
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+    
+    def _remove(self, key: str):
+        item = self._entries.pop(key, None)
+        if item:
+            self._bytes -= item[1]
+    
+    def get(self, key: str) -> Optional[Tuple[Dict, Dict]]:
+        """Return (summary, raw info) if cached and fresh"""
+        item = self._entries.get(key)
+        if item is None or item[0] < time.monotonic():
+            if item is not None:
+                self._remove(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return item[2], item[3]
+    
+    def get_raw(self, key: str) -> Tuple[Optional[Dict], int]:
+        """(raw info, size) without touching hit/miss counters"""
+        item = self._entries.get(key)
+        if item is None or item[0] < time.monotonic():
+            return None, 0
+        return item[3], item[1]
+    
+    def put(self, key: str, summary: Dict, raw: Dict, size: int):
+        self._remove(key)
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, size, summary, raw)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+    
+    def _done(self, key: str, task: asyncio.Task):
+        self._inflight.pop(key, None)
+        if task.cancelled():
+            return
+        if task.exception() is None:
+            summary, raw, size = task.result()
+            self.put(key, summary, raw, size)
+    
+    async def get_or_fetch(self, key: str, fetch) -> Tuple[Dict, Dict]:
+        """Cached value, or the result of one shared fetch() for all concurrent callers"""
+        cached = self.get(key)
+        if cached:
+            return cached
+        
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fetch())
+            self._inflight[key] = task
+            task.add_done_callback(functools.partial(self._done, key))
+        else:
+            self.coalesced += 1
+        
+        # Shield so one impatient caller can't cancel the shared extraction
+        summary, raw, _ = await asyncio.shield(task)
+        return summary, raw
+    
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'bytes': self._bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'hit_ratio': self.hits / lookups if lookups else 0.0
+        }
+
+# ======================
+# FORMAT SELECTION
+# ======================
+QUALITY_HEIGHTS = {"8K": 4320, "4K": 2160, "2K": 1440}
+
+def quality_to_height(quality: str) -> int:
+    """'720p' -> 720, '4K' -> 2160"""
+    quality = quality.upper()
+    if quality in QUALITY_HEIGHTS:
+        return QUALITY_HEIGHTS[quality]
+    return int(quality.rstrip('P'))
+
+def estimate_format_size(fmt: Dict, duration: float) -> int:
+    """Best guess of a format's size in bytes (0 if unknown)"""
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if size:
+        return int(size)
+    # tbr is in kbit/s
+    tbr = fmt.get('tbr') or (fmt.get('vbr') or 0) + (fmt.get('abr') or 0)
+    if tbr and duration:
+        return int(tbr * 1000 / 8 * duration)
+    return 0
+
+def select_format(video_info: Dict, format_id: str, max_size: int,
+                  max_height: int) -> Tuple[Optional[str], int, str]:
+    """Pick a yt-dlp format spec that respects the user's size and quality limits.
+    
+    Returns (format spec or None if nothing fits, estimated size, note for the user).
+    """
+    formats = video_info.get('formats', [])
+    audio_only = [f for f in formats if f.get('vcodec') == 'none' and f.get('acodec') != 'none']
+    audio_size = max((f.get('estimated_size') or 0 for f in audio_only), default=0)
+    
+    def total_size(fmt: Dict) -> int:
+        size = fmt.get('estimated_size') or 0
+        # Video-only streams get merged with the best audio
+        if fmt.get('acodec') == 'none' and size:
+            size += audio_size
+        return size
+    
+    def spec(fmt: Dict) -> str:
+        if fmt.get('acodec') == 'none':
+            return f"{fmt['format_id']}+bestaudio/{fmt['format_id']}"
+        return fmt['format_id']
+    
+    videos = [f for f in formats if (f.get('height') or 0) > 0]
+    allowed = sorted(
+        (f for f in videos if f['height'] <= max_height),
+        key=lambda f: (f['height'], total_size(f)),
+        reverse=True
+    )
+    fitting = [f for f in allowed if total_size(f) <= max_size]
+    
+    requested = next((f for f in videos if f['format_id'] == format_id), None)
+    if requested:
+        note = ""
+        if requested['height'] > max_height:
+            note = f"Limited to {max_height}p on your plan"
+        elif total_size(requested) <= max_size:
+            return spec(requested), total_size(requested), ""
+        else:
+            note = "Picked a smaller format that fits your size limit"
+        # Downgrade to the best allowed format at or below the requested height
+        for fmt in fitting:
+            if fmt['height'] <= requested['height']:
+                return spec(fmt), total_size(fmt), note
+        return None, total_size(requested), note
+    
+    if fitting:
+        return spec(fitting[0]), total_size(fitting[0]), ""
+    if allowed:
+        # Every allowed format is known to be too big
+        return None, min(total_size(f) for f in allowed), ""
+    
+    # No height info (e.g. generic extractor): let yt-dlp filter, the size guard does the rest
+    return (
+        f"best[height<=?{max_height}][filesize<?{max_size}]/best[height<=?{max_height}]",
+        0,
+        ""
+    )
+
+# ======================
+# DOWNLOAD SESSIONS
+# ======================
+class DownloadSession:
+    """Everything a quality-selection menu needs once a button is pressed"""
+    def __init__(self, url: str, info: Dict, raw: Optional[Dict], size: int,
+                 user_id: int, formats: List[Dict]):
+        self.url = url
+        self.info = info
+        self.raw = raw
+        self.size = size
+        self.user_id = user_id
+        self.formats = formats
+        self.expires_at = time.monotonic() + PerformanceConfig.SESSION_TTL
+
+class SessionRegistry:
+    """Maps short callback tokens to download sessions (Telegram caps callback_data at 64 bytes)"""
+    def __init__(self, max_entries: int = 5000, max_bytes: int = 128 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._sessions: "OrderedDict[str, DownloadSession]" = OrderedDict()
+        self._bytes = 0
+    
+    def _remove(self, token: str):
+        session = self._sessions.pop(token, None)
+        if session:
+            self._bytes -= session.size
+    
+    def create(self, url: str, info: Dict, raw: Optional[Dict], size: int,
+               user_id: int, formats: List[Dict]) -> str:
+        """Register a session and return its token"""
+        token = secrets.token_urlsafe(6)
+        while token in self._sessions:
+            token = secrets.token_urlsafe(6)
+        
+        if size > self.max_bytes:
+            # Too big to keep; buttons still work, the download just re-extracts
+            raw, size = None, 0
+        
+        self._sessions[token] = DownloadSession(url, info, raw, size, user_id, formats)
+        self._bytes += size
+        
+        now = time.monotonic()
+        while self._sessions:
+            oldest_token, oldest = next(iter(self._sessions.items()))
+            over_limit = len(self._sessions) > self.max_entries or self._bytes > self.max_bytes
+            if not over_limit and oldest.expires_at > now:
+                break
+            if oldest_token == token:
+                break
+            self._remove(oldest_token)
+        return token
+    
+    def get(self, token: str) -> Optional[DownloadSession]:
+        session = self._sessions.get(token)
+        if session and session.expires_at < time.monotonic():
+            self._remove(token)
+            return None
+        return session
+
+# ======================
+# VIDEO DOWNLOADER
+# ======================
+# Audio formats in order of preference for AUDIO_MODE=native: AAC and MP3 need no re-encode
+AUDIO_NATIVE_FORMAT = 'bestaudio[acodec^=mp4a]/bestaudio[ext=m4a]/bestaudio[acodec=mp3]/bestaudio/best'
+
+# Extensions Telegram's sendAudio plays; anything else is converted to MP3
+PLAYABLE_AUDIO_EXTS = ('.m4a', '.mp3')
+
+class VideoDownloader:
+    def __init__(self):
+        self.ydl_opts = {
+            'quiet': True,
+            'no_warnings': True,
+            'extract_flat': False,
+            'socket_timeout': 30,
+            'http_chunk_size': 10485760,
+        }
+        self.metadata_pool = WorkerPool(
+            "metadata",
+            PerformanceConfig.METADATA_WORKERS,
+            PerformanceConfig.METADATA_QUEUE_SIZE
+        )
+        self.download_pool = WorkerPool(
+            "download",
+            PerformanceConfig.DOWNLOAD_WORKERS,
+            PerformanceConfig.DOWNLOAD_QUEUE_SIZE
+        )
+        self.jobs: Dict[str, DownloadJob] = {}
+        self.info_cache = MetadataCache(
+            PerformanceConfig.INFO_CACHE_TTL,
+            PerformanceConfig.INFO_CACHE_SIZE,
+            PerformanceConfig.INFO_CACHE_MAX_BYTES
+        )
+    
+    def new_job(self, user_id: int, max_bytes: int = 0, to_disk: bool = False) -> DownloadJob:
+        """Register a cancellable download job"""
+        job = DownloadJob(user_id, max_bytes, to_disk)
+        self.jobs[job.job_id] = job
+        return job
+    
+    def finish_job(self, job: DownloadJob):
+        """Forget the job and delete its files"""
+        self.jobs.pop(job.job_id, None)
+        job.cleanup()
+    
+    def cancel_job(self, job_id: str, user_id: int) -> bool:
+        """Cancel a job owned by user_id"""
+        job = self.jobs.get(job_id)
+        if not job or job.user_id != user_id:
+            return False
+        job.cancel()
+        return True
+    
+    def shutdown(self):
+        for job in list(self.jobs.values()):
+            job.cancel()
+        self.metadata_pool.shutdown()
+        self.download_pool.shutdown()
+    
+    async def get_video_info(self, url: str) -> Dict:
+        """Get video information (cached, concurrent lookups share one extraction)"""
+        try:
+            with track_stage('info'):
+                summary, _ = await self.info_cache.get_or_fetch(
+                    normalize_url(url),
+                    functools.partial(self._fetch_video_info, url)
+                )
+            return dict(summary)
+        except Exception as e:
+            return {'success': False, 'error': str(e)}
+    
+    def get_cached_info(self, url: str) -> Tuple[Optional[Dict], int]:
+        """(raw yt-dlp info, approximate size) for a recently extracted URL"""
+        return self.info_cache.get_raw(normalize_url(url))
+    
+    async def _fetch_video_info(self, url: str) -> Tuple[Dict, Dict, int]:
+        with track_stage('extract'):
+            info, size = await self.metadata_pool.run(self._extract_info, url)
+        return self._summarize(url, info, size)
+    
+    @staticmethod
+    def _summarize(url: str, info: Dict, size: int) -> Tuple[Dict, Dict, int]:
+        """(summary, raw info, size) as kept in the metadata cache"""
+        formats = []
+        for fmt in info.get('formats', []):
+            if fmt.get('vcodec') != 'none' or fmt.get('acodec') != 'none':
+                formats.append({
+                    'format_id': fmt['format_id'],
+                    'ext': fmt.get('ext', 'mp4'),
+                    'resolution': fmt.get('resolution', 'N/A'),
+                    'height': fmt.get('height', 0),
+                    'width': fmt.get('width', 0),
+                    'filesize': fmt.get('filesize', 0),
+                    'estimated_size': estimate_format_size(fmt, info.get('duration') or 0),
+                    'vcodec': fmt.get('vcodec'),
+                    'acodec': fmt.get('acodec'),
+                    'tbr': fmt.get('tbr'),
+                    'quality': f"{fmt.get('height', 0)}p" if fmt.get('height') else 'Audio',
+                    'note': fmt.get('format_note', '')
+                })
+        
+        summary = {
+            'success': True,
+            'id': info.get('id'),
+            'title': info.get('title', 'Unknown'),
+            'duration': info.get('duration', 0),
+            'thumbnail': info.get('thumbnail', ''),
+            'uploader': info.get('uploader', 'Unknown'),
+            'view_count': info.get('view_count', 0),
+            'like_count': info.get('like_count', 0),
+            'formats': formats,
+            'webpage_url': info.get('webpage_url', url),
+            'extractor': info.get('extractor', 'generic'),
+            'description': (info.get('description') or '')[:500]
+        }
+        return summary, info, size
+    
+    def _extract_info(self, url: str) -> Tuple[Dict, int]:
+        """Blocking metadata extraction (runs in metadata pool)"""
+        with yt_dlp.YoutubeDL(self.ydl_opts) as ydl:
+            info = ydl.sanitize_info(ydl.extract_info(url, download=False))
+        # Approximate footprint, used to bound the metadata cache
+        return info, len(json.dumps(info, default=str))
+    
+    async def expand_urls(self, url: str, limit: int) -> List[str]:
+        """Entry URLs of a playlist link (at most limit), or just the URL itself"""
+        urls, extracted = await self.metadata_pool.run(self._expand_urls, url, limit)
+        if extracted is not None:
+            # Not a playlist, so that was a full extraction: get_video_info reuses it
+            self.info_cache.put(normalize_url(url), *self._summarize(url, *extracted))
+        return urls
+    
+    def _expand_urls(self, url: str, limit: int) -> Tuple[List[str], Optional[Tuple[Dict, int]]]:
+        """Blocking flat playlist extraction (runs in metadata pool).
+        
+        For a single video also returns its (info, size), as _extract_info would.
+        """
+        opts = dict(self.ydl_opts, extract_flat='in_playlist', playlistend=limit)
+        with yt_dlp.YoutubeDL(opts) as ydl:
+            info = ydl.extract_info(url, download=False)
+            if info.get('_type') not in ('playlist', 'multi_video'):
+                info = ydl.sanitize_info(info)
+                return [url], (info, len(json.dumps(info, default=str)))
+        
+        urls = []
+        for entry in info.get('entries') or []:
+            entry_url = entry and (entry.get('webpage_url') or entry.get('url'))
+            if entry_url and re.match(r'^https?://', entry_url):
+                urls.append(entry_url)
+        return urls[:limit], None
+    
+    async def download_video(self, url: str, format_id: str, job: DownloadJob,
+                             info: Optional[Dict] = None) -> Tuple[bool, Union[str, BytesIO], str]:
+        """Download video into memory (small direct formats) or the job's directory.
+        
+        Reuses extracted info when given or still cached.
+        """
+        if info is None:
+            info, _ = self.get_cached_info(url)
+        return await self._run_download('download_video', job, info, self._download_video, url, format_id, job, info)
+    
+    async def _run_download(self, stage: str, job: DownloadJob, info: Optional[Dict], func, *args):
+        """Run a blocking download in the pool; failures become (False, "", message)"""
+        start = time.monotonic()
+        try:
+            result = await self.download_pool.run(func, *args)
+        except asyncio.CancelledError:
+            job.cancel()
+            raise
+        except FileTooLargeError as e:
+            result = False, "", str(e)
+        except yt_dlp.utils.DownloadCancelled:
+            result = False, "", "Download cancelled"
+        except PoolBusyError:
+            result = False, "", "Server is busy, please try again in a minute"
+        except Exception as e:
+            result = False, "", str(e)
+        finally:
+            STAGE_SECONDS.labels(stage).observe(time.monotonic() - start)
+        
+        if not result[0] and not job.cancelled:
+            count_error(stage, extractor_label(info, result[2]))
+        return result
+    
+    def _extract_or_process(self, ydl, url: str, info: Optional[Dict]) -> Dict:
+        """Download from already extracted info when we have it, else extract again"""
+        if info is not None:
+            try:
+                return ydl.process_ie_result(copy.deepcopy(info), download=True)
+            except yt_dlp.utils.DownloadCancelled:
+                raise
+            except Exception as e:
+                # Format URLs may have expired since extraction
+                logger.warning(f"Reusing extracted info failed, re-extracting: {e}")
+        return ydl.extract_info(url, download=True)
+    
+    def _job_opts(self, job: DownloadJob) -> Dict:
+        """yt-dlp options that keep a job inside its own directory"""
+        if job.cancelled:
+            raise yt_dlp.utils.DownloadCancelled("Cancelled by user")
+        os.makedirs(job.workdir, exist_ok=True)
+        
+        opts = self.ydl_opts.copy()
+        # ID-based names: titles collide and may contain unsafe characters
+        opts['outtmpl'] = os.path.join(job.workdir, '%(id)s.%(format_id)s.%(ext)s')
+        opts['progress_hooks'] = [job.progress_hook]
+        if job.max_bytes:
+            opts['max_filesize'] = job.max_bytes
+        return opts
+    
+    @staticmethod
+    def _final_path(info: Dict, job: DownloadJob) -> str:
+        """Path of the finished file (after merging/post-processing)"""
+        for download in info.get('requested_downloads') or []:
+            path = download.get('filepath')
+            if path and os.path.exists(path):
+                return path
+        
+        # Fall back to whatever finished file is in the job directory
+        if os.path.isdir(job.workdir):
+            for name in sorted(os.listdir(job.workdir)):
+                if not name.endswith(('.part', '.ytdl', '.temp')):
+                    return os.path.join(job.workdir, name)
+        
+        if job.max_bytes:
+            # yt-dlp skips files whose announced size exceeds max_filesize
+            raise FileTooLargeError("File is larger than your size limit")
+        raise FileNotFoundError("Downloaded file not found")
+    
+    def _download_video(self, url: str, format_id: str, job: DownloadJob,
+                        info: Optional[Dict] = None) -> Tuple[bool, Union[str, BytesIO], str]:
+        """Blocking video download (runs in download pool)"""
+        buffer = self._download_to_memory(info, format_id, job) if info and not job.to_disk else None
+        if buffer is not None:
+            return True, buffer, info.get('title', 'video')
+        
+        opts = self._job_opts(job)
+        opts['format'] = format_id
+        
+        with yt_dlp.YoutubeDL(opts) as ydl:
+            info = self._extract_or_process(ydl, url, info)
+            return True, self._final_path(info, job), info.get('title', 'video')
+    
+    @staticmethod
+    def _memory_format(info: Dict, format_id: str) -> Optional[Dict]:
+        """The requested format if it is a single progressive HTTP file small enough for memory"""
+        if not PerformanceConfig.MEMORY_DOWNLOAD_MAX:
+            return None
+        for fmt in info.get('formats') or [info]:
+            if fmt.get('format_id') != format_id:
+                continue
+            if fmt.get('protocol') not in ('http', 'https') or not fmt.get('url'):
+                return None
+            # Separate video/audio streams need merging on disk
+            if fmt.get('vcodec') == 'none' or fmt.get('acodec') == 'none':
+                return None
+            size = fmt.get('filesize') or fmt.get('filesize_approx') or 0
+            return fmt if size <= PerformanceConfig.MEMORY_DOWNLOAD_MAX else None
+        return None
+    
+    @staticmethod
+    def _format_headers(fmt: Dict) -> Dict[str, str]:
+        """HTTP headers yt-dlp would send for a format, including its cookies"""
+        headers = dict(fmt.get('http_headers') or {})
+        if fmt.get('cookies'):
+            jar = SimpleCookie()
+            try:
+                jar.load(fmt['cookies'])
+            except CookieError:
+                return headers
+            headers['Cookie'] = '; '.join(f"{name}={morsel.value}" for name, morsel in jar.items())
+        return headers
+    
+    def _download_to_memory(self, info: Dict, format_id: str, job: DownloadJob) -> Optional[BytesIO]:
+        """Fetch a small progressive format into a bounded buffer; None means use the disk path"""
+        fmt = self._memory_format(info, format_id)
+        if fmt is None:
+            return None
+        
+        limit = PerformanceConfig.MEMORY_DOWNLOAD_MAX
+        buffer = BytesIO()
+        start = time.monotonic()
+        try:
+            with requests.get(fmt['url'], headers=self._format_headers(fmt), stream=True, timeout=(10, 30)) as response:
+                response.raise_for_status()
+                total = int(response.headers.get('Content-Length') or 0) or fmt.get('filesize') or 0
+                if total > limit:
+                    return None
+                
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    buffer.write(chunk)
+                    if buffer.tell() > limit:
+                        logger.info(f"Job {job.job_id}: over {limit} bytes, falling back to disk")
+                        return None
+                    elapsed = time.monotonic() - start
+                    job.progress_hook({
+                        'status': 'downloading',
+                        'downloaded_bytes': buffer.tell(),
+                        'total_bytes': total,
+                        'speed': buffer.tell() / elapsed if elapsed else 0,
+                    })
+        except requests.RequestException as e:
+            logger.warning(f"Job {job.job_id}: in-memory download failed, falling back to disk: {e}")
+            return None
+        
+        job.progress_hook({
+            'status': 'finished',
+            'total_bytes': buffer.tell(),
+            'elapsed': time.monotonic() - start,
+            'info_dict': info,
+        })
+        buffer.seek(0)
+        # Name used for the upload's filename and mimetype
+        buffer.name = f"{info.get('id', job.job_id)}.{fmt.get('ext', 'mp4')}"
+        return buffer
+    
+    async def download_audio(self, url: str, job: DownloadJob,
+                             info: Optional[Dict] = None) -> Tuple[bool, str, str]:
+        """Download audio only into the job's directory"""
+        return await self._run_download('download_audio', job, info, self._download_audio, url, job, info)
+    
+    def _download_audio(self, url: str, job: DownloadJob,
+                        info: Optional[Dict] = None) -> Tuple[bool, str, str]:
+        """Blocking audio download (runs in download pool)"""
+        opts = self._job_opts(job)
+        if PerformanceConfig.AUDIO_MODE == "mp3":
+            opts['format'] = 'bestaudio/best'
+            opts['postprocessors'] = [{
+                'key': 'FFmpegExtractAudio',
+                'preferredcodec': 'mp3',
+                'preferredquality': '192',
+            }]
+        else:
+            # Prefer streams Telegram plays as audio so extraction is a stream copy
+            opts['format'] = AUDIO_NATIVE_FORMAT
+            opts['postprocessors'] = [{
+                'key': 'FFmpegExtractAudio',
+                'preferredcodec': 'best',
+            }]
+        
+        with yt_dlp.YoutubeDL(opts) as ydl:
+            info = self._extract_or_process(ydl, url, info)
+            return True, self._final_path(info, job), info.get('title', 'audio')
+
+# ======================
+# UPLOADS
+# ======================
+# Bot upload limits of the cloud Bot API and of a local Bot API server
+CLOUD_UPLOAD_LIMIT = 50 * 1024 * 1024
+LOCAL_UPLOAD_LIMIT = 2000 * 1024 * 1024
+
+class StreamingInputFile(InputFile):
+    """InputFile that keeps the file handle instead of reading it into memory.
+    
+    httpx renders file handles in the multipart body chunk by chunk, so an upload
+    holds only one chunk in memory regardless of the file size.
+    """
+    def __init__(self, media: Union[str, BytesIO], attach: bool = False):
+        # Buffers stay open so a failed upload can be retried from them
+        self.owned = isinstance(media, str)
+        self.handle = open(media, 'rb') if self.owned else media
+        self.handle.seek(0)
+        super().__init__(b'', filename=os.path.basename(self.handle.name), attach=attach)
+        self.input_file_content = self.handle
+    
+    def close(self):
+        if self.owned:
+            self.handle.close()
+
+class Uploader:
+    """Sends finished files to Telegram with a bounded number of uploads in flight"""
+    def __init__(self, max_concurrent: int, local_mode: bool = False):
+        self.local_mode = local_mode
+        self.limit = LOCAL_UPLOAD_LIMIT if local_mode else CLOUD_UPLOAD_LIMIT
+        self.slots = asyncio.Semaphore(max_concurrent)
+        self.active = 0
+    
+    @staticmethod
+    def size(media: Union[str, BytesIO]) -> int:
+        """Size of a downloaded file or in-memory buffer"""
+        if isinstance(media, str):
+            return os.path.getsize(media)
+        return media.getbuffer().nbytes
+    
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        """Hold one of the upload slots"""
+        start = time.monotonic()
+        async with self.slots:
+            STAGE_SECONDS.labels('upload_wait').observe(time.monotonic() - start)
+            self.active += 1
+            try:
+                yield
+            finally:
+                self.active -= 1
+    
+    @contextlib.contextmanager
+    def open_media(self, media: Union[str, BytesIO], attach: bool = False):
+        """What to pass to the Bot API for a path or buffer, closed afterwards"""
+        if self.local_mode and isinstance(media, str) and not attach:
+            # The local server reads the file itself; nothing is copied through the bot
+            yield Path(os.path.abspath(media))
+            return
+        
+        upload = StreamingInputFile(media, attach=attach)
+        try:
+            yield upload
+        finally:
+            upload.close()
+    
+    async def send(self, send, field: str, media: Union[str, BytesIO], **kwargs):
+        """Call a reply_* method with media (a path or buffer) as its media field"""
+        async with self.slot():
+            with track_stage('upload'), self.open_media(media) as upload:
+                sent = await send(
+                    **{field: upload},
+                    write_timeout=PerformanceConfig.UPLOAD_TIMEOUT,
+                    **kwargs
+                )
+        UPLOAD_BYTES.labels(field).inc(self.size(media))
+        return sent
+
+# ======================
+# TRANSCODING
+# ======================
+class TranscodeError(Exception):
+    """Raised when ffmpeg cannot produce the requested output"""
+
+# x264 presets by CPU budget; vp9 uses cpu_used for the same trade-off
+TRANSCODE_PRESETS = {
+    'fast': {'preset': 'veryfast', 'crf': 28, 'cpu_used': 8},
+    'balanced': {'preset': 'medium', 'crf': 24, 'cpu_used': 4},
+    'small': {'preset': 'slow', 'crf': 30, 'cpu_used': 2},
+}
+
+# Output formats: codecs that can be stream-copied into them (None = any) and encoders otherwise
+CONVERT_TARGETS = {
+    'mp4': {'video': {'h264', 'hevc', 'av1'}, 'audio': {'aac', 'mp3'}, 'vcodec': 'libx264', 'acodec': 'aac'},
+    'mov': {'video': {'h264', 'hevc'}, 'audio': {'aac'}, 'vcodec': 'libx264', 'acodec': 'aac'},
+    'mkv': {'video': None, 'audio': None, 'vcodec': 'libx264', 'acodec': 'aac'},
+    'webm': {'video': {'vp8', 'vp9', 'av1'}, 'audio': {'opus', 'vorbis'}, 'vcodec': 'libvpx-vp9', 'acodec': 'libopus'},
+    'mp3': {'video': None, 'audio': {'mp3'}, 'vcodec': None, 'acodec': 'libmp3lame'},
+    'm4a': {'video': None, 'audio': {'aac'}, 'vcodec': None, 'acodec': 'aac'},
+}
+
+class Transcoder:
+    """Runs ffmpeg in its own bounded pool of processes, apart from the download workers"""
+    def __init__(self, max_workers: int, threads: int):
+        self.slots = asyncio.Semaphore(max_workers)
+        self.threads = threads
+        self.active = 0
+    
+    async def _exec(self, args: List[str], job: Optional[DownloadJob] = None) -> bytes:
+        """Run one ffmpeg/ffprobe process, killing it if the job is cancelled"""
+        proc = await asyncio.create_subprocess_exec(
+            *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+            start_new_session=True
+        )
+        output = asyncio.ensure_future(proc.communicate())
+        try:
+            while not output.done():
+                if job and job.cancelled:
+                    raise yt_dlp.utils.DownloadCancelled("Cancelled by user")
+                await asyncio.wait({output}, timeout=0.5)
+        finally:
+            if proc.returncode is None:
+                # Kill the whole process group, helpers included
+                with contextlib.suppress(ProcessLookupError):
+                    os.killpg(proc.pid, signal.SIGKILL)
+                await asyncio.shield(proc.wait())
+            output.cancel()
+        
+        stdout, stderr = output.result()
+        if proc.returncode != 0:
+            lines = stderr.decode(errors='replace').strip().splitlines()
+            raise TranscodeError(lines[-1] if lines else f"{args[0]} exited with {proc.returncode}")
+        return stdout
+    
+    async def probe(self, path: str) -> Dict:
+        """Duration and first video/audio codec of a media file"""
+        output = await self._exec([
+            'ffprobe', '-v', 'error', '-print_format', 'json',
+            '-show_format', '-show_streams', path
+        ])
+        info = json.loads(output or b'{}')
+        streams = info.get('streams', [])
+        video = next((s for s in streams if s.get('codec_type') == 'video'
+                      and not (s.get('disposition') or {}).get('attached_pic')), None)
+        audio = next((s for s in streams if s.get('codec_type') == 'audio'), None)
+        return {
+            'duration': float((info.get('format') or {}).get('duration') or 0),
+            'video': video.get('codec_name') if video else None,
+            'audio': audio.get('codec_name') if audio else None,
+            'height': video.get('height', 0) if video else 0,
+        }
+    
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        async with self.slots:
+            self.active += 1
+            try:
+                yield
+            finally:
+                self.active -= 1
+    
+    def _video_args(self, encoder: str, preset: str) -> List[str]:
+        settings = TRANSCODE_PRESETS[preset]
+        if encoder == 'libvpx-vp9':
+            return ['-c:v', encoder, '-deadline', 'good', '-cpu-used', str(settings['cpu_used']),
+                    '-row-mt', '1', '-b:v', '0', '-crf', str(settings['crf'] + 8)]
+        return ['-c:v', encoder, '-preset', settings['preset'], '-crf', str(settings['crf'])]
+    
+    @staticmethod
+    def _output_path(src: str, suffix: str) -> str:
+        stem = os.path.splitext(src)[0]
+        return f"{stem}.{suffix}"
+    
+    async def convert(self, src: str, fmt: str, job: DownloadJob, preset: str = 'fast') -> Tuple[str, bool]:
+        """Convert to another container; streams are copied when the codecs allow it.
+        
+        Returns (output path, whether it was a pure remux).
+        """
+        target = CONVERT_TARGETS[fmt]
+        info = await self.probe(src)
+        audio_only = target['vcodec'] is None
+        if audio_only and not info['audio']:
+            raise TranscodeError("This video has no audio track")
+        
+        copy_video = info['video'] is None or target['video'] is None or info['video'] in target['video']
+        copy_audio = info['audio'] is None or target['audio'] is None or info['audio'] in target['audio']
+        
+        args = ['ffmpeg', '-y', '-v', 'error', '-i', src]
+        if audio_only:
+            args += ['-map', '0:a:0', '-vn']
+        else:
+            args += ['-map', '0:v:0?', '-map', '0:a:0?']
+            args += ['-c:v', 'copy'] if copy_video else self._video_args(target['vcodec'], preset)
+        args += ['-c:a', 'copy'] if copy_audio else ['-c:a', target['acodec'], '-b:a', '160k']
+        if fmt in ('mp4', 'mov', 'm4a'):
+            args += ['-movflags', '+faststart']
+        
+        output = self._output_path(src, f"converted.{fmt}")
+        async with self.slot():
+            with track_stage('transcode'):
+                await self._exec(args + ['-threads', str(self.threads), output], job)
+        return output, copy_audio and (audio_only or copy_video)
+    
+    async def compress(self, src: str, target_size: int, job: DownloadJob, preset: str = 'fast') -> str:
+        """Two-pass x264 encode sized to fit target_size bytes"""
+        info = await self.probe(src)
+        if not info['video']:
+            raise TranscodeError("No video track to compress")
+        if not info['duration']:
+            raise TranscodeError("Unknown duration, cannot size the output")
+        if os.path.getsize(src) <= target_size and info['video'] == 'h264' and src.endswith('.mp4'):
+            return src
+        
+        # Bitrate budget, leaving ~4% for container overhead
+        total_kbps = target_size * 8 / 1000 / info['duration'] * 0.96
+        audio_kbps = (96 if total_kbps > 400 else 48) if info['audio'] else 0
+        video_kbps = int(total_kbps - audio_kbps)
+        if video_kbps < 60:
+            raise TranscodeError("Video is too long to fit in that size")
+        
+        # Fewer pixels look better than starved bitrate
+        height = 720 if video_kbps > 1500 else 480 if video_kbps > 600 else 360
+        
+        output = self._output_path(src, "compressed.mp4")
+        common = [
+            'ffmpeg', '-y', '-v', 'error', '-i', src, '-map', '0:v:0',
+            '-vf', f"scale=-2:'min({height},ih)'",
+            '-c:v', 'libx264', '-preset', TRANSCODE_PRESETS[preset]['preset'], '-b:v', f"{video_kbps}k",
+            '-passlogfile', os.path.join(job.workdir, 'x264pass'), '-threads', str(self.threads),
+        ]
+        async with self.slot():
+            with track_stage('transcode'):
+                await self._exec(common + ['-pass', '1', '-an', '-f', 'mp4', os.devnull], job)
+                audio = ['-map', '0:a:0', '-c:a', 'aac', '-b:a', f"{audio_kbps}k"] if audio_kbps else []
+                await self._exec(common + ['-pass', '2', *audio, '-movflags', '+faststart', output], job)
+        
+        if os.path.getsize(output) > target_size:
+            raise TranscodeError("Compressed file is still larger than the limit")
+        return output
+
+# ======================
+# DISK JANITOR
+# ======================
+PARTIAL_SUFFIXES = ('.part', '.ytdl', '.temp')
+
+class DiskJanitor:
+    """Keeps the download directory within budget and clears what crashed jobs left behind"""
+    # Only DownloadJob directories (uuid4().hex[:12]) are ever touched
+    JOB_DIR_RE = re.compile(r'^[0-9a-f]{12}$')
+    
+    def __init__(self, root: str, budget: int, min_free: int, active_jobs):
+        self.root = root
+        self.budget = budget
+        self.min_free = min_free
+        # Callable returning the ids of jobs that are still running
+        self.active_jobs = active_jobs
+        self.usage = 0
+        self.reclaimed_total = 0
+        self._lock = threading.Lock()
+        self.unsafe_root = self._is_unsafe_root(root)
+        if self.unsafe_root:
+            logger.error(f"DOWNLOAD_DIR={root} is the working directory, one of its parents or $HOME; "
+                         f"the janitor will not delete anything there")
+    
+    @staticmethod
+    def _is_unsafe_root(root: str) -> bool:
+        resolved = Path(root).resolve()
+        cwd = Path.cwd().resolve()
+        return resolved == cwd or resolved in cwd.parents or resolved == Path.home().resolve()
+    
+    @staticmethod
+    def _entry_size(path: str) -> int:
+        if os.path.isfile(path):
+            return os.path.getsize(path)
+        total = 0
+        for dirpath, _, filenames in os.walk(path):
+            for name in filenames:
+                try:
+                    total += os.path.getsize(os.path.join(dirpath, name))
+                except OSError:
+                    pass
+        return total
+    
+    @staticmethod
+    def _last_modified(path: str) -> float:
+        latest = os.path.getmtime(path)
+        if os.path.isdir(path):
+            for dirpath, _, filenames in os.walk(path):
+                for name in filenames:
+                    try:
+                        latest = max(latest, os.path.getmtime(os.path.join(dirpath, name)))
+                    except OSError:
+                        pass
+        return latest
+    
+    def _remove(self, path: str) -> int:
+        size = self._entry_size(path)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except OSError:
+                return 0
+        return size
+    
+    def sweep(self, grace: Optional[int] = None) -> Dict:
+        """Remove orphans and stale partials, then evict LRU leftovers until under budget"""
+        if grace is None:
+            grace = PerformanceConfig.ORPHAN_GRACE
+        report = {'orphans': 0, 'partials': 0, 'evicted': 0, 'reclaimed': 0}
+        if self.unsafe_root:
+            return report
+        with self._lock:
+            os.makedirs(self.root, exist_ok=True)
+            now = time.time()
+            active = set(self.active_jobs())
+            leftovers = []
+            usage = 0
+            
+            for name in os.listdir(self.root):
+                if not self.JOB_DIR_RE.match(name):
+                    continue
+                path = os.path.join(self.root, name)
+                try:
+                    if name in active:
+                        # Partial files nobody has written to for a while are dead
+                        for dirpath, _, filenames in os.walk(path):
+                            for filename in filenames:
+                                file_path = os.path.join(dirpath, filename)
+                                if (filename.endswith(PARTIAL_SUFFIXES)
+                                        and now - os.path.getmtime(file_path) > PerformanceConfig.STALE_PARTIAL_AGE):
+                                    report['reclaimed'] += self._remove(file_path)
+                                    report['partials'] += 1
+                        usage += self._entry_size(path)
+                        continue
+                    
+                    modified = self._last_modified(path)
+                    if now - modified > grace:
+                        report['reclaimed'] += self._remove(path)
+                        report['orphans'] += 1
+                    else:
+                        size = self._entry_size(path)
+                        leftovers.append((modified, path, size))
+                        usage += size
+                except OSError as e:
+                    logger.warning(f"Janitor skipped {path}: {e}")
+            
+            # Still over budget: drop recent leftovers, least recently modified first
+            for _, path, size in sorted(leftovers):
+                if usage <= self.budget:
+                    break
+                report['reclaimed'] += self._remove(path)
+                report['evicted'] += 1
+                usage -= size
+            
+            self.usage = usage
+            self.reclaimed_total += report['reclaimed']
+            return report
+    
+    def free_bytes(self) -> int:
+        os.makedirs(self.root, exist_ok=True)
+        return shutil.disk_usage(self.root).free
+    
+    def has_capacity(self) -> bool:
+        """False when new jobs should be refused for lack of disk"""
+        return self.free_bytes() >= self.min_free and self.usage < self.budget
+
 # ======================
-# LOGGING SETUP
+# BROADCAST ENGINE
 # ======================
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
-logger = logging.getLogger(__name__)
+class TokenBucket:
+    """Async token bucket: `rate` tokens per second, bursts up to `capacity`"""
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+    
+    def pause(self, seconds: float):
+        """Stop handing out tokens for a while (Telegram's RetryAfter)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+    
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
 
-# ======================
-# DATABASE SIMULATION (Using JSON files)
-# ======================
-class CoolDatabase:
-    def __init__(self):
-        self.users_file = "users.json"
-        self.stats_file = "stats.json"
-        self.downloads_file = "downloads.json"
-        self._init_files()
+class Broadcaster:
+    """Sends a broadcast in the background with rate limiting, checkpoints and resume"""
+    MAX_RETRIES = 3
     
-    def _init_files(self):
-        """Initialize JSON files"""
-        for file in [self.users_file, self.stats_file, self.downloads_file]:
-            if not os.path.exists(file):
-                with open(file, 'w') as f:
-                    json.dump({}, f)
+    def __init__(self, state_file: str, user_cache: UserCache):
+        self.state_file = state_file
+        self.user_cache = user_cache
+        self.state: Optional[Dict] = None
+        self.task: Optional[asyncio.Task] = None
+        self._done_above: set = set()
+        # Users who blocked the bot, marked inactive in one batch at each checkpoint
+        self._blocked: set = set()
     
-    def get_user(self, user_id: int) -> Dict:
-        """Get user data"""
-        try:
-            with open(self.users_file, 'r') as f:
-                users = json.load(f)
-            return users.get(str(user_id), self._create_default_user(user_id))
-        except:
-            return self._create_default_user(user_id)
+    @property
+    def running(self) -> bool:
+        return self.task is not None and not self.task.done()
     
-    def update_user(self, user_id: int, data: Dict):
-        """Update user data"""
+    def _snapshot(self) -> Dict:
+        """Copy of the progress to checkpoint; take it on the event loop, where workers update it"""
+        return {**self.state, 'done_above': sorted(self._done_above)}
+    
+    def _save(self, state: Dict):
+        """Checkpoint a snapshot atomically"""
+        atomic_write(self.state_file, json.dumps(state))
+    
+    def _take_blocked(self) -> set:
+        blocked, self._blocked = self._blocked, set()
+        return blocked
+    
+    def _checkpoint(self, blocked: set, state: Dict):
+        """Mark blocked users inactive, then save the snapshot (safe to run in a worker thread)"""
+        if blocked:
+            try:
+                self.user_cache.update_users({user_id: {'is_active': False} for user_id in blocked})
+            except Exception as e:
+                logger.error(f"Broadcast could not mark {len(blocked)} blocked users inactive: {e}")
+                self._blocked |= blocked
+        self._save(state)
+    
+    def _load(self) -> Optional[Dict]:
         try:
-            with open(self.users_file, 'r') as f:
-                users = json.load(f)
-            
-            user_id_str = str(user_id)
-            if user_id_str not in users:
-                users[user_id_str] = self._create_default_user(user_id)
-            
-            users[user_id_str].update(data)
-            users[user_id_str]['updated_at'] = datetime.now().isoformat()
-            
-            with open(self.users_file, 'w') as f:
-                json.dump(users, f, indent=2)
-        except Exception as e:
-            logger.error(f"Update user error: {e}")
+            with open(self.state_file, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            logger.error(f"Ignoring unreadable broadcast checkpoint {self.state_file}: {e}")
+            return None
     
-    def _create_default_user(self, user_id: int) -> Dict:
-        """Create default user structure"""
-        return {
-            "user_id": user_id,
-            "is_premium": False,
-            "premium_until": None,
-            "daily_downloads": 0,
-            "total_downloads": 0,
-            "referral_code": self._generate_referral_code(),
-            "referrals": [],
-            "redeemed_codes": [],
-            "join_date": datetime.now().isoformat(),
-            "last_reset": datetime.now().date().isoformat()
+    def start(self, application: Application, text: str, user_ids: List[int],
+              admin_chat_id: int, status_message_id: int):
+        self.state = {
+            'id': uuid.uuid4().hex[:8],
+            'text': text,
+            'user_ids': user_ids,
+            'cursor': 0,
+            'sent': 0,
+            'failed': 0,
+            'blocked': 0,
+            'status': 'running',
+            'admin_chat_id': admin_chat_id,
+            'status_message_id': status_message_id,
+            'started': datetime.now().isoformat(),
         }
+        self._done_above = set()
+        self._blocked = set()
+        self._save(self._snapshot())
+        self.task = asyncio.create_task(self._run(application.bot))
     
-    def _generate_referral_code(self) -> str:
-        """Generate random referral code"""
-        return ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
+    def resume(self, application: Application) -> bool:
+        """Continue a broadcast interrupted by a restart"""
+        state = self._load()
+        if not state or state.get('status') != 'running' or self.running:
+            return False
+        self.state = state
+        self._done_above = set(state.get('done_above', []))
+        self.task = asyncio.create_task(self._run(application.bot))
+        return True
     
-    def reset_daily_counts(self):
-        """Reset daily download counts"""
+    def cancel(self) -> bool:
+        if not self.running:
+            return False
+        self.state['status'] = 'cancelled'
+        self.task.cancel()
+        return True
+    
+    async def stop(self):
+        """Shutdown: interrupt the broadcast but keep its checkpoint for resume"""
+        if self.running:
+            self.task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.task
+    
+    def report_text(self) -> str:
+        state = self.state
+        total = len(state['user_ids'])
+        done = state['cursor'] + len(self._done_above)
+        percent = int(done * 100 / total) if total else 100
+        return (
+            f"📤 *Broadcast {state['status']}*\n\n"
+            f"{get_progress_bar(percent)} {percent}%\n"
+            f"👥 {done}/{total} users\n"
+            f"✅ Sent: {state['sent']}\n"
+            f"❌ Failed: {state['failed']}\n"
+            f"🚫 Blocked: {state['blocked']}"
+        )
+    
+    async def _report(self, bot):
         try:
-            today = datetime.now().date().isoformat()
-            with open(self.users_file, 'r') as f:
-                users = json.load(f)
-            
-            for user_id, user_data in users.items():
-                if user_data.get('last_reset') != today:
-                    user_data['daily_downloads'] = 0
-                    user_data['last_reset'] = today
-            
-            with open(self.users_file, 'w') as f:
-                json.dump(users, f, indent=2)
-        except Exception as e:
-            logger.error(f"Reset counts error: {e}")
+            await bot.edit_message_text(
+                self.report_text(),
+                chat_id=self.state['admin_chat_id'],
+                message_id=self.state['status_message_id'],
+                parse_mode='Markdown'
+            )
+        except TelegramError:
+            pass
+    
+    def _mark_done(self, index: int):
+        self._done_above.add(index)
+        # Cursor = everything below it is done; resume starts there
+        while self.state['cursor'] in self._done_above:
+            self._done_above.discard(self.state['cursor'])
+            self.state['cursor'] += 1
+    
+    async def _send(self, bot, bucket: TokenBucket, user_id: int):
+        for _ in range(self.MAX_RETRIES):
+            await bucket.acquire()
+            try:
+                await bot.send_message(chat_id=user_id, text=self.state['text'], parse_mode='Markdown')
+                self.state['sent'] += 1
+                return
+            except RetryAfter as e:
+                bucket.pause(e.retry_after)
+            except Forbidden:
+                # Bot was blocked or the account is gone: skip them next time
+                self.state['blocked'] += 1
+                self._blocked.add(user_id)
+                return
+            except TelegramError:
+                break
+        self.state['failed'] += 1
+    
+    async def _run(self, bot):
+        state = self.state
+        user_ids = state['user_ids']
+        bucket = TokenBucket(PerformanceConfig.BROADCAST_RATE, PerformanceConfig.BROADCAST_RATE)
+        pending = (i for i in range(state['cursor'], len(user_ids)) if i not in self._done_above)
+        
+        async def worker():
+            for index in pending:
+                await self._send(bot, bucket, user_ids[index])
+                self._mark_done(index)
+        
+        # Stopped with an event rather than cancelled: cancelling can't interrupt a
+        # checkpoint already running in a thread, which could then land after the final one
+        stop = asyncio.Event()
+        
+        async def reporter():
+            while True:
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(stop.wait(), PerformanceConfig.BROADCAST_REPORT_INTERVAL)
+                if stop.is_set():
+                    return
+                try:
+                    await asyncio.to_thread(self._checkpoint, self._take_blocked(), self._snapshot())
+                except Exception as e:
+                    logger.error(f"Broadcast checkpoint failed: {e}")
+                await self._report(bot)
+        
+        report_task = asyncio.create_task(reporter())
+        
+        async def stop_reporter():
+            stop.set()
+            await asyncio.gather(report_task, return_exceptions=True)
+        
+        try:
+            await asyncio.gather(*(worker() for _ in range(PerformanceConfig.BROADCAST_CONCURRENCY)))
+            state['status'] = 'completed'
+        except asyncio.CancelledError:
+            if state['status'] == 'running':
+                # Shutdown, not /broadcast cancel: keep 'running' so we resume on restart
+                await stop_reporter()
+                self._checkpoint(self._take_blocked(), self._snapshot())
+                raise
+        finally:
+            await stop_reporter()
+        
+        await asyncio.to_thread(self._checkpoint, self._take_blocked(), self._snapshot())
+        await self._report(bot)
 
-# Initialize database
-db = CoolDatabase()
+# ======================
+# BATCH DOWNLOADS
+# ======================
+MEDIA_GROUP_SIZE = 10  # Telegram's limit for sendMediaGroup
+
+class BatchItem:
+    """One URL of a /batch request and what became of it"""
+    def __init__(self, index: int, url: str):
+        self.index = index
+        self.url = url
+        self.title = url
+        self.video_info: Dict = {}
+        self.variant = ""
+        self.job: Optional[DownloadJob] = None
+        self.media: Optional[str] = None
+        self.size = 0
+        self.cache_key: Optional[str] = None
+        self.cached: Optional[Dict] = None
+        self.error: Optional[str] = None
 
 # ======================
-# VIDEO DOWNLOADER
+# WEB SERVER
 # ======================
-class VideoDownloader:
-    def __init__(self):
-        self.ydl_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'extract_flat': False,
-            'socket_timeout': 30,
-            'http_chunk_size': 10485760,
-        }
+class BotCollector:
+    """Prometheus collector reading queue depths, cache counters and transfer totals at scrape time"""
+    def __init__(self, bot: "CoolVideoBot"):
+        self.bot = bot
     
-    async def get_video_info(self, url: str) -> Dict:
-        """Get video information"""
-        try:
-            with yt_dlp.YoutubeDL(self.ydl_opts) as ydl:
-                info = ydl.extract_info(url, download=False)
-                
-                formats = []
-                for fmt in info.get('formats', []):
-                    if fmt.get('vcodec') != 'none' or fmt.get('acodec') != 'none':
-                        formats.append({
-                            'format_id': fmt['format_id'],
-                            'ext': fmt.get('ext', 'mp4'),
-                            'resolution': fmt.get('resolution', 'N/A'),
-                            'height': fmt.get('height', 0),
-                            'width': fmt.get('width', 0),
-                            'filesize': fmt.get('filesize', 0),
-                            'quality': f"{fmt.get('height', 0)}p" if fmt.get('height') else 'Audio',
-                            'note': fmt.get('format_note', '')
-                        })
-                
-                return {
-                    'success': True,
-                    'title': info.get('title', 'Unknown'),
-                    'duration': info.get('duration', 0),
-                    'thumbnail': info.get('thumbnail', ''),
-                    'uploader': info.get('uploader', 'Unknown'),
-                    'view_count': info.get('view_count', 0),
-                    'like_count': info.get('like_count', 0),
-                    'formats': formats,
-                    'webpage_url': info.get('webpage_url', url),
-                    'extractor': info.get('extractor', 'generic'),
-                    'description': info.get('description', '')[:500]
-                }
-        except Exception as e:
-            return {'success': False, 'error': str(e)}
+    def collect(self):
+        bot = self.bot
+        depth = GaugeMetricFamily('bot_queue_depth', 'Work running or waiting, per queue', labels=['queue'])
+        for queue, value in (
+            ('metadata_pool', bot.downloader.metadata_pool.depth),
+            ('download_pool', bot.downloader.download_pool.depth),
+            ('downloads_running', bot.scheduler.active),
+            ('downloads_queued', bot.scheduler.queued),
+            ('uploads', bot.uploader.active),
+            ('transcodes', bot.transcoder.active),
+        ):
+            depth.add_metric([queue], value)
+        yield depth
+        
+        lookups = CounterMetricFamily('bot_cache_requests', 'Cache lookups by result', labels=['cache', 'result'])
+        ratio = GaugeMetricFamily('bot_cache_hit_ratio', 'Cache hits / lookups since start', labels=['cache'])
+        user_stats = bot.user_cache.stats()
+        info_stats = bot.downloader.info_cache.stats()
+        for cache, hits, misses in (
+            ('user', user_stats['hits'], user_stats['misses']),
+            ('info', info_stats['hits'], info_stats['misses']),
+            ('file_id', file_id_cache.hits, file_id_cache.misses),
+        ):
+            lookups.add_metric([cache, 'hit'], hits)
+            lookups.add_metric([cache, 'miss'], misses)
+            ratio.add_metric([cache], hits / (hits + misses) if hits + misses else 0.0)
+        lookups.add_metric(['info', 'coalesced'], info_stats['coalesced'])
+        yield lookups
+        yield ratio
+        
+        transfers = transfer_stats.snapshot()
+        for name, key, help_text in (
+            ('bot_download_bytes', 'bytes', 'Bytes downloaded from sources'),
+            ('bot_download_transfer_seconds', 'seconds', 'Time spent transferring from sources'),
+            ('bot_downloaded_files', 'downloads', 'Files downloaded from sources'),
+        ):
+            family = CounterMetricFamily(name, help_text, labels=['extractor'])
+            for extractor, totals in transfers.items():
+                family.add_metric([extractor], totals[key])
+            yield family
+        
+        yield GaugeMetricFamily('bot_download_dir_bytes', 'Bytes used in DOWNLOAD_DIR', value=bot.janitor.usage)
+
+class WebServer:
+    """aiohttp server for the Telegram webhook, health/readiness probes and /metrics"""
+    def __init__(self, bot: "CoolVideoBot", webhook_path: str = "", secret: str = ""):
+        self.bot = bot
+        self.secret = secret
+        self.application: Optional[Application] = None
+        self.ready = False
+        self.updates_received = 0
+        self.runner: Optional[web.AppRunner] = None
+        
+        self.app = web.Application()
+        self.app.router.add_get('/healthz', self.healthz)
+        self.app.router.add_get('/readyz', self.readyz)
+        self.app.router.add_get('/metrics', self.metrics)
+        if webhook_path:
+            self.app.router.add_post(webhook_path, self.webhook)
     
-    async def download_video(self, url: str, format_id: str = "best") -> Tuple[bool, str, str]:
-        """Download video"""
-        try:
-            opts = self.ydl_opts.copy()
-            opts['format'] = format_id
-            opts['outtmpl'] = 'downloads/%(title)s.%(ext)s'
-            
-            # Create downloads directory
-            os.makedirs('downloads', exist_ok=True)
-            
-            with yt_dlp.YoutubeDL(opts) as ydl:
-                info = ydl.extract_info(url, download=True)
-                filename = ydl.prepare_filename(info)
-                
-                # Check if file exists
-                if not os.path.exists(filename):
-                    # Try with different extension
-                    for ext in ['.webm', '.mkv', '.mp4', '.m4a', '.mp3']:
-                        alt_filename = filename.rsplit('.', 1)[0] + ext
-                        if os.path.exists(alt_filename):
-                            filename = alt_filename
-                            break
-                
-                return True, filename, info.get('title', 'video')
-        except Exception as e:
-            return False, "", str(e)
+    async def start(self, application: Application, host: str, port: int):
+        self.application = application
+        self.runner = web.AppRunner(self.app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        logger.info(f"HTTP server listening on {host}:{port}")
+    
+    async def stop(self):
+        self.ready = False
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
     
-    async def download_audio(self, url: str) -> Tuple[bool, str, str]:
-        """Download audio only"""
+    async def webhook(self, request: web.Request) -> web.Response:
+        """Queue an update from Telegram; handlers run concurrently off the request"""
+        token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not secrets.compare_digest(token, self.secret):
+            return web.Response(status=403)
+        if not self.application or not self.application.running:
+            return web.Response(status=503)
+        
         try:
-            opts = self.ydl_opts.copy()
-            opts['format'] = 'bestaudio/best'
-            opts['postprocessors'] = [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '192',
-            }]
-            opts['outtmpl'] = 'downloads/%(title)s.%(ext)s'
-            
-            os.makedirs('downloads', exist_ok=True)
-            
-            with yt_dlp.YoutubeDL(opts) as ydl:
-                info = ydl.extract_info(url, download=True)
-                filename = ydl.prepare_filename(info)
-                filename = filename.rsplit('.', 1)[0] + '.mp3'
-                
-                return True, filename, info.get('title', 'audio')
-        except Exception as e:
-            return False, "", str(e)
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        
+        await self.application.update_queue.put(Update.de_json(data, self.application.bot))
+        self.updates_received += 1
+        return web.Response()
+    
+    async def healthz(self, request: web.Request) -> web.Response:
+        """Liveness: the event loop is answering"""
+        return web.Response(text="ok")
+    
+    async def metrics(self, request: web.Request) -> web.Response:
+        """Prometheus scrape endpoint"""
+        return web.Response(body=generate_latest(REGISTRY), headers={'Content-Type': CONTENT_TYPE_LATEST})
+    
+    async def readyz(self, request: web.Request) -> web.Response:
+        """Readiness: the application is running and can take new downloads"""
+        status = {
+            'ready': self.ready and bool(self.application and self.application.running),
+            'disk_ok': self.bot.janitor.has_capacity(),
+            'downloads_running': self.bot.scheduler.active,
+            'downloads_queued': self.bot.scheduler.queued,
+            'updates_pending': self.application.update_queue.qsize() if self.application else 0,
+            'updates_received': self.updates_received,
+        }
+        ok = status['ready'] and status['disk_ok']
+        return web.json_response(status, status=200 if ok else 503)
 
 # ======================
 # MAIN BOT CLASS
@@ -267,7 +2910,31 @@ class VideoDownloader:
 class CoolVideoBot:
     def __init__(self):
         self.downloader = VideoDownloader()
-        self.user_cache = {}
+        self.user_cache = UserCache(db, PerformanceConfig.USER_CACHE_SIZE)
+        self.sessions = SessionRegistry(PerformanceConfig.SESSION_MAX, PerformanceConfig.SESSION_MAX_BYTES)
+        self.web: Optional[WebServer] = None
+        self.transcoder = Transcoder(
+            PerformanceConfig.TRANSCODE_WORKERS,
+            PerformanceConfig.TRANSCODE_THREADS
+        )
+        self.uploader = Uploader(
+            PerformanceConfig.MAX_CONCURRENT_UPLOADS,
+            local_mode=bool(PerformanceConfig.LOCAL_BOT_API_URL)
+        )
+        self.janitor = DiskJanitor(
+            PerformanceConfig.DOWNLOAD_DIR,
+            PerformanceConfig.DOWNLOAD_DIR_BUDGET,
+            PerformanceConfig.MIN_FREE_BYTES,
+            lambda: list(self.downloader.jobs)
+        )
+        self.broadcaster = Broadcaster(PerformanceConfig.BROADCAST_STATE_FILE, self.user_cache)
+        self.scheduler = DownloadScheduler(
+            PerformanceConfig.MAX_CONCURRENT_DOWNLOADS,
+            PerformanceConfig.MAX_QUEUED_PER_USER,
+            PerformanceConfig.PREMIUM_WEIGHT
+        )
+        # Users with a /batch running
+        self.batch_users: set = set()
         
         # Bot commands list
         self.commands = [
@@ -307,7 +2974,7 @@ class CoolVideoBot:
     # ======================
     def is_premium_user(self, user_id: int) -> bool:
         """Check if user is premium"""
-        user_data = db.get_user(user_id)
+        user_data = self.user_cache.get_user(user_id)
         
         # Check fake premium list
         if user_id in PremiumConfig.FAKE_PREMIUM_USERS:
@@ -327,19 +2994,12 @@ class CoolVideoBot:
     
     def can_download(self, user_id: int) -> Tuple[bool, str]:
         """Check if user can download"""
-        user_data = db.get_user(user_id)
+        user_data = self.user_cache.get_user(user_id)
         is_premium = self.is_premium_user(user_id)
         
-        # Reset daily counts if needed
-        today = datetime.now().date().isoformat()
-        if user_data.get('last_reset') != today:
-            user_data['daily_downloads'] = 0
-            user_data['last_reset'] = today
-            db.update_user(user_id, user_data)
-        
         daily_limit = PremiumConfig.PREMIUM_DAILY_LIMIT if is_premium else PremiumConfig.FREE_DAILY_LIMIT
         
-        if user_data.get('daily_downloads', 0) >= daily_limit:
+        if daily_downloads(user_data) >= daily_limit:
             reset_time = "tomorrow"
             return False, f"⚠️ Daily limit reached! ({daily_limit} downloads/day)\nReset: {reset_time}"
         
@@ -347,14 +3007,78 @@ class CoolVideoBot:
     
     def update_download_count(self, user_id: int):
         """Update user download count"""
-        user_data = db.get_user(user_id)
-        current = user_data.get('daily_downloads', 0)
-        total = user_data.get('total_downloads', 0)
+        def count(user_data: Dict):
+            user_data.update({
+                'daily_downloads': daily_downloads(user_data) + 1,
+                'total_downloads': user_data.get('total_downloads', 0) + 1,
+                'last_reset': today_str()
+            })
         
-        db.update_user(user_id, {
-            'daily_downloads': current + 1,
-            'total_downloads': total + 1
-        })
+        self.user_cache.modify_user(user_id, count)
+    
+    async def shutdown(self, application: Application):
+        """Stop worker pools and persist cached users on shutdown"""
+        if self.web:
+            await self.web.stop()
+        await self.broadcaster.stop()
+        self.downloader.shutdown()
+        self.user_cache.flush()
+        download_log.flush()
+        file_id_cache.flush()
+    
+    async def error_handler(self, update: object, context: ContextTypes.DEFAULT_TYPE):
+        """Log errors raised by handlers; a damaged user store gets a maintenance reply"""
+        logger.error(f"Error while handling an update: {context.error}", exc_info=context.error)
+        if isinstance(context.error, StoreCorruptError) and isinstance(update, Update) and update.effective_message:
+            with contextlib.suppress(TelegramError):
+                await update.effective_message.reply_text(
+                    "🛠 The bot is under maintenance right now. Please try again later."
+                )
+    
+    async def run_janitor(self, context: ContextTypes.DEFAULT_TYPE):
+        """Periodic job: clean up the download directory"""
+        report = await asyncio.to_thread(self.janitor.sweep)
+        if report['reclaimed']:
+            logger.info(
+                f"Janitor reclaimed {self.format_size(report['reclaimed'])} "
+                f"({report['orphans']} orphans, {report['partials']} partials, {report['evicted']} evicted)"
+            )
+    
+    async def check_disk(self) -> bool:
+        """True if there is room for another download (sweeps once if not)"""
+        if self.janitor.has_capacity():
+            return True
+        await asyncio.to_thread(self.janitor.sweep)
+        return self.janitor.has_capacity()
+    
+    async def flush_user_cache(self, context: ContextTypes.DEFAULT_TYPE):
+        """Periodic job: write dirty cached users, download rollups and file_ids to disk"""
+        flushed = await self.user_cache.flush_async()
+        if flushed:
+            logger.info(f"Flushed {flushed} cached users")
+        await asyncio.to_thread(download_log.flush)
+        await asyncio.to_thread(file_id_cache.flush)
+    
+    async def require_premium(self, update: Update, feature: str) -> bool:
+        """True for premium users; everyone else is told how to unlock the feature"""
+        if self.is_premium_user(update.effective_user.id):
+            return True
+        await update.message.reply_text(
+            f"🔒 *{feature} is a Premium feature!*\n\n"
+            "Redeem a code with `/vip [code]` to unlock it.",
+            parse_mode='Markdown'
+        )
+        return False
+    
+    def max_file_size(self, is_premium: bool) -> int:
+        """Largest file the user's plan allows that the Bot API can also accept"""
+        plan_size = PremiumConfig.PREMIUM_MAX_SIZE if is_premium else PremiumConfig.FREE_MAX_SIZE
+        return min(plan_size, self.uploader.limit)
+    
+    def max_height(self, is_premium: bool) -> int:
+        """Highest video height allowed on the user's plan"""
+        quality = PremiumConfig.PREMIUM_MAX_QUALITY if is_premium else PremiumConfig.FREE_MAX_QUALITY
+        return quality_to_height(quality)
     
     def format_duration(self, seconds: int) -> str:
         """Format duration"""
@@ -373,6 +3097,118 @@ class CoolVideoBot:
             bytes_size /= 1024.0
         return f"{bytes_size:.1f} TB"
     
+    def video_caption(self, title: str, file_size: int, user, is_premium: bool) -> str:
+        return (
+            f"✅ *Download Complete!*\n\n"
+            f"📹 *{clean_filename(title)}*\n"
+            f"📦 Size: {self.format_size(file_size)}\n"
+            f"👤 User: {user.first_name}\n"
+            f"🎮 Status: {'👑 Premium' if is_premium else '🎯 Free'}"
+        )
+    
+    def audio_caption(self, title: str, user, is_premium: bool) -> str:
+        return (
+            f"✅ *Audio Extracted!*\n\n"
+            f"🎵 *{clean_filename(title)}*\n"
+            f"👤 User: {user.first_name}\n"
+            f"🎮 Status: {'👑 Premium' if is_premium else '🎯 Free'}"
+        )
+    
+    def queue_status_updater(self, status_msg, job: DownloadJob, started_text: str):
+        """on_position callback that shows the queue position in the status message"""
+        async def update(position: int):
+            if position:
+                text = (
+                    f"⏳ *Queued* - position {position}\n"
+                    "Your download starts automatically."
+                )
+            else:
+                text = started_text
+            await status_msg.edit_text(text, reply_markup=cancel_markup(job), parse_mode='Markdown')
+        return update
+    
+    def progress_text(self, header: str, progress: Dict) -> str:
+        downloaded, total = progress.get('downloaded', 0), progress.get('total', 0)
+        percent = min(100, int(downloaded * 100 / total)) if total else 0
+        text = f"{header}\n\n{get_progress_bar(percent)} {percent}%\n"
+        text += f"📦 {self.format_size(downloaded)}"
+        if total:
+            text += f" / {self.format_size(total)}"
+        text += f"\n⚡ {self.format_size(progress.get('speed', 0))}/s"
+        if progress.get('eta') is not None:
+            text += f" • ⏱️ ETA {self.format_duration(int(progress['eta']))}"
+        return text
+    
+    async def report_progress(self, status_msg, job: DownloadJob, header: str):
+        """Edit the status message with live progress, at most once per PROGRESS_INTERVAL"""
+        last_version, last_text = 0, ""
+        while True:
+            await asyncio.sleep(PerformanceConfig.PROGRESS_INTERVAL)
+            version, progress = job.progress()
+            if version == last_version:
+                continue
+            last_version = version
+            text = self.progress_text(header, progress)
+            if text == last_text:
+                continue
+            try:
+                await status_msg.edit_text(text, reply_markup=cancel_markup(job), parse_mode='Markdown')
+                last_text = text
+            except RetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+            except BadRequest:
+                pass
+    
+    @contextlib.asynccontextmanager
+    async def progress_reporter(self, status_msg, job: DownloadJob, header: str):
+        """Run report_progress for the duration of a download"""
+        task = asyncio.create_task(self.report_progress(status_msg, job, header))
+        try:
+            yield
+        finally:
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+    
+    def record_download(self, user_id: int, video_info: Dict, variant: str,
+                        num_bytes: int, started: float, cache_hit: bool):
+        """Append a finished download to the history log"""
+        try:
+            download_log.record({
+                'ts': datetime.now().isoformat(timespec='seconds'),
+                'user': user_id,
+                'extractor': video_info.get('extractor', 'generic'),
+                'title': (video_info.get('title') or '')[:100],
+                'format': variant,
+                'bytes': num_bytes,
+                'duration': round(time.monotonic() - started, 2),
+                'cache_hit': cache_hit
+            })
+        except Exception as e:
+            logger.error(f"Download log error: {e}")
+    
+    def file_cache_key(self, video_info: Dict, variant: str) -> Optional[str]:
+        """file_id cache key for extracted video info, or None if unknown"""
+        if not video_info.get('success') or not video_info.get('id'):
+            return None
+        return FileIdCache.make_key(video_info['extractor'], video_info['id'], variant)
+    
+    async def send_cached_file(self, message, key: str, entry: Dict, caption: str) -> bool:
+        """Resend an already uploaded file by file_id"""
+        send = {
+            'video': message.reply_video,
+            'audio': message.reply_audio,
+            'animation': message.reply_animation,
+            'document': message.reply_document,
+        }[entry['kind']]
+        try:
+            await send(entry['file_id'], caption=caption, parse_mode='Markdown')
+            return True
+        except BadRequest as e:
+            logger.warning(f"Cached file_id rejected ({key}): {e}")
+            file_id_cache.discard(key)
+            return False
+    
     # ======================
     # COMMAND HANDLERS
     # ======================
@@ -382,6 +3218,10 @@ class CoolVideoBot:
         user = update.effective_user
         is_premium = self.is_premium_user(user.id)
         
+        # Users who blocked the bot and came back get broadcasts again
+        if self.user_cache.get_user(user.id).get('is_active') is False:
+            self.user_cache.update_user(user.id, {'is_active': True})
+        
         # Cool ASCII art
         welcome_text = f"""
 ╔══════════════════════════════════╗
@@ -559,7 +3399,7 @@ Type /help for all commands!
 """
         
         # Show available VIP codes
-        user_data = db.get_user(user.id)
+        user_data = self.user_cache.get_user(user.id)
         redeemed = user_data.get('redeemed_codes', [])
         
         for code, days in PremiumConfig.VIP_CODES.items():
@@ -606,10 +3446,10 @@ Example: `/vip WELCOME2024`
     async def myplan(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Show user's current plan"""
         user = update.effective_user
-        user_data = db.get_user(user.id)
+        user_data = self.user_cache.get_user(user.id)
         is_premium = self.is_premium_user(user.id)
         
-        daily_used = user_data.get('daily_downloads', 0)
+        daily_used = daily_downloads(user_data)
         daily_limit = PremiumConfig.PREMIUM_DAILY_LIMIT if is_premium else PremiumConfig.FREE_DAILY_LIMIT
         total_downloads = user_data.get('total_downloads', 0)
         
@@ -626,7 +3466,7 @@ Example: `/vip WELCOME2024`
 
 📥 *Daily Usage:*
 {progress_bar} {daily_used}/{daily_limit}
-Reset: In {24 - datetime.now().hour} hours
+Reset: In {24 - datetime.now(BOT_TZ).hour} hours
 
 📈 *Total Downloads:* {total_downloads}
 
@@ -683,6 +3523,8 @@ Reset: In {24 - datetime.now().hour} hours
         url = context.args[0]
         await self.handle_video_url(update, url)
     
+    @traced('handle_video_url')
+    @timed('analyze')
     async def handle_video_url(self, update: Update, url: str):
         """Process video URL"""
         user = update.effective_user
@@ -717,30 +3559,38 @@ Reset: In {24 - datetime.now().hour} hours
             keyboard = []
             formats = video_info.get('formats', [])
             
-            # Sort formats by quality
-            video_formats = [f for f in formats if f.get('height', 0) > 0]
-            video_formats.sort(key=lambda x: x.get('height', 0), reverse=True)
+            # Sort formats by quality (only those allowed on the user's plan)
+            max_height = self.max_height(self.is_premium_user(user.id))
+            video_formats = [f for f in formats if 0 < (f.get('height') or 0) <= max_height]
+            video_formats.sort(key=lambda x: x.get('height') or 0, reverse=True)
+            
+            video_formats = video_formats[:5]
+            
+            # Buttons carry a short token; the session keeps url + extracted info
+            raw_info, raw_size = self.downloader.get_cached_info(url)
+            token = self.sessions.create(url, video_info, raw_info, raw_size, user.id, video_formats)
             
             # Add best quality option
             keyboard.append([InlineKeyboardButton(
                 "⚡ Best Quality (Auto)", 
-                callback_data=f"download:{url}:best"
+                callback_data=f"dl:{token}:best"
             )])
             
             # Add audio only option
             keyboard.append([InlineKeyboardButton(
                 "🎵 Audio Only (MP3)", 
-                callback_data=f"audio:{url}"
+                callback_data=f"au:{token}"
             )])
             
             # Add quality options (max 5)
-            for fmt in video_formats[:5]:
+            for index, fmt in enumerate(video_formats):
                 quality = fmt.get('quality', 'N/A')
-                size = self.format_size(fmt.get('filesize', 0))
+                estimated = fmt.get('estimated_size') or 0
+                size = f"~{self.format_size(estimated)}" if estimated else "size unknown"
                 text = f"🎬 {quality} ({size})"
                 keyboard.append([InlineKeyboardButton(
                     text,
-                    callback_data=f"download:{url}:{fmt['format_id']}"
+                    callback_data=f"dl:{token}:{index}"
                 )])
             
             reply_markup = InlineKeyboardMarkup(keyboard)
@@ -759,32 +3609,357 @@ Reset: In {24 - datetime.now().hour} hours
 👇 *Select download option:*
             """
             
-            # Send with thumbnail if available
-            if video_info.get('thumbnail'):
-                try:
-                    await update.message.reply_photo(
-                        photo=video_info['thumbnail'],
-                        caption=info_text,
-                        reply_markup=reply_markup,
-                        parse_mode='Markdown'
-                    )
-                    await processing_msg.delete()
-                except:
-                    await processing_msg.edit_text(
-                        info_text,
-                        reply_markup=reply_markup,
-                        parse_mode='Markdown'
-                    )
+            # Send with thumbnail if available
+            if video_info.get('thumbnail'):
+                try:
+                    await update.message.reply_photo(
+                        photo=video_info['thumbnail'],
+                        caption=info_text,
+                        reply_markup=reply_markup,
+                        parse_mode='Markdown'
+                    )
+                    await processing_msg.delete()
+                except:
+                    await processing_msg.edit_text(
+                        info_text,
+                        reply_markup=reply_markup,
+                        parse_mode='Markdown'
+                    )
+            else:
+                await processing_msg.edit_text(
+                    info_text,
+                    reply_markup=reply_markup,
+                    parse_mode='Markdown'
+                )
+                
+        except Exception as e:
+            await processing_msg.edit_text(f"❌ Error: {str(e)}")
+            logger.error(f"Video info error: {traceback.format_exc()}")
+    
+    @traced('process_transcode')
+    async def process_transcode(self, query, url: str, action: str, fmt: str = "mp4",
+                                target_size: int = 0, preset: str = "fast"):
+        """Download a video and compress or convert it with ffmpeg"""
+        user = query.from_user
+        started = time.monotonic()
+        
+        can_download, error_msg = self.can_download(user.id)
+        if not can_download:
+            await query.message.reply_text(error_msg)
+            return
+        
+        if not await self.check_disk():
+            await query.message.reply_text("💾 Server storage is full right now. Please try again in a few minutes.")
+            return
+        
+        is_premium = self.is_premium_user(user.id)
+        max_size = self.max_file_size(is_premium)
+        max_height = self.max_height(is_premium)
+        if action == "compress":
+            target_size = min(target_size or max_size, max_size)
+            variant = f"compress:{preset}:{target_size // (1024 * 1024)}"
+            # The output is sized down anyway, a smaller source is faster to fetch and encode
+            max_height = min(max_height, PerformanceConfig.TRANSCODE_MAX_HEIGHT)
+        else:
+            variant = f"convert:{fmt}"
+        
+        job = self.downloader.new_job(user.id, PerformanceConfig.TRANSCODE_MAX_INPUT)
+        status_msg = await query.message.reply_text(
+            "⏬ *Downloading source video...*",
+            reply_markup=cancel_markup(job),
+            parse_mode='Markdown'
+        )
+        
+        try:
+            video_info = await self.downloader.get_video_info(url)
+            if not video_info.get('success'):
+                await status_msg.edit_text(f"❌ Error: {video_info.get('error', 'Unknown error')}")
+                return
+            
+            selected, estimated_size, _ = select_format(
+                video_info, "best", PerformanceConfig.TRANSCODE_MAX_INPUT, max_height
+            )
+            if selected is None:
+                await status_msg.edit_text(
+                    f"❌ Source too large! (~{self.format_size(estimated_size)})\n"
+                    f"Limit: {self.format_size(PerformanceConfig.TRANSCODE_MAX_INPUT)}"
+                )
+                return
+            
+            # The same source and settings give the same output
+            cache_key = self.file_cache_key(video_info, f"{selected}>{variant}")
+            entry = file_id_cache.get(cache_key) if cache_key else None
+            if entry and entry['file_size'] <= max_size:
+                caption = self.video_caption(video_info['title'], entry['file_size'], user, is_premium)
+                if await self.send_cached_file(query.message, cache_key, entry, caption):
+                    self.update_download_count(user.id)
+                    self.record_download(user.id, video_info, variant, entry['file_size'], started, True)
+                    await status_msg.delete()
+                    return
+            
+            async with self.scheduler.slot(
+                user.id, is_premium, job,
+                self.queue_status_updater(status_msg, job, "⏬ *Downloading source video...*")
+            ):
+                async with self.progress_reporter(status_msg, job, "⏬ *Downloading source video...*"):
+                    success, media, title = await self.downloader.download_video(url, selected, job)
+            
+            if not success:
+                await status_msg.edit_text(f"❌ Download failed: {media}")
+                return
+            
+            if isinstance(media, BytesIO):
+                # ffmpeg reads from disk
+                os.makedirs(job.workdir, exist_ok=True)
+                path = os.path.join(job.workdir, media.name)
+                with open(path, 'wb') as f:
+                    f.write(media.getbuffer())
+                media = path
+            
+            # Transcoding runs outside the download slot, in the transcoder's own pool
+            if action == "compress":
+                await status_msg.edit_text(
+                    f"🗜️ *Compressing to {self.format_size(target_size)}...*\n⏳ Two-pass encode, please wait",
+                    reply_markup=cancel_markup(job),
+                    parse_mode='Markdown'
+                )
+                output = await self.transcoder.compress(media, target_size, job, preset)
+            else:
+                await status_msg.edit_text(
+                    f"🔄 *Converting to {fmt.upper()}...*",
+                    reply_markup=cancel_markup(job),
+                    parse_mode='Markdown'
+                )
+                output, remuxed = await self.transcoder.convert(media, fmt, job, preset)
+                logger.info(f"Converted to {fmt} ({'remux' if remuxed else 'encode'})")
+            
+            file_size = os.path.getsize(output)
+            if file_size > max_size:
+                await status_msg.edit_text(
+                    f"❌ Result too large! ({self.format_size(file_size)})\n"
+                    f"Limit: {self.format_size(max_size)}" +
+                    ("\nTry /compress instead" if action == "convert" else "")
+                )
+                return
+            
+            await status_msg.edit_text("📤 *Uploading to Telegram...*", parse_mode='Markdown')
+            if fmt in ('mp3', 'm4a'):
+                sent = await self.uploader.send(
+                    query.message.reply_audio, 'audio', output,
+                    caption=self.audio_caption(title, user, is_premium),
+                    parse_mode='Markdown'
+                )
+            elif fmt in ('mp4', 'mov'):
+                sent = await self.uploader.send(
+                    query.message.reply_video, 'video', output,
+                    caption=self.video_caption(title, file_size, user, is_premium),
+                    parse_mode='Markdown',
+                    supports_streaming=True
+                )
             else:
-                await processing_msg.edit_text(
-                    info_text,
-                    reply_markup=reply_markup,
+                # Telegram only plays MP4 inline; other containers go as files
+                sent = await self.uploader.send(
+                    query.message.reply_document, 'document', output,
+                    caption=self.video_caption(title, file_size, user, is_premium),
                     parse_mode='Markdown'
                 )
-                
+            
+            if cache_key:
+                entry = FileIdCache.entry_from_message(sent)
+                if entry:
+                    file_id_cache.put(cache_key, entry)
+            
+            self.update_download_count(user.id)
+            self.record_download(user.id, video_info, variant, file_size, started, False)
+            
+            await status_msg.delete()
+        
+        except (yt_dlp.utils.DownloadCancelled, SchedulerFullError) as e:
+            await status_msg.edit_text(f"🛑 {e}")
+        except TranscodeError as e:
+            await status_msg.edit_text(f"❌ Processing failed: {e}")
         except Exception as e:
-            await processing_msg.edit_text(f"❌ Error: {str(e)}")
-            logger.error(f"Video info error: {traceback.format_exc()}")
+            await status_msg.edit_text(f"❌ Error: {str(e)}")
+            logger.error(f"Transcode error: {traceback.format_exc()}")
+        finally:
+            self.downloader.finish_job(job)
+    
+    # ======================
+    # BATCH DOWNLOADS
+    # ======================
+    
+    def batch_status_text(self, items: List[BatchItem], sent: int, header: str = "📦 *Batch download*") -> str:
+        """Progress summary of a batch"""
+        failed = sum(1 for item in items if item.error)
+        text = (
+            f"{header}\n\n"
+            f"✅ Sent: {sent}/{len(items)}\n"
+            f"❌ Failed: {failed}\n"
+            f"⏳ Remaining: {len(items) - sent - failed}"
+        )
+        return text
+    
+    async def fetch_batch_item(self, item: BatchItem, user_id: int, max_size: int, max_height: int):
+        """Extract and download one batch item (or find it in the file_id cache)"""
+        video_info = await self.downloader.get_video_info(item.url)
+        if not video_info.get('success'):
+            item.error = video_info.get('error', 'Unknown error')
+            return
+        item.video_info = video_info
+        item.title = video_info['title']
+        
+        selected, estimated_size, _ = select_format(video_info, 'best', max_size, max_height)
+        if selected is None:
+            item.error = f"Too large (~{self.format_size(estimated_size)})"
+            return
+        item.variant = selected
+        
+        item.cache_key = self.file_cache_key(video_info, selected)
+        entry = file_id_cache.get(item.cache_key) if item.cache_key else None
+        if entry and entry['kind'] == 'video' and entry['file_size'] <= max_size:
+            item.cached = entry
+            item.size = entry['file_size']
+            return
+        
+        # Finished items may wait for a media group, so they must not sit in memory
+        item.job = self.downloader.new_job(user_id, max_size, to_disk=True)
+        async with self.scheduler.slot(user_id, True, item.job):
+            success, media, _ = await self.downloader.download_video(item.url, selected, item.job)
+        if not success:
+            item.error = media
+            return
+        
+        item.size = self.uploader.size(media)
+        if item.size > max_size:
+            item.error = f"Too large ({self.format_size(item.size)})"
+            return
+        item.media = media
+    
+    async def send_batch_group(self, message, group: List[BatchItem]):
+        """Send finished items as one media group; on failure retry them one by one"""
+        try:
+            async with self.uploader.slot():
+                with track_stage('upload'), contextlib.ExitStack() as uploads:
+                    media = [
+                        InputMediaVideo(
+                            item.cached['file_id'] if item.cached
+                            else uploads.enter_context(self.uploader.open_media(item.media, attach=True)),
+                            caption=clean_filename(item.title),
+                            supports_streaming=True
+                        )
+                        for item in group
+                    ]
+                    messages = await message.reply_media_group(
+                        media=media,
+                        write_timeout=PerformanceConfig.UPLOAD_TIMEOUT
+                    )
+        except TelegramError as e:
+            if len(group) == 1:
+                group[0].error = str(e)
+                return
+            # One bad file fails the whole group: isolate it
+            logger.warning(f"Media group of {len(group)} failed, sending individually: {e}")
+            for item in group:
+                await self.send_batch_group(message, [item])
+            return
+        
+        for item, sent in zip(group, messages):
+            if not item.cached:
+                UPLOAD_BYTES.labels('video').inc(item.size)
+            if item.cache_key and not item.cached:
+                entry = FileIdCache.entry_from_message(sent)
+                if entry:
+                    file_id_cache.put(item.cache_key, entry)
+    
+    @traced('run_batch')
+    async def run_batch(self, message, user, urls: List[str], status_msg):
+        """Fetch batch items in parallel and upload them in media groups as they finish.
+        
+        At most BATCH_WORKERS items are fetched at once (fewer if the user's scheduler
+        allowance is smaller, so items queue instead of being refused), and fetching stops
+        running ahead once a full media group is waiting, so finished files never pile up on disk.
+        """
+        started = time.monotonic()
+        max_size = self.max_file_size(True)
+        max_height = self.max_height(True)
+        items = [BatchItem(index, url) for index, url in enumerate(urls)]
+        ready: asyncio.Queue = asyncio.Queue()
+        fetchers_max = max(1, min(PerformanceConfig.BATCH_WORKERS, self.scheduler.remaining(user.id, True)))
+        workers = asyncio.Semaphore(fetchers_max)
+        window = asyncio.Semaphore(MEDIA_GROUP_SIZE + fetchers_max)
+        
+        async def fetch(item: BatchItem):
+            try:
+                await window.acquire()
+                async with workers:
+                    await self.fetch_batch_item(item, user.id, max_size, max_height)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                item.error = str(e)
+            finally:
+                ready.put_nowait(item)
+        
+        fetchers = [asyncio.create_task(fetch(item)) for item in items]
+        sent = 0
+        last_text = ""
+        try:
+            group: List[BatchItem] = []
+            received = 0
+            while received < len(items) or group:
+                item = None
+                if received < len(items):
+                    try:
+                        # A partial group is sent once nothing new arrives for a while
+                        timeout = PerformanceConfig.BATCH_GROUP_WAIT if group else None
+                        item = await asyncio.wait_for(ready.get(), timeout)
+                        received += 1
+                    except asyncio.TimeoutError:
+                        pass
+                
+                if item is not None:
+                    if item.error:
+                        window.release()
+                    else:
+                        group.append(item)
+                
+                if group and (item is None or len(group) == MEDIA_GROUP_SIZE or received == len(items)):
+                    await self.send_batch_group(message, group)
+                    for done in group:
+                        if not done.error:
+                            sent += 1
+                            self.update_download_count(user.id)
+                            self.record_download(
+                                user.id, done.video_info, done.variant, done.size, started, bool(done.cached)
+                            )
+                        if done.job:
+                            self.downloader.finish_job(done.job)
+                            done.job = None
+                        window.release()
+                    group = []
+                
+                text = self.batch_status_text(items, sent)
+                if text != last_text:
+                    with contextlib.suppress(BadRequest, RetryAfter):
+                        await status_msg.edit_text(text, parse_mode='Markdown')
+                    last_text = text
+        finally:
+            for task in fetchers:
+                task.cancel()
+            for item in items:
+                if item.job:
+                    self.downloader.finish_job(item.job)
+        
+        text = self.batch_status_text(items, sent, "📦 *Batch complete!*")
+        failures = [item for item in items if item.error]
+        if failures:
+            text += "\n\n*Failed:*\n"
+            for item in failures[:10]:
+                title = clean_filename(item.title)[:40].translate(self.MARKDOWN_STRIP)
+                text += f"{item.index + 1}. {title}: {str(item.error)[:80].translate(self.MARKDOWN_STRIP)}\n"
+            if len(failures) > 10:
+                text += f"...and {len(failures) - 10} more\n"
+        await status_msg.edit_text(text, parse_mode='Markdown')
     
     async def button_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle button callbacks"""
@@ -794,7 +3969,26 @@ Reset: In {24 - datetime.now().hour} hours
         data = query.data
         user = query.from_user
         
-        if data.startswith("download:"):
+        if data.startswith("dl:") or data.startswith("au:"):
+            parts = data.split(":")
+            session = self.sessions.get(parts[1])
+            if not session:
+                await query.message.reply_text("⌛ This menu has expired. Please send the link again.")
+                return
+            
+            if parts[0] == "au":
+                await self.process_audio(query, session.url, session)
+                return
+            
+            choice = parts[2] if len(parts) > 2 else "best"
+            if choice.isdigit() and int(choice) < len(session.formats):
+                format_id = session.formats[int(choice)]['format_id']
+            else:
+                format_id = "best"
+            await self.process_download(query, session.url, format_id, session)
+        
+        elif data.startswith("download:"):
+            # Buttons sent before session tokens existed
             _, url, format_id = data.split(":", 2)
             await self.process_download(query, url, format_id)
         
@@ -802,6 +3996,16 @@ Reset: In {24 - datetime.now().hour} hours
             url = data.split(":", 1)[1]
             await self.process_audio(query, url)
         
+        elif data.startswith("hist:"):
+            text, reply_markup = self.history_page(user.id, int(data.split(":", 1)[1]))
+            await query.edit_message_text(text, reply_markup=reply_markup, parse_mode='Markdown')
+        
+        elif data.startswith("cancel:"):
+            job_id = data.split(":", 1)[1]
+            if self.downloader.cancel_job(job_id, user.id):
+                if not self.scheduler.cancel(job_id):
+                    await query.edit_message_text("🛑 *Cancelling download...*", parse_mode='Markdown')
+        
         elif data == "premium_info":
             await self.premium_info(update, context)
         
@@ -824,9 +4028,12 @@ Reset: In {24 - datetime.now().hour} hours
                 parse_mode='Markdown'
             )
     
-    async def process_download(self, query, url: str, format_id: str):
+    @traced('process_download')
+    async def process_download(self, query, url: str, format_id: str,
+                               session: Optional[DownloadSession] = None):
         """Process video download"""
         user = query.from_user
+        started = time.monotonic()
         
         # Check download limit
         can_download, error_msg = self.can_download(user.id)
@@ -834,26 +4041,76 @@ Reset: In {24 - datetime.now().hour} hours
             await query.message.reply_text(error_msg)
             return
         
+        if not await self.check_disk():
+            await query.message.reply_text("💾 Server storage is full right now. Please try again in a few minutes.")
+            return
+        
+        is_premium = self.is_premium_user(user.id)
+        max_size = self.max_file_size(is_premium)
+        max_height = self.max_height(is_premium)
+        
+        job = self.downloader.new_job(user.id, max_size)
         status_msg = await query.message.reply_text(
             "⏬ *Downloading video...*\n"
             "⚡ This may take a moment...",
+            reply_markup=cancel_markup(job),
             parse_mode='Markdown'
         )
         
         try:
-            success, filename, title = await self.downloader.download_video(url, format_id)
+            video_info = session.info if session else await self.downloader.get_video_info(url)
+            
+            # Reject or downgrade oversize formats before fetching anything
+            if video_info.get('success'):
+                selected, estimated_size, note = select_format(video_info, format_id, max_size, max_height)
+                if selected is None:
+                    await status_msg.edit_text(
+                        f"❌ File too large! (~{self.format_size(estimated_size)})\n"
+                        f"Limit: {self.format_size(max_size)}\n" +
+                        (f"Use /compress {url} to shrink it!" if is_premium else "Upgrade to premium for larger files!")
+                    )
+                    return
+                format_id = selected
+                if note:
+                    await status_msg.edit_text(
+                        f"⏬ *Downloading video...*\nℹ️ {note}",
+                        reply_markup=cancel_markup(job),
+                        parse_mode='Markdown'
+                    )
+            
+            # Popular videos were already uploaded once: resend by file_id
+            cache_key = self.file_cache_key(video_info, format_id)
+            entry = file_id_cache.get(cache_key) if cache_key else None
+            if entry and entry['file_size'] <= max_size:
+                caption = self.video_caption(video_info['title'], entry['file_size'], user, is_premium)
+                if await self.send_cached_file(query.message, cache_key, entry, caption):
+                    self.update_download_count(user.id)
+                    self.record_download(user.id, video_info, format_id, entry['file_size'], started, True)
+                    await status_msg.delete()
+                    return
+            
+            started_text = "⏬ *Downloading video...*\n⚡ This may take a moment..."
+            async with self.scheduler.slot(
+                user.id, is_premium, job,
+                self.queue_status_updater(status_msg, job, started_text)
+            ):
+                async with self.progress_reporter(status_msg, job, "⏬ *Downloading video...*"):
+                    # Short clips come back as an in-memory buffer, everything else as a path
+                    success, media, title = await self.downloader.download_video(
+                        url, format_id, job, info=session.raw if session else None
+                    )
             
             if not success:
-                await status_msg.edit_text(f"❌ Download failed: {filename}")
+                await status_msg.edit_text(f"❌ Download failed: {media}")
                 return
             
+            # The size check and upload run after the slot is released, like audio and batch items
+            
             # Check file size
-            file_size = os.path.getsize(filename)
-            is_premium = self.is_premium_user(user.id)
-            max_size = PremiumConfig.PREMIUM_MAX_SIZE if is_premium else PremiumConfig.FREE_MAX_SIZE
+            with track_stage('size_check'):
+                file_size = self.uploader.size(media)
             
             if file_size > max_size:
-                os.remove(filename)
                 await status_msg.edit_text(
                     f"❌ File too large! ({self.format_size(file_size)})\n"
                     f"Limit: {self.format_size(max_size)}\n"
@@ -863,37 +4120,39 @@ Reset: In {24 - datetime.now().hour} hours
             
             await status_msg.edit_text("📤 *Uploading to Telegram...*")
             
-            # Send video
-            with open(filename, 'rb') as video_file:
-                await query.message.reply_video(
-                    video=video_file,
-                    caption=f"✅ *Download Complete!*\n\n"
-                          f"📹 *{clean_filename(title)}*\n"
-                          f"📦 Size: {self.format_size(file_size)}\n"
-                          f"👤 User: {user.first_name}\n"
-                          f"🎮 Status: {'👑 Premium' if is_premium else '🎯 Free'}",
-                    parse_mode='Markdown',
-                    supports_streaming=True
-                )
+            # Send video (streamed from disk or memory)
+            sent = await self.uploader.send(
+                query.message.reply_video, 'video', media,
+                caption=self.video_caption(title, file_size, user, is_premium),
+                parse_mode='Markdown',
+                supports_streaming=True
+            )
+            
+            if cache_key:
+                entry = FileIdCache.entry_from_message(sent)
+                if entry:
+                    file_id_cache.put(cache_key, entry)
             
             # Update download count
             self.update_download_count(user.id)
+            self.record_download(user.id, video_info, format_id, file_size, started, False)
             
             await status_msg.delete()
             
-            # Clean up
-            try:
-                os.remove(filename)
-            except:
-                pass
-            
+        except (yt_dlp.utils.DownloadCancelled, SchedulerFullError) as e:
+            await status_msg.edit_text(f"🛑 {e}")
         except Exception as e:
             await status_msg.edit_text(f"❌ Error: {str(e)}")
             logger.error(f"Download error: {traceback.format_exc()}")
+        finally:
+            # Removes the job directory, also on errors and cancellation
+            self.downloader.finish_job(job)
     
-    async def process_audio(self, query, url: str):
+    @traced('process_audio')
+    async def process_audio(self, query, url: str, session: Optional[DownloadSession] = None):
         """Process audio download"""
         user = query.from_user
+        started = time.monotonic()
         
         # Check download limit
         can_download, error_msg = self.can_download(user.id)
@@ -901,46 +4160,82 @@ Reset: In {24 - datetime.now().hour} hours
             await query.message.reply_text(error_msg)
             return
         
+        if not await self.check_disk():
+            await query.message.reply_text("💾 Server storage is full right now. Please try again in a few minutes.")
+            return
+        
+        is_premium = self.is_premium_user(user.id)
+        max_size = self.max_file_size(is_premium)
+        
+        job = self.downloader.new_job(user.id, max_size)
         status_msg = await query.message.reply_text(
             "🎵 *Extracting audio...*\n"
-            "⏳ Converting to MP3...",
+            "⏳ Preparing audio track...",
+            reply_markup=cancel_markup(job),
             parse_mode='Markdown'
         )
         
         try:
-            success, filename, title = await self.downloader.download_audio(url)
+            video_info = session.info if session else await self.downloader.get_video_info(url)
+            
+            # Reuse an earlier upload of the same audio
+            cache_key = self.file_cache_key(video_info, f"audio:{PerformanceConfig.AUDIO_MODE}")
+            entry = file_id_cache.get(cache_key) if cache_key else None
+            if entry:
+                caption = self.audio_caption(video_info['title'], user, is_premium)
+                if await self.send_cached_file(query.message, cache_key, entry, caption):
+                    self.update_download_count(user.id)
+                    self.record_download(user.id, video_info, "audio", entry['file_size'], started, True)
+                    await status_msg.delete()
+                    return
+            
+            started_text = "🎵 *Extracting audio...*\n⏳ Preparing audio track..."
+            async with self.scheduler.slot(
+                user.id, is_premium, job,
+                self.queue_status_updater(status_msg, job, started_text)
+            ):
+                async with self.progress_reporter(status_msg, job, "🎵 *Extracting audio...*"):
+                    success, filename, title = await self.downloader.download_audio(
+                        url, job, info=session.raw if session else None
+                    )
             
             if not success:
                 await status_msg.edit_text(f"❌ Audio extraction failed: {filename}")
                 return
             
+            if not filename.endswith(PLAYABLE_AUDIO_EXTS):
+                # e.g. Opus/Vorbis-only sources; encoded in the transcoder pool, outside the download slot
+                await status_msg.edit_text("🎵 *Converting to MP3...*", parse_mode='Markdown')
+                filename, _ = await self.transcoder.convert(filename, 'mp3', job)
+            
             await status_msg.edit_text("📤 *Uploading audio...*")
             
-            # Send audio
-            with open(filename, 'rb') as audio_file:
-                await query.message.reply_audio(
-                    audio=audio_file,
-                    caption=f"✅ *Audio Extracted!*\n\n"
-                          f"🎵 *{clean_filename(title)}*\n"
-                          f"👤 User: {user.first_name}\n"
-                          f"🎮 Status: {'👑 Premium' if self.is_premium_user(user.id) else '🎯 Free'}",
-                    parse_mode='Markdown'
-                )
+            # Send audio (streamed from disk)
+            sent = await self.uploader.send(
+                query.message.reply_audio, 'audio', filename,
+                caption=self.audio_caption(title, user, is_premium),
+                parse_mode='Markdown'
+            )
+            
+            if cache_key:
+                entry = FileIdCache.entry_from_message(sent)
+                if entry:
+                    file_id_cache.put(cache_key, entry)
             
             # Update download count
             self.update_download_count(user.id)
+            self.record_download(user.id, video_info, "audio", os.path.getsize(filename), started, False)
             
             await status_msg.delete()
             
-            # Clean up
-            try:
-                os.remove(filename)
-            except:
-                pass
-            
+        except (yt_dlp.utils.DownloadCancelled, SchedulerFullError) as e:
+            await status_msg.edit_text(f"🛑 {e}")
         except Exception as e:
             await status_msg.edit_text(f"❌ Error: {str(e)}")
             logger.error(f"Audio error: {traceback.format_exc()}")
+        finally:
+            # Removes the job directory, also on errors and cancellation
+            self.downloader.finish_job(job)
     
     async def audio_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Audio extraction command"""
@@ -955,22 +4250,166 @@ Reset: In {24 - datetime.now().hour} hours
         url = context.args[0]
         user = update.effective_user
         
-        # Create mock query object
-        class MockQuery:
-            def __init__(self, message, user):
-                self.message = message
-                self.from_user = user
-            
-            async def answer(self):
-                pass
-        
-        query = MockQuery(update.message, user)
+        query = MessageQuery(update.message, user)
         await self.process_audio(query, url)
     
+    async def batch_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Download many URLs (or a playlist) in one go (premium)"""
+        user = update.effective_user
+        if not await self.require_premium(update, "Batch download"):
+            return
+        
+        # URLs may follow the command or come on separate lines of the same message
+        urls = list(dict.fromkeys(
+            word for word in (update.message.text or '').split()[1:]
+            if re.match(r'^https?://', word)
+        ))
+        if not urls:
+            await update.message.reply_text(
+                "📦 *Usage:* `/batch [url1] [url2] ...`\n"
+                f"Send up to {PerformanceConfig.BATCH_MAX_ITEMS} links, or one playlist link.",
+                parse_mode='Markdown'
+            )
+            return
+        
+        remaining = PremiumConfig.PREMIUM_DAILY_LIMIT - daily_downloads(self.user_cache.get_user(user.id))
+        limit = min(PerformanceConfig.BATCH_MAX_ITEMS, remaining)
+        if limit <= 0:
+            _, error_msg = self.can_download(user.id)
+            await update.message.reply_text(error_msg)
+            return
+        
+        # Batch items share the user's scheduler allowance, so only one batch at a time
+        if user.id in self.batch_users:
+            await update.message.reply_text("📦 Your previous batch is still running. Please wait for it to finish.")
+            return
+        if self.scheduler.remaining(user.id, True) <= 0:
+            await update.message.reply_text("⏳ You have too many downloads in progress. Please wait for them to finish.")
+            return
+        
+        if not await self.check_disk():
+            await update.message.reply_text("💾 Server storage is full right now. Please try again in a few minutes.")
+            return
+        
+        self.batch_users.add(user.id)
+        try:
+            await self.start_batch(update, user, urls, limit)
+        finally:
+            self.batch_users.discard(user.id)
+    
+    async def start_batch(self, update: Update, user, urls: List[str], limit: int):
+        """Expand the links of a /batch command and run it"""
+        status_msg = await update.message.reply_text("🔍 *Reading links...*", parse_mode='Markdown')
+        try:
+            if len(urls) == 1:
+                urls = await self.downloader.expand_urls(urls[0], limit)
+        except Exception as e:
+            await status_msg.edit_text(f"❌ Error: {str(e)}")
+            return
+        
+        note = ""
+        if len(urls) > limit:
+            note = f"\nℹ️ Only the first {limit} links will be downloaded"
+            urls = urls[:limit]
+        if not urls:
+            await status_msg.edit_text("❌ No videos found in that link")
+            return
+        
+        await status_msg.edit_text(
+            f"📦 *Batch download*\n\n⏳ Fetching {len(urls)} videos...{note}",
+            parse_mode='Markdown'
+        )
+        await self.run_batch(update.message, user, urls, status_msg)
+    
+    async def compress_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Compress a video to fit a size (premium)"""
+        if not await self.require_premium(update, "Compression"):
+            return
+        
+        args = context.args or []
+        size_mb = next((int(arg) for arg in args[1:] if arg.isdigit()), 0)
+        preset = next((arg.lower() for arg in args[1:] if arg.lower() in TRANSCODE_PRESETS), "fast")
+        unknown = [arg for arg in args[1:] if not arg.isdigit() and arg.lower() not in TRANSCODE_PRESETS]
+        if not args or not re.match(r'^https?://', args[0]) or unknown:
+            await update.message.reply_text(
+                "🗜️ *Usage:* `/compress [url] [size_mb] [preset]`\n"
+                f"Presets: {', '.join(TRANSCODE_PRESETS)}\n"
+                f"Example: `/compress https://youtube.com/watch?v=... {PremiumConfig.FREE_MAX_SIZE // (1024 * 1024)}`",
+                parse_mode='Markdown'
+            )
+            return
+        
+        target_size = (size_mb or PremiumConfig.FREE_MAX_SIZE // (1024 * 1024)) * 1024 * 1024
+        await self.process_transcode(
+            MessageQuery(update.message, update.effective_user), args[0], "compress",
+            target_size=target_size, preset=preset
+        )
+    
+    async def convert_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Convert a video to another format (premium)"""
+        if not await self.require_premium(update, "Format conversion"):
+            return
+        
+        args = context.args or []
+        fmt = args[1].lower().lstrip('.') if len(args) > 1 else ""
+        if not args or not re.match(r'^https?://', args[0]) or fmt not in CONVERT_TARGETS:
+            await update.message.reply_text(
+                "🔄 *Usage:* `/convert [url] [format]`\n"
+                f"Formats: {', '.join(CONVERT_TARGETS)}\n"
+                "Example: `/convert https://youtube.com/watch?v=... mp3`",
+                parse_mode='Markdown'
+            )
+            return
+        
+        await self.process_transcode(
+            MessageQuery(update.message, update.effective_user), args[0], "convert", fmt=fmt
+        )
+    
+    HISTORY_PAGE_SIZE = 10
+    MARKDOWN_STRIP = str.maketrans('', '', '_*`[')
+    
+    def history_page(self, user_id: int, page: int) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+        """Text and navigation buttons for one page of /history"""
+        total = download_log.user_count(user_id)
+        if not total:
+            return "📜 *No downloads yet!*\n\nSend me a video URL to get started.", None
+        
+        pages = min(
+            (total + self.HISTORY_PAGE_SIZE - 1) // self.HISTORY_PAGE_SIZE,
+            (PerformanceConfig.HISTORY_PER_USER + self.HISTORY_PAGE_SIZE - 1) // self.HISTORY_PAGE_SIZE
+        )
+        page = max(0, min(page, pages - 1))
+        events = download_log.history(user_id, page, self.HISTORY_PAGE_SIZE)
+        
+        text = f"📜 *YOUR DOWNLOAD HISTORY* (page {page + 1}/{pages})\n\n"
+        for number, event in enumerate(events, start=page * self.HISTORY_PAGE_SIZE + 1):
+            icon = "🎵" if event.get('format') == "audio" else "🎬"
+            text += (
+                f"{number}. {icon} {clean_filename(event.get('title') or 'Untitled')[:60].translate(self.MARKDOWN_STRIP)}\n"
+                f"    {event.get('extractor', '').upper()} • {self.format_size(event.get('bytes', 0))} • "
+                f"{event.get('ts', '')[:16].replace('T', ' ')}"
+                f"{' ⚡' if event.get('cache_hit') else ''}\n"
+            )
+        text += f"\n📈 Total downloads: {total}"
+        
+        buttons = []
+        if page > 0:
+            buttons.append(InlineKeyboardButton("⬅️ Newer", callback_data=f"hist:{page - 1}"))
+        if page < pages - 1:
+            buttons.append(InlineKeyboardButton("Older ➡️", callback_data=f"hist:{page + 1}"))
+        return text, InlineKeyboardMarkup([buttons]) if buttons else None
+    
+    async def history_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Show the user's download history"""
+        user = update.effective_user
+        page = int(context.args[0]) - 1 if context.args and context.args[0].isdigit() else 0
+        text, reply_markup = self.history_page(user.id, page)
+        await update.message.reply_text(text, reply_markup=reply_markup, parse_mode='Markdown')
+    
     async def referral_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Referral program"""
         user = update.effective_user
-        user_data = db.get_user(user.id)
+        user_data = self.user_cache.get_user(user.id)
         referral_code = user_data.get('referral_code', 'N/A')
         
         referral_text = f"""
@@ -1043,7 +4482,7 @@ Reset: In {24 - datetime.now().hour} hours
             )
             return
         
-        user_data = db.get_user(user.id)
+        user_data = self.user_cache.get_user(user.id)
         redeemed = user_data.get('redeemed_codes', [])
         
         # Check if already redeemed
@@ -1057,7 +4496,7 @@ Reset: In {24 - datetime.now().hour} hours
         
         # Update user
         redeemed.append(code)
-        db.update_user(user.id, {
+        self.user_cache.update_user(user.id, {
             'is_premium': True,
             'premium_until': premium_until.isoformat(),
             'redeemed_codes': redeemed
@@ -1076,9 +4515,9 @@ Reset: In {24 - datetime.now().hour} hours
     async def stats_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """User statistics"""
         user = update.effective_user
-        user_data = db.get_user(user.id)
+        user_data = self.user_cache.get_user(user.id)
         
-        daily_used = user_data.get('daily_downloads', 0)
+        daily_used = daily_downloads(user_data)
         total_downloads = user_data.get('total_downloads', 0)
         referrals = len(user_data.get('referrals', []))
         
@@ -1102,7 +4541,7 @@ Reset: In {24 - datetime.now().hour} hours
 👥 *Referrals:* {referrals}
 🎁 *Bonus Downloads:* {referrals * PremiumConfig.REFERRAL_BONUS}
 
-⚡ *Next Reset:* In {24 - datetime.now().hour} hours
+⚡ *Next Reset:* In {24 - datetime.now(BOT_TZ).hour} hours
 
 💡 *Tips:*
 • Invite friends for bonus downloads
@@ -1180,21 +4619,35 @@ Just send the video URL to me!
         
         # Get quick stats
         try:
-            with open("users.json", 'r') as f:
-                users = json.load(f)
+            await self.user_cache.flush_async()
+            total_users, premium_users = await asyncio.to_thread(db.count_users)
             
-            total_users = len(users)
-            premium_users = sum(1 for u in users.values() if u.get('is_premium'))
+            download_totals = download_log.totals()
+            total_downloads = download_totals['total']
             
-            with open("downloads.json", 'r') as f:
-                downloads = json.load(f)
+            cache_stats = self.user_cache.stats()
+            info_stats = self.downloader.info_cache.stats()
             
-            total_downloads = len(downloads)
+            transfer_lines = ""
+            transfers = sorted(transfer_stats.snapshot().items(), key=lambda x: -x[1]['bytes'])
+            for extractor, totals in transfers[:5]:
+                transfer_lines += (
+                    f"  - {extractor}: {totals['downloads']} files, "
+                    f"{self.format_size(totals['speed'])}/s avg\n"
+                )
             
             admin_text += f"""
 • Total Users: {total_users}
 • Premium Users: {premium_users}
-• Total Downloads: {total_downloads}
+• Total Downloads: {total_downloads} ({self.format_size(download_totals['bytes'])}, {download_totals['cache_hits']} from cache)
+• User Cache: {cache_stats['hits']} hits / {cache_stats['misses']} misses ({cache_stats['hit_ratio']:.0%})
+• Info Cache: {info_stats['hits']} hits / {info_stats['coalesced']} coalesced ({info_stats['hit_ratio']:.0%})
+• Downloads: {self.scheduler.active} running / {self.scheduler.queued} queued
+• Transcodes: {self.transcoder.active} running
+• Uploads: {self.uploader.active} running ({'local Bot API' if self.uploader.local_mode else 'cloud Bot API'}, {self.format_size(self.uploader.limit)} limit)
+• Transfer speed by source:
+{transfer_lines or "  - no downloads yet"}
+• Disk: {self.format_size(self.janitor.usage)} used, {self.format_size(self.janitor.free_bytes())} free, {self.format_size(self.janitor.reclaimed_total)} reclaimed
 """
         
         except:
@@ -1206,7 +4659,7 @@ Just send the video URL to me!
         )
     
     async def broadcast_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Broadcast message to all users"""
+        """Broadcast message to all users (runs in the background)"""
         user = update.effective_user
         
         if user.id not in ADMIN_IDS:
@@ -1214,7 +4667,25 @@ Just send the video URL to me!
             return
         
         if not context.args:
-            await update.message.reply_text("Usage: /broadcast [message]")
+            await update.message.reply_text(
+                "Usage: /broadcast [message]\n"
+                "/broadcast status - Show progress\n"
+                "/broadcast cancel - Stop the current broadcast"
+            )
+            return
+        
+        if context.args[0] in ("status", "cancel") and len(context.args) == 1:
+            if not self.broadcaster.state:
+                await update.message.reply_text("No broadcast has run yet.")
+                return
+            if context.args[0] == "cancel" and not self.broadcaster.cancel():
+                await update.message.reply_text("No broadcast is running.")
+                return
+            await update.message.reply_text(self.broadcaster.report_text(), parse_mode='Markdown')
+            return
+        
+        if self.broadcaster.running:
+            await update.message.reply_text("⚠️ A broadcast is already running. Use /broadcast status")
             return
         
         message = " ".join(context.args)
@@ -1228,32 +4699,28 @@ Just send the video URL to me!
 """
         
         try:
-            with open("users.json", 'r') as f:
-                users = json.load(f)
-            
-            sent = 0
-            failed = 0
-            
-            for user_id in users.keys():
-                try:
-                    await context.bot.send_message(
-                        chat_id=int(user_id),
-                        text=broadcast_text,
-                        parse_mode='Markdown'
-                    )
-                    sent += 1
-                except:
-                    failed += 1
-                await asyncio.sleep(0.1)  # Rate limiting
+            # Snapshot recipients off the event loop; users who blocked the bot are skipped
+            await self.user_cache.flush_async()
+            user_ids = await asyncio.to_thread(
+                lambda: sorted(uid for uid, data in db.iter_users() if data.get('is_active', True))
+            )
             
-            await update.message.reply_text(
-                f"📤 Broadcast completed!\n"
-                f"✅ Sent: {sent}\n"
-                f"❌ Failed: {failed}"
+            status_msg = await update.message.reply_text(
+                f"📤 *Broadcast started* to {len(user_ids)} users...",
+                parse_mode='Markdown'
+            )
+            self.broadcaster.start(
+                context.application, broadcast_text, user_ids,
+                status_msg.chat_id, status_msg.message_id
             )
         
         except Exception as e:
             await update.message.reply_text(f"❌ Error: {str(e)}")
+    
+    async def resume_broadcast(self, context: ContextTypes.DEFAULT_TYPE):
+        """Startup job: continue a broadcast interrupted by a restart"""
+        if self.broadcaster.resume(context.application):
+            logger.info("Resumed interrupted broadcast")
 
 # ======================
 # HELPER FUNCTIONS
@@ -1271,6 +4738,21 @@ def get_progress_bar(percentage: int, length: int = 10) -> str:
     filled = int(length * percentage / 100)
     return "█" * filled + "░" * (length - filled)
 
+class MessageQuery:
+    """Stand-in for a callback query so commands can reuse the button code paths"""
+    def __init__(self, message, user):
+        self.message = message
+        self.from_user = user
+    
+    async def answer(self):
+        pass
+
+def cancel_markup(job: DownloadJob) -> InlineKeyboardMarkup:
+    """Inline keyboard with a cancel button for a download job"""
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton("❌ Cancel", callback_data=f"cancel:{job.job_id}")
+    ]])
+
 # ======================
 # BOT SETUP
 # ======================
@@ -1288,31 +4770,37 @@ async def post_init(application: Application):
         BotCommand("vip", "🎟️ Redeem VIP code"),
     ])
 
-def main():
-    """Start the bot"""
-    # Check token
-    if not BOT_TOKEN or BOT_TOKEN == "YOUR_BOT_TOKEN_HERE":
-        print("❌ ERROR: BOT_TOKEN not set!")
-        print("Set BOT_TOKEN in environment variables or .env file")
-        return
-    
-    print(f"""
-╔══════════════════════════════════╗
-║     PREMIUM VIDEO DOWNLOADER     ║
-║            🤖 BOT               ║
-╚══════════════════════════════════╝
-    
-✅ Token: {BOT_TOKEN[:15]}...
-✅ Admin IDs: {ADMIN_IDS}
-✅ Starting bot...
-    """)
-    
-    # Create application
-    application = Application.builder().token(BOT_TOKEN).post_init(post_init).build()
-    
-    # Initialize bot
-    bot = CoolVideoBot()
+async def run_webhook(application: Application, web_server: WebServer):
+    """Run the application on webhooks delivered to web_server until SIGINT/SIGTERM"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
     
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    try:
+        await web_server.start(application, PerformanceConfig.HTTP_HOST, PerformanceConfig.PORT)
+        await application.bot.set_webhook(
+            url=f"{PerformanceConfig.WEBHOOK_URL}{PerformanceConfig.WEBHOOK_PATH}",
+            secret_token=PerformanceConfig.WEBHOOK_SECRET,
+            allowed_updates=["message", "callback_query"],
+            max_connections=PerformanceConfig.WEBHOOK_MAX_CONNECTIONS,
+            drop_pending_updates=True
+        )
+        web_server.ready = True
+        await stop.wait()
+    finally:
+        web_server.ready = False
+        await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+def add_handlers(application: Application, bot: CoolVideoBot):
+    """Register the bot's command, message and callback handlers"""
     # Add command handlers
     application.add_handler(CommandHandler("start", bot.start))
     application.add_handler(CommandHandler("help", bot.help_command))
@@ -1323,6 +4811,10 @@ def main():
     application.add_handler(CommandHandler("refer", bot.referral_command))
     application.add_handler(CommandHandler("vip", bot.vip_command))
     application.add_handler(CommandHandler("stats", bot.stats_command))
+    application.add_handler(CommandHandler("history", bot.history_command))
+    application.add_handler(CommandHandler("batch", bot.batch_command))
+    application.add_handler(CommandHandler("compress", bot.compress_command))
+    application.add_handler(CommandHandler("convert", bot.convert_command))
     application.add_handler(CommandHandler("trending", bot.trending_command))
     application.add_handler(CommandHandler("admin", bot.admin_command))
     application.add_handler(CommandHandler("broadcast", bot.broadcast_command))
@@ -1341,18 +4833,106 @@ def main():
     # Add callback handler
     application.add_handler(CallbackQueryHandler(bot.button_callback))
     
-    # Reset daily counts periodically
+    application.add_error_handler(bot.error_handler)
+
+def main():
+    """Start the bot"""
+    # Check token
+    if not BOT_TOKEN or BOT_TOKEN == "YOUR_BOT_TOKEN_HERE":
+        print("❌ ERROR: BOT_TOKEN not set!")
+        print("Set BOT_TOKEN in environment variables or .env file")
+        return
+    
+    print(f"""
+╔══════════════════════════════════╗
+║     PREMIUM VIDEO DOWNLOADER     ║
+║            🤖 BOT               ║
+╚══════════════════════════════════╝
+    
+✅ Token: {BOT_TOKEN[:15]}...
+✅ Admin IDs: {ADMIN_IDS}
+✅ Starting bot...
+    """)
+    
+    # Initialize bot
+    bot = CoolVideoBot()
+    webhook_mode = bool(PerformanceConfig.WEBHOOK_URL)
+    REGISTRY.register(BotCollector(bot))
+    bot.web = WebServer(
+        bot,
+        webhook_path=PerformanceConfig.WEBHOOK_PATH if webhook_mode else "",
+        secret=PerformanceConfig.WEBHOOK_SECRET
+    )
+    
+    async def on_startup(application: Application):
+        await post_init(application)
+        # Polling on a web dyno still has to answer on $PORT; metrics need the server too
+        if not webhook_mode and ("PORT" in os.environ or PerformanceConfig.METRICS_ENABLED):
+            host = PerformanceConfig.HTTP_HOST
+            if "PORT" not in os.environ and "HTTP_HOST" not in os.environ:
+                # Only serving metrics: don't expose them publicly by default
+                host = "127.0.0.1"
+            await bot.web.start(application, host, PerformanceConfig.PORT)
+            bot.web.ready = True
+    
+    # Create application (updates run concurrently so slow downloads don't block others)
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(PerformanceConfig.CONCURRENT_UPDATES)
+        .post_init(on_startup)
+        .post_shutdown(bot.shutdown)
+    )
+    if PerformanceConfig.LOCAL_BOT_API_URL:
+        # Local Bot API server: 2GB uploads, files are passed by path
+        builder = (
+            builder
+            .base_url(f"{PerformanceConfig.LOCAL_BOT_API_URL}/bot")
+            .base_file_url(f"{PerformanceConfig.LOCAL_BOT_API_URL}/file/bot")
+            .local_mode(True)
+        )
+    application = builder.build()
+    
+    add_handlers(application, bot)
+    
+    # Persist cached users periodically
+    application.job_queue.run_repeating(
+        bot.flush_user_cache,
+        interval=PerformanceConfig.USER_CACHE_FLUSH_INTERVAL,
+        first=PerformanceConfig.USER_CACHE_FLUSH_INTERVAL
+    )
+    
+    # Clean the download directory now (nothing is running yet) and on a schedule
+    report = bot.janitor.sweep(grace=0)
+    if report['reclaimed']:
+        print(f"🧹 Reclaimed {bot.format_size(report['reclaimed'])} from {PerformanceConfig.DOWNLOAD_DIR}/")
+    application.job_queue.run_repeating(
+        bot.run_janitor,
+        interval=PerformanceConfig.JANITOR_INTERVAL,
+        first=PerformanceConfig.JANITOR_INTERVAL
+    )
+    
+    # Pick up a broadcast that was interrupted by a restart
+    application.job_queue.run_once(bot.resume_broadcast, when=5)
+    
+    # Reset daily counts at midnight in the configured timezone
     async def reset_counts(context: ContextTypes.DEFAULT_TYPE):
-        db.reset_daily_counts()
+        await asyncio.to_thread(bot.user_cache.reset_daily_counts)
+    
+    application.job_queue.run_daily(reset_counts, time=dtime(0, 0, tzinfo=BOT_TZ))
     
     # Start bot
     print("🤖 Bot is running...")
     print("📱 Go to Telegram and start using!")
     
-    application.run_polling(
-        drop_pending_updates=True,
-        allowed_updates=["message", "callback_query"]
-    )
+    if webhook_mode:
+        print(f"🌐 Webhook: {PerformanceConfig.WEBHOOK_URL}{PerformanceConfig.WEBHOOK_PATH} (port {PerformanceConfig.PORT})")
+        asyncio.run(run_webhook(application, bot.web))
+    else:
+        application.run_polling(
+            drop_pending_updates=True,
+            allowed_updates=["message", "callback_query"]
+        )
 
 if __name__ == '__main__':
     main()